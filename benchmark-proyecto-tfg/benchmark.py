@@ -0,0 +1,561 @@
+import argparse
+import array
+import json
+import math
+import os
+import platform
+import random
+import re
+import shutil
+import signal
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+import uuid
+import wave
+from concurrent.futures import ThreadPoolExecutor
+
+# Banco de pruebas de las cuatro versiones del servicio. Genera audios sintéticos de varias duraciones, arranca cada
+# versión en local (con un Redis propio si lo necesita) o usa una ya arrancada con --url, le envía peticiones a
+# /transcripcion_archivo con la concurrencia indicada y escribe en JSON el rendimiento, la latencia (p50, p95 y p99),
+# el factor de tiempo real y la memoria máxima de sus procesos.
+# Funciona sin red y sin GPU, pero los pesos del modelo tienen que estar ya descargados (por ejemplo, con
+# python -c "import whisper; whisper.load_model('tiny')", o en la caché de Hugging Face para la versión JAX).
+# Solo usa la biblioteca estándar, así que puede lanzarse con el Python de cualquiera de los servicios:
+#   python benchmark-proyecto-tfg/benchmark.py --variantes flask asyncio --duraciones 5 30 --concurrencia 1 4
+# Para una ejecución corta (integración continua): --duraciones 5 --peticiones 2 (el modelo por defecto es tiny)
+
+DIRECTORIO = os.path.dirname(os.path.abspath(__file__))
+RAIZ = os.path.dirname(DIRECTORIO)
+DIRECTORIO_AUDIOS = os.path.join(DIRECTORIO, "audios")
+
+FRECUENCIA_MUESTREO = 16000
+PUERTO_REDIS = 6379
+
+CELERY = [sys.executable, "-m", "celery"]
+
+# Cómo se arranca y cómo responde cada versión: los procesos (la API y, si lo hay, el worker de Celery), el puerto, la
+# contraseña del Redis que necesita (None, si no usa Redis) y el formato de la respuesta de /transcripcion_archivo:
+# la página con el resultado, una línea JSON por evento hasta el fin o la página de "Procesando", con el identificador
+# de la tarea cuyos eventos se siguen después por SSE
+VARIANTES = {
+    "flask": {
+        "directorio": "whisperFlask-proyecto-tfg",
+        "puerto": 3000,
+        "redis": None,
+        "procesos": {"api": [sys.executable, "main.py"]},
+        "respuesta": "html",
+    },
+    "asyncio": {
+        "directorio": "whisperFastAPIAsyncio-proyecto-tfg",
+        "puerto": 5000,
+        "redis": None,
+        "procesos": {"api": [sys.executable, "main.py"]},
+        "respuesta": "html",
+    },
+    "celery": {
+        "directorio": "whisperFastAPICelery-proyecto-tfg",
+        "puerto": 8000,
+        "redis": "1234",
+        "procesos": {
+            "worker": CELERY + ["-A", "worker.celery_app", "worker", "--pool=solo", "--loglevel=warning"],
+            "api": [sys.executable, "main.py"],
+        },
+        "respuesta": "ndjson",
+    },
+    "jax": {
+        "directorio": "whisperJAX-proyecto-tfg",
+        "puerto": 9000,
+        "redis": "",
+        "procesos": {
+            "worker": CELERY + ["-A", "main.celery_app", "worker", "--pool=solo", "--loglevel=warning"],
+            "api": [sys.executable, "main.py"],
+        },
+        "respuesta": "sse",
+    },
+}
+
+
+# ---------------------------------------------------------------------------------------------------------------------
+# Audios sintéticos
+
+# Sílaba sintética: los primeros armónicos de una fundamental de voz, con una envolvente que sube y baja
+def _silaba(aleatorio):
+    longitud = int(aleatorio.uniform(0.12, 0.35) * FRECUENCIA_MUESTREO)
+    fundamental = aleatorio.uniform(100, 250)
+    deriva = aleatorio.uniform(-0.2, 0.2)
+    amplitudes = [aleatorio.uniform(0.2, 1) / armonico for armonico in range(1, 6)]
+
+    muestras = array.array("h")
+    fase = 0.0
+    for i in range(longitud):
+        fase += 2 * math.pi * fundamental * (1 + deriva * i / longitud) / FRECUENCIA_MUESTREO
+        envolvente = math.sin(math.pi * i / longitud)
+        valor = sum(amplitud * math.sin(armonico * fase) for armonico, amplitud in enumerate(amplitudes, 1))
+        muestras.append(int(6000 * envolvente * valor))
+    return muestras
+
+
+# Audio parecido a la voz (frases de sílabas separadas por pausas con ruido de fondo) de la duración indicada. Es
+# siempre el mismo para la misma semilla, y las pausas dejan que la detección de voz lo divida en fragmentos
+def generar_audio(ruta, duracion, semilla=0):
+    aleatorio = random.Random(semilla)
+    silabas = [_silaba(aleatorio) for _ in range(40)]
+    ruido = array.array("h", (int(aleatorio.gauss(0, 30)) for _ in range(FRECUENCIA_MUESTREO)))
+
+    def pausa(segundos):
+        longitud = int(segundos * FRECUENCIA_MUESTREO)
+        inicio = aleatorio.randrange(len(ruido) - longitud) if longitud < len(ruido) else 0
+        return (ruido * (longitud // len(ruido) + 1))[inicio:inicio + longitud]
+
+    total = int(duracion * FRECUENCIA_MUESTREO)
+    muestras = array.array("h")
+    while len(muestras) < total:
+        for _ in range(aleatorio.randint(4, 12)):
+            muestras.extend(aleatorio.choice(silabas))
+            muestras.extend(pausa(aleatorio.uniform(0.02, 0.08)))
+        muestras.extend(pausa(aleatorio.uniform(0.3, 1.2)))
+    del muestras[total:]
+
+    with wave.open(ruta, "wb") as archivo:
+        archivo.setnchannels(1)
+        archivo.setsampwidth(2)
+        archivo.setframerate(FRECUENCIA_MUESTREO)
+        archivo.writeframes(muestras.tobytes())
+
+
+# Ruta del audio sintético de la duración indicada, generándolo la primera vez
+def audio_sintetico(duracion):
+    os.makedirs(DIRECTORIO_AUDIOS, exist_ok=True)
+    ruta = os.path.join(DIRECTORIO_AUDIOS, f"sintetico_{duracion:g}s.wav")
+    if not os.path.exists(ruta):
+        generar_audio(ruta, duracion)
+    return ruta
+
+
+# Contenido del audio para la petición número indicada. Salvo que se quiera medir la caché, se cambia la última
+# muestra para que cada petición tenga un contenido distinto y la caché de resultados no la responda
+def contenido_peticion(datos, numero, con_cache):
+    if con_cache:
+        return datos
+    return datos[:-2] + struct.pack("<h", numero % 32768)
+
+
+# ---------------------------------------------------------------------------------------------------------------------
+# Peticiones
+
+# Cuerpo multipart/form-data con los campos y el archivo de audio, y su tipo de contenido
+def _multipart(campos, nombre_archivo, datos):
+    frontera = uuid.uuid4().hex
+    partes = []
+    for nombre, valor in campos.items():
+        partes.append(f'--{frontera}\r\nContent-Disposition: form-data; name="{nombre}"\r\n\r\n{valor}\r\n'.encode())
+    partes.append(f'--{frontera}\r\nContent-Disposition: form-data; name="archivo_audio"; '
+                  f'filename="{nombre_archivo}"\r\nContent-Type: audio/wav\r\n\r\n'.encode())
+    partes.append(datos)
+    partes.append(f"\r\n--{frontera}--\r\n".encode())
+    return b"".join(partes), f"multipart/form-data; boundary={frontera}"
+
+
+# Leer las líneas JSON de eventos hasta el de fin. Un evento de error hace fallar la petición
+def _esperar_ndjson(respuesta):
+    for linea in respuesta:
+        if not linea.strip():
+            continue
+        evento = json.loads(linea)
+        if evento["tipo"] == "error":
+            raise RuntimeError(evento.get("mensaje", "error en la tarea"))
+        if evento["tipo"] == "fin":
+            return
+    raise RuntimeError("la respuesta terminó sin evento de fin")
+
+
+# Leer los eventos enviados por el servidor hasta el de fin
+def _esperar_sse(respuesta):
+    for linea in respuesta:
+        linea = linea.decode().strip()
+        if linea == "event: error":
+            raise RuntimeError("error en la tarea")
+        if linea == "event: fin":
+            return
+    raise RuntimeError("la respuesta terminó sin evento de fin")
+
+
+# Transcribir un audio y devolver los segundos hasta tener el resultado completo. En las versiones con Celery se
+# espera al fin de la tarea, no solo a que se encole
+def transcribir(url, variante, datos, nombre_archivo, modelo, tiempo_maximo):
+    formato = VARIANTES[variante]["respuesta"]
+    campos = {"modelo": modelo or ""}
+    if formato == "ndjson":
+        campos["streaming"] = "true"
+    cuerpo, tipo = _multipart(campos, nombre_archivo, datos)
+    peticion = urllib.request.Request(url + "/transcripcion_archivo", data=cuerpo, headers={"Content-Type": tipo})
+
+    inicio = time.perf_counter()
+    with urllib.request.urlopen(peticion, timeout=tiempo_maximo) as respuesta:
+        if formato == "ndjson":
+            _esperar_ndjson(respuesta)
+        elif formato == "sse":
+            pagina = respuesta.read().decode()
+            encontrado = re.search(r'const taskId = "([^"]+)"', pagina)
+            if not encontrado:
+                raise RuntimeError("la respuesta no contiene el identificador de la tarea")
+            with urllib.request.urlopen(f"{url}/eventos/{encontrado.group(1)}", timeout=tiempo_maximo) as eventos:
+                _esperar_sse(eventos)
+        else:
+            respuesta.read()
+    return time.perf_counter() - inicio
+
+
+# Valores de /metrics, por serie. Si el servicio no las expone se devuelve un diccionario vacío
+def leer_metricas(url):
+    try:
+        with urllib.request.urlopen(url + "/metrics", timeout=30) as respuesta:
+            texto = respuesta.read().decode()
+    except (urllib.error.URLError, OSError):
+        return {}
+
+    valores = {}
+    for linea in texto.splitlines():
+        if linea and not linea.startswith("#"):
+            serie, _, valor = linea.rpartition(" ")
+            valores[serie] = float(valor)
+    return valores
+
+
+# Medias del factor de tiempo real y de cada etapa medidos por el servicio entre dos lecturas de /metrics
+def metricas_servidor(antes, despues):
+    def diferencia(serie):
+        return despues.get(serie, 0.0) - antes.get(serie, 0.0)
+
+    def media(nombre, etiquetas=""):
+        cuenta = diferencia(f"{nombre}_count{etiquetas}")
+        return diferencia(f"{nombre}_sum{etiquetas}") / cuenta if cuenta else None
+
+    etapas = {}
+    for serie in despues:
+        encontrado = re.fullmatch(r'whisper_etapa_segundos_count\{etapa="([^"]+)"\}', serie)
+        if encontrado and diferencia(serie):
+            etapas[encontrado.group(1)] = media("whisper_etapa_segundos", "{" + serie.split("{", 1)[1])
+    return {"rtf_medio": media("whisper_factor_tiempo_real"), "etapas": etapas}
+
+
+# Percentil p (de 0 a 100) con interpolación lineal entre los dos valores más próximos
+def percentil(valores, p):
+    ordenados = sorted(valores)
+    if not ordenados:
+        return None
+    posicion = (len(ordenados) - 1) * p / 100
+    inferior = math.floor(posicion)
+    superior = min(inferior + 1, len(ordenados) - 1)
+    return ordenados[inferior] + (ordenados[superior] - ordenados[inferior]) * (posicion - inferior)
+
+
+def resumen(valores):
+    if not valores:
+        return None
+    return {"media": sum(valores) / len(valores), "p50": percentil(valores, 50), "p95": percentil(valores, 95),
+            "p99": percentil(valores, 99), "maximo": max(valores)}
+
+
+# ---------------------------------------------------------------------------------------------------------------------
+# Procesos
+
+# Procesos hijos (y sus descendientes) de un proceso, leyendo /proc
+def _arbol_procesos(pid):
+    hijos = {}
+    for entrada in os.listdir("/proc"):
+        if not entrada.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entrada}/stat") as archivo:
+                # El nombre del proceso va entre paréntesis y puede tener espacios; el padre va justo después del estado
+                padre = int(archivo.read().rsplit(")", 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        hijos.setdefault(padre, []).append(int(entrada))
+
+    arbol, pendientes = [], [pid]
+    while pendientes:
+        actual = pendientes.pop()
+        arbol.append(actual)
+        pendientes.extend(hijos.get(actual, []))
+    return arbol
+
+
+# Memoria residente en bytes de un proceso, o 0 si ya terminó
+def _memoria_residente(pid):
+    try:
+        with open(f"/proc/{pid}/status") as archivo:
+            for linea in archivo:
+                if linea.startswith("VmRSS:"):
+                    return int(linea.split()[1]) * 1024
+    except OSError:
+        pass
+    return 0
+
+
+# Hilo que mide periódicamente la memoria residente de cada proceso del servicio (sumando la de sus hijos) y guarda
+# la máxima de cada uno y la máxima del conjunto. Con reiniciar se leen los máximos y se empieza a medir de nuevo
+class MedidorMemoria:
+
+    def __init__(self, procesos, intervalo=0.2):
+        self.procesos = procesos
+        self.intervalo = intervalo
+        self.maximos = {}
+        self.cerrojo = threading.Lock()
+        self.detenido = threading.Event()
+        self.hilo = threading.Thread(target=self._bucle, name="medidor-memoria", daemon=True)
+        self.hilo.start()
+
+    def _bucle(self):
+        while not self.detenido.wait(self.intervalo):
+            memoria = {nombre: sum(_memoria_residente(pid) for pid in _arbol_procesos(proceso.pid))
+                       for nombre, proceso in self.procesos.items()}
+            memoria["total"] = sum(memoria.values())
+            with self.cerrojo:
+                for nombre, valor in memoria.items():
+                    self.maximos[nombre] = max(self.maximos.get(nombre, 0), valor)
+
+    def reiniciar(self):
+        with self.cerrojo:
+            maximos, self.maximos = self.maximos, {}
+        return maximos
+
+    def detener(self):
+        self.detenido.set()
+        self.hilo.join()
+
+
+def _puerto_ocupado(puerto):
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as conexion:
+        return conexion.connect_ex(("127.0.0.1", puerto)) == 0
+
+
+def _esperar_puerto(puerto, tiempo_maximo, proceso):
+    limite = time.monotonic() + tiempo_maximo
+    while not _puerto_ocupado(puerto):
+        if proceso.poll() is not None:
+            raise RuntimeError(f"el proceso terminó al arrancar con código {proceso.returncode}")
+        if time.monotonic() > limite:
+            raise RuntimeError(f"el puerto {puerto} no se abrió en {tiempo_maximo} segundos")
+        time.sleep(0.5)
+
+
+# Lanzar un proceso en su propio grupo, para poder terminarlo junto con sus hijos, con la salida en un registro
+def _lanzar(comando, directorio, entorno, registro):
+    with open(registro, "ab") as salida:
+        return subprocess.Popen(comando, cwd=directorio, env=entorno, stdout=salida, stderr=subprocess.STDOUT,
+                                start_new_session=True)
+
+
+def _terminar(proceso, espera=15):
+    if proceso.poll() is not None:
+        return
+    os.killpg(proceso.pid, signal.SIGTERM)
+    try:
+        proceso.wait(espera)
+    except subprocess.TimeoutExpired:
+        os.killpg(proceso.pid, signal.SIGKILL)
+        proceso.wait()
+
+
+# Servidor de Redis local y temporal, sin persistencia, en el puerto al que se conectan los servicios. Si el puerto ya
+# está ocupado se usa el Redis que haya en él
+def arrancar_redis(contrasena, binario, registros):
+    if _puerto_ocupado(PUERTO_REDIS):
+        print(f"Usando el Redis que ya escucha en el puerto {PUERTO_REDIS}", file=sys.stderr)
+        return None
+    binario = binario or shutil.which("redis-server")
+    if not binario:
+        raise RuntimeError("no se encuentra redis-server; indique su ruta con --redis-server")
+
+    comando = [binario, "--port", str(PUERTO_REDIS), "--save", "", "--appendonly", "no"]
+    if contrasena:
+        comando += ["--requirepass", contrasena]
+    proceso = _lanzar(comando, registros, os.environ.copy(), os.path.join(registros, "redis.log"))
+    _esperar_puerto(PUERTO_REDIS, 30, proceso)
+    return proceso
+
+
+# Entorno de los procesos del servicio: el modelo pedido, solo CPU, sin acceso a la red para descargar modelos y con
+# la caché y las subidas en un directorio temporal
+def entorno_servicio(variante, args, temporal):
+    entorno = os.environ.copy()
+    entorno.update({
+        "CUDA_VISIBLE_DEVICES": "",
+        "JAX_PLATFORMS": "cpu",
+        "HF_HUB_OFFLINE": "1",
+        "TRANSFORMERS_OFFLINE": "1",
+        "CACHE_DIR": os.path.join(temporal, "cache"),
+        "DIRECTORIO_SUBIDAS": os.path.join(temporal, "subidas"),
+        "PYTHONUNBUFFERED": "1",
+    })
+    if args.modelo:
+        entorno["TAMANO_MODELO"] = args.modelo
+    if args.backend:
+        entorno["BACKEND"] = args.backend
+    contrasena = VARIANTES[variante]["redis"]
+    if contrasena is not None:
+        url = f"redis://:{contrasena}@localhost:{PUERTO_REDIS}/0"
+        if not contrasena:
+            url = f"redis://localhost:{PUERTO_REDIS}/0"
+        # Celery da prioridad a estas variables sobre el broker y el backend escritos en el código
+        entorno.update({"REDIS_URL": url, "CELERY_BROKER_URL": url, "CELERY_RESULT_BACKEND": url})
+    return entorno
+
+
+# ---------------------------------------------------------------------------------------------------------------------
+# Ejecución
+
+# Enviar args.peticiones peticiones con el audio, con la concurrencia indicada, y resumir latencias, rendimiento,
+# factor de tiempo real y memoria
+def medir(url, variante, args, ruta, duracion, concurrencia, medidor, numeros):
+    with open(ruta, "rb") as archivo:
+        datos = archivo.read()
+    nombre_archivo = os.path.basename(ruta)
+
+    def peticion(numero):
+        try:
+            return transcribir(url, variante, contenido_peticion(datos, numero, args.cache), nombre_archivo,
+                               args.modelo, args.tiempo_maximo), None
+        except urllib.error.HTTPError as e:
+            return None, e.code
+        except (urllib.error.URLError, OSError, RuntimeError, ValueError) as e:
+            return None, str(e)
+
+    metricas_antes = leer_metricas(url)
+    if medidor:
+        medidor.reiniciar()
+    inicio = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrencia) as pool:
+        respuestas = list(pool.map(peticion, [next(numeros) for _ in range(args.peticiones)]))
+    segundos = time.perf_counter() - inicio
+    memoria = medidor.reiniciar() if medidor else None
+
+    latencias = [latencia for latencia, _ in respuestas if latencia is not None]
+    errores = [error for _, error in respuestas if error is not None]
+    return {
+        "duracion_audio": duracion,
+        "concurrencia": concurrencia,
+        "peticiones": len(respuestas),
+        "correctas": len(latencias),
+        # Peticiones rechazadas por la cola llena (503) y el resto de errores
+        "rechazadas": errores.count(503),
+        "errores": [error for error in errores if error != 503],
+        "segundos": segundos,
+        "rendimiento": {
+            "peticiones_por_segundo": len(latencias) / segundos,
+            "segundos_audio_por_segundo": len(latencias) * duracion / segundos,
+        },
+        "latencia": resumen(latencias),
+        # Factor de tiempo real visto por el cliente: segundos de respuesta por segundo de audio, con subida y colas
+        "rtf": resumen([latencia / duracion for latencia in latencias]),
+        "servidor": metricas_servidor(metricas_antes, leer_metricas(url)),
+        "memoria_maxima": memoria,
+    }
+
+
+def _esperar_servicio(url, tiempo_maximo):
+    limite = time.monotonic() + tiempo_maximo
+    while True:
+        try:
+            with urllib.request.urlopen(url + "/", timeout=10) as respuesta:
+                respuesta.read()
+                return
+        except (urllib.error.URLError, OSError):
+            if time.monotonic() > limite:
+                raise RuntimeError(f"{url} no responde tras {tiempo_maximo} segundos")
+            time.sleep(1)
+
+
+# Medir una versión: arrancarla (salvo que se indique su URL), calentarla con el audio más corto y medir cada duración
+# con cada concurrencia
+def medir_variante(variante, args, audios):
+    configuracion = VARIANTES[variante]
+    url = args.url or f"http://localhost:{configuracion['puerto']}"
+    procesos, redis, medidor = {}, None, None
+    temporal = tempfile.mkdtemp(prefix=f"benchmark-{variante}-")
+    try:
+        if not args.url:
+            directorio = os.path.join(RAIZ, configuracion["directorio"])
+            entorno = entorno_servicio(variante, args, temporal)
+            if configuracion["redis"] is not None:
+                redis = arrancar_redis(configuracion["redis"], args.redis_server, temporal)
+            for nombre, comando in configuracion["procesos"].items():
+                procesos[nombre] = _lanzar(comando, directorio, entorno, os.path.join(temporal, f"{nombre}.log"))
+            _esperar_puerto(configuracion["puerto"], args.tiempo_arranque, procesos["api"])
+            medidor = MedidorMemoria(procesos)
+        _esperar_servicio(url, args.tiempo_arranque)
+
+        # El calentamiento incluye la carga del modelo, que no se mide
+        numeros = iter(range(1, sys.maxsize))
+        duracion_minima = min(audios)
+        for _ in range(args.calentamiento):
+            with open(audios[duracion_minima], "rb") as archivo:
+                datos = contenido_peticion(archivo.read(), next(numeros), args.cache)
+            transcribir(url, variante, datos, os.path.basename(audios[duracion_minima]), args.modelo,
+                        args.tiempo_maximo)
+
+        medidas = []
+        for concurrencia in args.concurrencia:
+            for duracion, ruta in sorted(audios.items()):
+                print(f"{variante}: {duracion:g} s de audio, concurrencia {concurrencia}", file=sys.stderr)
+                medidas.append(medir(url, variante, args, ruta, duracion, concurrencia, medidor, numeros))
+        return {"variante": variante, "url": url, "medidas": medidas, "registros": None if args.url else temporal}
+    finally:
+        if medidor:
+            medidor.detener()
+        for proceso in reversed(list(procesos.values())):
+            _terminar(proceso)
+        if redis:
+            _terminar(redis)
+        if args.url:
+            shutil.rmtree(temporal, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Banco de pruebas de las versiones del servicio de transcripción")
+    parser.add_argument("--variantes", nargs="+", choices=list(VARIANTES), default=list(VARIANTES))
+    parser.add_argument("--url", help="URL de un servicio ya arrancado (solo con una variante); no se arranca nada")
+    parser.add_argument("--modelo", default="tiny", help="tamaño del modelo (por defecto, tiny)")
+    parser.add_argument("--backend", help="backend de inferencia de los servicios (BACKEND)")
+    parser.add_argument("--duraciones", nargs="+", type=float, default=[5, 30, 120],
+                        help="duraciones en segundos de los audios sintéticos")
+    parser.add_argument("--concurrencia", nargs="+", type=int, default=[1],
+                        help="peticiones simultáneas; con varios valores se mide cada uno")
+    parser.add_argument("--peticiones", type=int, default=4, help="peticiones por duración y concurrencia")
+    parser.add_argument("--calentamiento", type=int, default=1, help="peticiones sin medir antes de empezar")
+    parser.add_argument("--cache", action="store_true", help="repetir el mismo audio para medir la caché")
+    parser.add_argument("--tiempo-maximo", type=float, default=1800, help="segundos máximos por petición")
+    parser.add_argument("--tiempo-arranque", type=float, default=600, help="segundos máximos de arranque")
+    parser.add_argument("--redis-server", help="ruta de redis-server (por defecto, el del PATH)")
+    parser.add_argument("--salida", help="archivo JSON de resultados (por defecto, la salida estándar)")
+    args = parser.parse_args()
+    if args.url and len(args.variantes) != 1:
+        parser.error("--url solo puede usarse con una variante")
+
+    audios = {duracion: audio_sintetico(duracion) for duracion in args.duraciones}
+    resultados = {
+        "entorno": {"python": platform.python_version(), "sistema": platform.platform(), "cpus": os.cpu_count()},
+        "modelo": args.modelo,
+        "cache": args.cache,
+        "resultados": [medir_variante(variante, args, audios) for variante in args.variantes],
+    }
+
+    texto = json.dumps(resultados, indent=2, ensure_ascii=False)
+    if args.salida:
+        with open(args.salida, "w") as archivo:
+            archivo.write(texto + "\n")
+    else:
+        print(texto)
+
+
+if __name__ == "__main__":
+    main()
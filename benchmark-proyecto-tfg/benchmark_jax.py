@@ -0,0 +1,81 @@
+import argparse
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+
+# Banco de pruebas del modelo de Whisper JAX sin el servicio: separa el tiempo de compilación de XLA, que se paga una
+# vez al arrancar cada proceso del worker, del factor de tiempo real en estado estacionario, que es el que ven las
+# peticiones una vez calentado el modelo. Para cada duración de audio sintético escribe en JSON la mediana de los
+# segundos y del factor de tiempo real de varias transcripciones. Necesita el entorno de la versión JAX, de donde toma
+# backends.py, con los pesos del modelo ya en la caché de Hugging Face:
+#   JAX_PLATFORMS=cpu python benchmark-proyecto-tfg/benchmark_jax.py --modelo tiny --duraciones 5 30 120
+
+DIRECTORIO = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(DIRECTORIO), "whisperJAX-proyecto-tfg"))
+
+from backends import FRECUENCIA_MUESTREO, cargar_modelo  # noqa: E402
+from benchmark import audio_sintetico  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compilación y factor de tiempo real del modelo de Whisper JAX")
+    parser.add_argument("--modelo", default="tiny", help="tamaño del modelo (por defecto, tiny)")
+    parser.add_argument("--duraciones", nargs="+", type=float, default=[5, 30, 120],
+                        help="duraciones de los audios, en segundos")
+    parser.add_argument("--repeticiones", type=int, default=3, help="transcripciones medidas de cada audio")
+    parser.add_argument("--salida", help="archivo JSON de resultados (por defecto, la salida estándar)")
+    args = parser.parse_args()
+
+    import jax
+
+    inicio = time.perf_counter()
+    modelo = cargar_modelo(args.modelo, "jax")
+    carga = time.perf_counter() - inicio
+
+    calentamiento = modelo.calentar()
+    print(f"Carga {carga:.1f} s, compilación {calentamiento['compilacion']:.1f} s", file=sys.stderr)
+
+    resultados = []
+    for duracion in args.duraciones:
+        audio = modelo.cargar_audio(audio_sintetico(duracion))
+        segundos = []
+        for _ in range(args.repeticiones):
+            inicio = time.perf_counter()
+            modelo.transcribir_audio(audio)
+            segundos.append(time.perf_counter() - inicio)
+        mediana = statistics.median(segundos)
+        resultados.append({
+            "duracion": duracion,
+            "segundos": mediana,
+            "rtf": mediana / (len(audio) / FRECUENCIA_MUESTREO),
+            # La primera transcripción de cada audio también tiene que estar ya compilada
+            "primera": segundos[0],
+        })
+        print(f"{duracion:g} s: rtf {resultados[-1]['rtf']:.3f}", file=sys.stderr)
+
+    informe = {
+        "maquina": {"plataforma": platform.platform(), "procesador": platform.processor(), "nucleos": os.cpu_count(),
+                    "jax": jax.__version__, "backend_jax": jax.default_backend(),
+                    "dispositivos": jax.local_device_count()},
+        "modelo": modelo.nombre,
+        "dtype": modelo.dtype,
+        "lote": modelo.lote,
+        "carga_segundos": carga,
+        "compilacion_segundos": calentamiento["compilacion"],
+        "pasada_calentada_segundos": calentamiento["pasada"],
+        "repeticiones": args.repeticiones,
+        "resultados": resultados,
+    }
+    texto = json.dumps(informe, indent=2, ensure_ascii=False)
+    if args.salida:
+        with open(args.salida, "w") as archivo:
+            archivo.write(texto + "\n")
+    else:
+        print(texto)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+import argparse
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+
+import numpy as np
+import torch
+import whisper
+from whisper.audio import N_FRAMES, N_SAMPLES, SAMPLE_RATE
+
+# Microbanco de pruebas del espectrograma log-Mel: compara, para audios de varias duraciones, el cálculo de
+# whisper.log_mel_spectrogram seguido de las ventanas de 30 segundos con pad_or_trim (lo que se hacía antes en cada
+# petición) con el de espectrograma.py, y el de los fragmentos de 30 segundos de un audio largo uno a uno con el
+# cálculo por lotes. Escribe en JSON la mediana de los milisegundos de cada forma, la mejora y la diferencia máxima
+# entre los espectrogramas. Necesita el entorno de uno de los servicios, de donde toma espectrograma.py:
+#   python benchmark-proyecto-tfg/benchmark_mel.py --duraciones 30 120 600 --hilos 1
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(RAIZ, "whisperFlask-proyecto-tfg"))
+
+from espectrograma import log_mel, log_mel_lote, ventana_mel  # noqa: E402
+
+
+# Cálculo anterior: el espectrograma con whisper y cada ventana recortada y rellenada con pad_or_trim
+def mel_whisper(audio, dispositivo):
+    mel = whisper.log_mel_spectrogram(torch.from_numpy(audio).to(dispositivo))
+    ventanas = [whisper.pad_or_trim(mel[:, inicio:], N_FRAMES) for inicio in range(0, mel.shape[-1], N_FRAMES)]
+    return mel, ventanas
+
+
+def mel_frontal(audio, dispositivo):
+    mel = log_mel(audio, dispositivo)
+    ventanas = [ventana_mel(mel, inicio) for inicio in range(0, mel.shape[-1], N_FRAMES)]
+    return mel, ventanas
+
+
+def fragmentos_whisper(fragmentos, dispositivo):
+    return [whisper.log_mel_spectrogram(torch.from_numpy(fragmento).to(dispositivo)) for fragmento in fragmentos]
+
+
+def fragmentos_frontal(fragmentos, dispositivo):
+    return log_mel_lote(fragmentos, dispositivo)
+
+
+# Mediana de los milisegundos de funcion(*args) en varias repeticiones, tras una sin medir, y su último resultado
+def cronometrar(funcion, args, repeticiones, dispositivo):
+    resultado = funcion(*args)
+    tiempos = []
+    for _ in range(repeticiones):
+        inicio = time.perf_counter()
+        resultado = funcion(*args)
+        if dispositivo.type == "cuda":
+            torch.cuda.synchronize()
+        tiempos.append((time.perf_counter() - inicio) * 1000)
+    return statistics.median(tiempos), resultado
+
+
+def comparar(anterior, nuevo, args, repeticiones, dispositivo):
+    ms_anterior, resultado_anterior = cronometrar(anterior, args, repeticiones, dispositivo)
+    ms_nuevo, resultado_nuevo = cronometrar(nuevo, args, repeticiones, dispositivo)
+    mels_anterior = resultado_anterior[:1] if isinstance(resultado_anterior, tuple) else resultado_anterior
+    mels_nuevo = resultado_nuevo[:1] if isinstance(resultado_nuevo, tuple) else resultado_nuevo
+    return {
+        "ms_whisper": ms_anterior,
+        "ms_frontal": ms_nuevo,
+        "mejora": ms_anterior / ms_nuevo if ms_nuevo else 0.0,
+        "diferencia_maxima": max((a - b).abs().max().item() for a, b in zip(mels_anterior, mels_nuevo)),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Microbanco de pruebas del espectrograma log-Mel")
+    parser.add_argument("--duraciones", nargs="+", type=float, default=[30, 120, 600],
+                        help="duraciones de los audios, en segundos")
+    parser.add_argument("--repeticiones", type=int, default=10, help="repeticiones medidas de cada cálculo")
+    parser.add_argument("--hilos", type=int, help="hilos de torch (por defecto, los de torch)")
+    parser.add_argument("--dispositivo", default="cpu", help="dispositivo de torch (por defecto, cpu)")
+    parser.add_argument("--salida", help="archivo JSON de resultados (por defecto, la salida estándar)")
+    args = parser.parse_args()
+
+    if args.hilos:
+        torch.set_num_threads(args.hilos)
+    dispositivo = torch.device(args.dispositivo)
+    aleatorio = np.random.default_rng(0)
+
+    resultados = []
+    with torch.inference_mode():
+        for duracion in args.duraciones:
+            audio = (0.1 * aleatorio.standard_normal(int(duracion * SAMPLE_RATE))).astype(np.float32)
+            fragmentos = [audio[inicio:inicio + N_SAMPLES] for inicio in range(0, len(audio), N_SAMPLES)]
+            resultados.append({
+                "duracion": duracion,
+                "archivo": comparar(mel_whisper, mel_frontal, (audio, dispositivo), args.repeticiones, dispositivo),
+                "fragmentos": comparar(fragmentos_whisper, fragmentos_frontal, (fragmentos, dispositivo),
+                                       args.repeticiones, dispositivo),
+            })
+            print(f"{duracion:g} s: archivo x{resultados[-1]['archivo']['mejora']:.2f}, "
+                  f"fragmentos x{resultados[-1]['fragmentos']['mejora']:.2f}", file=sys.stderr)
+
+    informe = {
+        "maquina": {"plataforma": platform.platform(), "procesador": platform.processor(), "nucleos": os.cpu_count(),
+                    "torch": torch.__version__, "hilos_torch": torch.get_num_threads(),
+                    "dispositivo": str(dispositivo)},
+        "repeticiones": args.repeticiones,
+        "resultados": resultados,
+    }
+    texto = json.dumps(informe, indent=2, ensure_ascii=False)
+    if args.salida:
+        with open(args.salida, "w") as archivo:
+            archivo.write(texto + "\n")
+    else:
+        print(texto)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,126 @@
+import argparse
+import json
+import os
+import platform
+import re
+import statistics
+import sys
+import time
+
+import torch
+import whisper
+
+# Banco de pruebas de los perfiles de decodificación (ver perfiles.py) sin el servicio: transcribe cada audio con
+# cada perfil y escribe en JSON la mediana de los segundos y del factor de tiempo real y la tasa de error de palabras
+# (WER). Si junto a un audio hay un .txt con su transcripción de referencia (grabacion.wav y grabacion.txt), el WER se
+# calcula contra ella; si no, contra la transcripción del perfil preciso, que mide cuánto se aparta cada perfil del
+# más lento. Sin --audios usa los audios sintéticos de benchmark.py, que sirven para la latencia pero no tienen
+# palabras de verdad. Necesita el entorno de uno de los servicios, de donde toma transcripcion.py y perfiles.py:
+#   python benchmark-proyecto-tfg/benchmark_perfiles.py --modelo tiny --audios grabaciones/*.wav
+
+DIRECTORIO = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(DIRECTORIO), "whisperFlask-proyecto-tfg"))
+
+from perfiles import PERFILES, opciones_perfil  # noqa: E402
+from transcripcion import transcribir_archivo  # noqa: E402
+from benchmark import audio_sintetico  # noqa: E402
+
+
+# Palabras de un texto, en minúsculas y sin signos de puntuación
+def palabras(texto):
+    return re.findall(r"\w+", texto.lower())
+
+
+# Tasa de error de palabras: sustituciones, inserciones y borrados para pasar de la referencia a la hipótesis (la
+# distancia de edición por palabras) entre las palabras de la referencia
+def tasa_error_palabras(referencia, hipotesis):
+    referencia, hipotesis = palabras(referencia), palabras(hipotesis)
+    if not referencia:
+        return float(len(hipotesis) > 0)
+    anterior = list(range(len(hipotesis) + 1))
+    for i, palabra_referencia in enumerate(referencia, 1):
+        actual = [i]
+        for j, palabra_hipotesis in enumerate(hipotesis, 1):
+            actual.append(min(anterior[j] + 1, actual[j - 1] + 1,
+                              anterior[j - 1] + (palabra_referencia != palabra_hipotesis)))
+        anterior = actual
+    return anterior[-1] / len(referencia)
+
+
+# Referencia de un audio: el texto del .txt con su mismo nombre, o None si no lo hay
+def referencia(ruta):
+    ruta_texto = os.path.splitext(ruta)[0] + ".txt"
+    if not os.path.exists(ruta_texto):
+        return None
+    with open(ruta_texto) as archivo:
+        return archivo.read()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Latencia y precisión de los perfiles de decodificación")
+    parser.add_argument("--modelo", default="tiny", help="tamaño del modelo (por defecto, tiny)")
+    parser.add_argument("--audios", nargs="+", help="audios a transcribir (por defecto, los sintéticos)")
+    parser.add_argument("--duraciones", nargs="+", type=float, default=[5, 30],
+                        help="duraciones de los audios sintéticos, en segundos")
+    parser.add_argument("--perfiles", nargs="+", default=list(PERFILES), choices=list(PERFILES),
+                        help="perfiles a comparar (por defecto, todos)")
+    parser.add_argument("--idioma", help="idioma de los audios, que fijan todos los perfiles (por defecto, el de "
+                                         "cada perfil)")
+    parser.add_argument("--repeticiones", type=int, default=3, help="transcripciones medidas de cada audio")
+    parser.add_argument("--dispositivo", default="cuda" if torch.cuda.is_available() else "cpu",
+                        help="dispositivo de torch")
+    parser.add_argument("--salida", help="archivo JSON de resultados (por defecto, la salida estándar)")
+    args = parser.parse_args()
+
+    modelo = whisper.load_model(args.modelo, device=args.dispositivo)
+    audios = args.audios or [audio_sintetico(duracion) for duracion in args.duraciones]
+
+    resultados = []
+    for ruta in audios:
+        textos = {}
+        for perfil in args.perfiles:
+            opciones = opciones_perfil(perfil, args.idioma)
+            # Una transcripción sin medir, para que la primera no pague la preparación del modelo
+            resultado = transcribir_archivo(modelo, ruta, **opciones)
+            segundos = []
+            for _ in range(args.repeticiones):
+                inicio = time.perf_counter()
+                resultado = transcribir_archivo(modelo, ruta, **opciones)
+                segundos.append(time.perf_counter() - inicio)
+            textos[perfil] = resultado["texto"]
+            mediana = statistics.median(segundos)
+            resultados.append({"audio": ruta, "perfil": perfil, "idioma": resultado["idioma"], "segundos": mediana,
+                               "rtf": mediana / resultado["duracion_audio"], "texto": resultado["texto"]})
+
+        # Con referencia, el WER es el error de cada perfil; sin ella, cuánto se aparta del preciso
+        texto_referencia = referencia(ruta)
+        if texto_referencia is None:
+            texto_referencia = textos.get("preciso")
+            campo = "diferencia_preciso"
+        else:
+            campo = "wer"
+        for medida in resultados[-len(args.perfiles):]:
+            if texto_referencia is not None:
+                medida[campo] = tasa_error_palabras(texto_referencia, medida["texto"])
+            print(f"{os.path.basename(ruta)} {medida['perfil']}: rtf {medida['rtf']:.3f}"
+                  + (f", {campo} {medida[campo]:.3f}" if campo in medida else ""), file=sys.stderr)
+
+    informe = {
+        "maquina": {"plataforma": platform.platform(), "procesador": platform.processor(), "nucleos": os.cpu_count(),
+                    "torch": torch.__version__, "hilos_torch": torch.get_num_threads(),
+                    "dispositivo": args.dispositivo},
+        "modelo": args.modelo,
+        "perfiles": {perfil: PERFILES[perfil] for perfil in args.perfiles},
+        "repeticiones": args.repeticiones,
+        "resultados": resultados,
+    }
+    texto = json.dumps(informe, indent=2, ensure_ascii=False)
+    if args.salida:
+        with open(args.salida, "w") as archivo:
+            archivo.write(texto + "\n")
+    else:
+        print(texto)
+
+
+if __name__ == "__main__":
+    main()
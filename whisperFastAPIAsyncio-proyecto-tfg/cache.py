@@ -0,0 +1,139 @@
+import hashlib
+import json
+import os
+import time
+
+# Configuración de la caché de resultados. Con CACHE_URL = redis://... se guarda en Redis y se comparte entre
+# procesos y workers; si no, se guarda en disco en CACHE_DIR
+CACHE_URL = os.environ.get("CACHE_URL", "")
+CACHE_DIR = os.environ.get("CACHE_DIR", "./cache")
+# Segundos que se conserva cada resultado desde su último uso y número máximo de resultados en disco
+CACHE_TTL = int(os.environ.get("CACHE_TTL", str(7 * 24 * 3600)))
+CACHE_MAX_ENTRADAS = int(os.environ.get("CACHE_MAX_ENTRADAS", "1000"))
+
+
+# Huella SHA-256 del contenido de un archivo, leída por trozos para no cargarlo entero en memoria
+def huella_archivo(localizacion_archivo):
+    huella = hashlib.sha256()
+    with open(localizacion_archivo, "rb") as archivo:
+        for trozo in iter(lambda: archivo.read(1024 * 1024), b""):
+            huella.update(trozo)
+    return huella.hexdigest()
+
+
+# Parte común de las dos cachés: construir las claves a partir del contenido, el modelo y las opciones, y contar
+# aciertos y fallos
+class CacheBase:
+
+    def __init__(self, modelo):
+        self.modelo = modelo
+
+    # El modelo es el de la caché, salvo que la petición haya elegido otro
+    def _clave(self, origen, opciones, modelo=None):
+        opciones = json.dumps(opciones or {}, sort_keys=True)
+        return hashlib.sha256(f"{origen}|{modelo or self.modelo}|{opciones}".encode()).hexdigest()
+
+    # Clave de un archivo: su contenido, el modelo y las opciones de decodificación
+    def clave_archivo(self, localizacion_archivo, opciones=None, modelo=None):
+        return self._clave(huella_archivo(localizacion_archivo), opciones, modelo)
+
+    # Clave de un vídeo: su URL, el modelo y las opciones, para no tener que descargarlo otra vez
+    def clave_url(self, url, opciones=None, modelo=None):
+        return self._clave(url.strip(), opciones, modelo)
+
+    def metricas(self):
+        aciertos, fallos = self._contadores()
+        total = aciertos + fallos
+        return {"aciertos": aciertos, "fallos": fallos, "tasa_aciertos": aciertos / total if total else 0.0}
+
+
+# Caché en disco: un archivo JSON por resultado. La fecha de modificación se renueva en cada acierto, de modo que
+# sirve tanto para caducar los resultados como para expulsar los menos usados recientemente
+class CacheDisco(CacheBase):
+
+    def __init__(self, modelo, directorio=CACHE_DIR, ttl=CACHE_TTL, max_entradas=CACHE_MAX_ENTRADAS):
+        super().__init__(modelo)
+        self.directorio = directorio
+        self.ttl = ttl
+        self.max_entradas = max_entradas
+        self.aciertos = 0
+        self.fallos = 0
+        os.makedirs(directorio, exist_ok=True)
+
+    def _ruta(self, clave):
+        return os.path.join(self.directorio, f"{clave}.json")
+
+    def obtener(self, clave):
+        ruta = self._ruta(clave)
+        try:
+            if time.time() - os.path.getmtime(ruta) > self.ttl:
+                os.remove(ruta)
+                raise FileNotFoundError(ruta)
+            with open(ruta, encoding="utf-8") as archivo:
+                resultado = json.load(archivo)
+            os.utime(ruta)
+        except (FileNotFoundError, ValueError):
+            self.fallos += 1
+            return None
+        self.aciertos += 1
+        return resultado
+
+    def guardar(self, clave, resultado):
+        # Escribir primero en un temporal para que nadie lea un resultado a medias
+        ruta = self._ruta(clave)
+        temporal = f"{ruta}.{os.getpid()}.tmp"
+        with open(temporal, "w", encoding="utf-8") as archivo:
+            json.dump(resultado, archivo)
+        os.replace(temporal, ruta)
+        self._expulsar()
+
+    # Expulsar los resultados usados hace más tiempo hasta quedarse en max_entradas
+    def _expulsar(self):
+        entradas = [entrada for entrada in os.scandir(self.directorio) if entrada.name.endswith(".json")]
+        if len(entradas) <= self.max_entradas:
+            return
+        entradas.sort(key=lambda entrada: entrada.stat().st_mtime)
+        for entrada in entradas[:len(entradas) - self.max_entradas]:
+            try:
+                os.remove(entrada.path)
+            except FileNotFoundError:
+                pass
+
+    def _contadores(self):
+        return self.aciertos, self.fallos
+
+
+# Caché en Redis, compartida entre todos los workers. Cada acierto renueva la caducidad del resultado; para acotar la
+# memoria, Redis debe expulsar las claves con caducidad menos usadas (maxmemory-policy volatile-lru)
+class CacheRedis(CacheBase):
+
+    PREFIJO = "cache:resultado:"
+
+    def __init__(self, modelo, url, ttl=CACHE_TTL):
+        import redis
+
+        super().__init__(modelo)
+        self.conexion = redis.Redis.from_url(url)
+        self.ttl = ttl
+
+    def obtener(self, clave):
+        with self.conexion.pipeline() as pipe:
+            pipe.get(self.PREFIJO + clave)
+            pipe.expire(self.PREFIJO + clave, self.ttl)
+            valor, _ = pipe.execute()
+        self.conexion.incr("cache:aciertos" if valor is not None else "cache:fallos")
+        return json.loads(valor) if valor is not None else None
+
+    def guardar(self, clave, resultado):
+        self.conexion.set(self.PREFIJO + clave, json.dumps(resultado), ex=self.ttl)
+
+    def _contadores(self):
+        aciertos, fallos = self.conexion.mget("cache:aciertos", "cache:fallos")
+        return int(aciertos or 0), int(fallos or 0)
+
+
+# Crear la caché configurada para el modelo indicado
+def crear_cache(modelo, url=CACHE_URL):
+    if url.startswith("redis://"):
+        return CacheRedis(modelo, url)
+    return CacheDisco(modelo)
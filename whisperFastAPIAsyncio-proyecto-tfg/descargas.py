@@ -0,0 +1,95 @@
+import os
+import shutil
+import threading
+import uuid
+
+import yt_dlp
+
+from subidas import DIRECTORIO_SUBIDAS
+
+# Descarga del audio de los vídeos con yt-dlp. Una sola llamada obtiene los metadatos (el título) y descarga la mejor
+# pista de audio tal cual, sin pasarla a MP3: ffmpeg la decodifica directamente a PCM mono de 16 kHz al transcribirla,
+# así que se evita una compresión con pérdidas y una decodificación de más. Cada descarga se guarda con un nombre
+# único en el directorio de subidas, de modo que las peticiones simultáneas no se pisan el archivo.
+# Vale cualquier URL que entienda yt-dlp, también la de un archivo de audio servido por HTTP
+
+# Opciones de yt-dlp: solo el audio, sin listas de reproducción y sin escribir el progreso en la salida
+OPCIONES_YT_DLP = {
+    "format": "bestaudio/best",
+    "noplaylist": True,
+    "quiet": True,
+    "noprogress": True,
+}
+
+# Descargas en curso en este proceso, por URL. Quien pide una URL que ya se está descargando espera a esa descarga
+# en lugar de empezar otra
+_en_curso = {}
+_cerrojo = threading.Lock()
+
+
+# Descarga en curso: cuántas peticiones más la esperan y, al terminar, el título, la copia del archivo para cada una
+# de ellas o el error
+class _Descarga:
+    def __init__(self):
+        self.terminada = threading.Event()
+        self.esperando = 0
+        self.copias = []
+        self.titulo = None
+        self.error = None
+
+
+# Descargar el audio con una única llamada a yt-dlp y devolver su localización y el título del vídeo
+def _descargar(url):
+    plantilla = os.path.join(DIRECTORIO_SUBIDAS, f"video-{uuid.uuid4().hex}.%(ext)s")
+    with yt_dlp.YoutubeDL({**OPCIONES_YT_DLP, "outtmpl": plantilla}) as ydl:
+        info = ydl.extract_info(url, download=True)
+        return ydl.prepare_filename(info), info.get("title", None)
+
+
+# Copia del archivo descargado con otro nombre, para quien esperaba la misma descarga. Quien transcribe un archivo lo
+# borra al terminar, así que cada petición necesita el suyo; un enlace duro no ocupa más disco
+def _copiar(localizacion_archivo, numero):
+    raiz, extension = os.path.splitext(localizacion_archivo)
+    copia = f"{raiz}-{numero}{extension}"
+    try:
+        os.link(localizacion_archivo, copia)
+    except OSError:
+        shutil.copyfile(localizacion_archivo, copia)
+    return copia
+
+
+# Descargar el audio de un vídeo y devolver la localización del archivo, que pasa a ser de quien lo pide (y lo borra
+# al terminar), el título del vídeo y el formato del audio. Si la misma URL ya se está descargando en este proceso se
+# espera a esa descarga
+def descargar_audio(url):
+    with _cerrojo:
+        descarga = _en_curso.get(url)
+        if descarga is None:
+            descarga = _en_curso[url] = _Descarga()
+            primera = True
+        else:
+            descarga.esperando += 1
+            primera = False
+
+    if not primera:
+        descarga.terminada.wait()
+        if descarga.error is not None:
+            raise descarga.error
+        with _cerrojo:
+            localizacion_archivo = descarga.copias.pop()
+    else:
+        try:
+            localizacion_archivo, descarga.titulo = _descargar(url)
+            # Las copias se hacen antes de soltar el archivo, y quien llegue después ya empieza otra descarga
+            with _cerrojo:
+                del _en_curso[url]
+                descarga.copias = [_copiar(localizacion_archivo, numero) for numero in range(descarga.esperando)]
+        except Exception as e:
+            with _cerrojo:
+                _en_curso.pop(url, None)
+            descarga.error = e
+            raise
+        finally:
+            descarga.terminada.set()
+
+    return localizacion_archivo, descarga.titulo, os.path.splitext(localizacion_archivo)[1].lstrip(".")
@@ -0,0 +1,152 @@
+import asyncio
+import functools
+import itertools
+import math
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from metricas import observar
+
+# Clases de prioridad de los trabajos: cuanto menor el valor, antes se atienden
+PRIORIDAD_CORTA = 0  # grabaciones del micrófono y archivos pequeños
+PRIORIDAD_LARGA = 1  # archivos grandes y vídeos
+NOMBRES_PRIORIDADES = {PRIORIDAD_CORTA: "corta", PRIORIDAD_LARGA: "larga"}
+
+
+# Excepción que se lanza cuando la cola de inferencia está llena. Lleva los segundos recomendados para reintentar
+class ColaLlena(Exception):
+    def __init__(self, reintentar_en):
+        super().__init__(f"Cola de inferencia llena, reintente en {reintentar_en} segundos")
+        self.reintentar_en = reintentar_en
+
+
+# Trabajo pendiente: la función a ejecutar, el futuro en el que se entrega su resultado y el instante de encolado
+class Trabajo:
+    def __init__(self, funcion, args, kwargs, prioridad, futuro):
+        self.funcion = funcion
+        self.args = args
+        self.kwargs = kwargs
+        self.prioridad = prioridad
+        self.futuro = futuro
+        self.encolado = time.perf_counter()
+        self.en_cola = True
+
+
+# Cola de trabajos de inferencia. Los trabajos se encolan por prioridad y cada uno recibe su propio futuro, así que
+# los resultados nunca se mezclan entre peticiones. Hay tantos trabajadores como trabajos caben en el planificador de
+# réplicas, y cada uno ejecuta la inferencia en un hilo aparte para no bloquear el bucle de eventos, en la réplica que
+# el planificador le asigna al empezar el trabajo (la que menos trabajos tiene en curso)
+class EjecutorInferencia:
+
+    def __init__(self, planificador, max_pendientes):
+        self.planificador = planificador
+        self.numero_trabajadores = planificador.capacidad()
+        self.pool = ThreadPoolExecutor(max_workers=self.numero_trabajadores, thread_name_prefix="inferencia")
+        self.max_pendientes = max_pendientes
+        self.cola = None
+        self.trabajadores = []
+        self.secuencia = itertools.count()
+        # Métricas. Solo se modifican desde el bucle de eventos, así que no necesitan cerrojo
+        self.en_ejecucion = 0
+        self.en_cola = {prioridad: 0 for prioridad in NOMBRES_PRIORIDADES}
+        self.atendidos = {prioridad: 0 for prioridad in NOMBRES_PRIORIDADES}
+        self.completados = {prioridad: 0 for prioridad in NOMBRES_PRIORIDADES}
+        self.espera_total = {prioridad: 0.0 for prioridad in NOMBRES_PRIORIDADES}
+        self.espera_maxima = {prioridad: 0.0 for prioridad in NOMBRES_PRIORIDADES}
+        # Media móvil de la duración de los trabajos, para estimar el Retry-After
+        self.duracion_media = 30.0
+
+    # Arrancar los trabajadores. Se llama al iniciar la aplicación, con el bucle de eventos ya en marcha
+    def iniciar(self):
+        self.cola = asyncio.PriorityQueue()
+        self.trabajadores = [asyncio.create_task(self._trabajador()) for _ in range(self.numero_trabajadores)]
+
+    async def detener(self):
+        for trabajador in self.trabajadores:
+            trabajador.cancel()
+        await asyncio.gather(*self.trabajadores, return_exceptions=True)
+        self.pool.shutdown(wait=False)
+
+    # Ejecutar un trabajo en una réplica del planificador, mientras la tiene reservada
+    def _ejecutar_en_replica(self, trabajo):
+        with self.planificador.reservar() as modelo:
+            return trabajo.funcion(modelo, *trabajo.args, **trabajo.kwargs)
+
+    # Descontar un trabajo de los que esperan en la cola de su prioridad, una sola vez: al sacarlo de la cola o al
+    # cancelarse mientras espera, lo que ocurra antes
+    def _salir_de_cola(self, trabajo):
+        if trabajo.en_cola:
+            trabajo.en_cola = False
+            self.en_cola[trabajo.prioridad] -= 1
+
+    async def _trabajador(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            _, _, trabajo = await self.cola.get()
+            self._salir_de_cola(trabajo)
+            if trabajo.futuro.cancelled():
+                continue
+
+            espera = time.perf_counter() - trabajo.encolado
+            self.atendidos[trabajo.prioridad] += 1
+            self.espera_total[trabajo.prioridad] += espera
+            self.espera_maxima[trabajo.prioridad] = max(self.espera_maxima[trabajo.prioridad], espera)
+            observar("whisper_etapa_segundos", espera, etapa="espera_cola")
+
+            self.en_ejecucion += 1
+            inicio = time.perf_counter()
+            try:
+                resultado = await loop.run_in_executor(self.pool, functools.partial(self._ejecutar_en_replica, trabajo))
+            except Exception as e:
+                if not trabajo.futuro.cancelled():
+                    trabajo.futuro.set_exception(e)
+            else:
+                if not trabajo.futuro.cancelled():
+                    trabajo.futuro.set_result(resultado)
+            finally:
+                self.en_ejecucion -= 1
+                self.completados[trabajo.prioridad] += 1
+                self.duracion_media = 0.8 * self.duracion_media + 0.2 * (time.perf_counter() - inicio)
+
+    # Trabajos admitidos: en cola o en ejecución
+    def pendientes(self):
+        return self.cola.qsize() + self.en_ejecucion
+
+    # Segundos estimados hasta que quede un hueco libre en la cola
+    def tiempo_reintento(self):
+        return max(1, math.ceil(self.duracion_media * self.pendientes() / self.numero_trabajadores))
+
+    # Encolar funcion(modelo, *args, **kwargs) con la prioridad indicada y devolver el futuro de su resultado.
+    # Si ya hay demasiados trabajos admitidos se rechaza inmediatamente con ColaLlena
+    def encolar(self, funcion, *args, prioridad=PRIORIDAD_LARGA, **kwargs):
+        if self.pendientes() >= self.max_pendientes:
+            raise ColaLlena(self.tiempo_reintento())
+
+        futuro = asyncio.get_running_loop().create_future()
+        trabajo = Trabajo(funcion, args, kwargs, prioridad, futuro)
+        self.cola.put_nowait((prioridad, next(self.secuencia), trabajo))
+        self.en_cola[prioridad] += 1
+        # Si la petición se cancela mientras el trabajo espera, deja de contar en la cola
+        futuro.add_done_callback(lambda _: self._salir_de_cola(trabajo))
+        return futuro
+
+    # Encolar el trabajo y esperar su resultado
+    async def ejecutar(self, funcion, *args, prioridad=PRIORIDAD_LARGA, **kwargs):
+        return await self.encolar(funcion, *args, prioridad=prioridad, **kwargs)
+
+    # Profundidad de la cola, trabajos en ejecución y tiempos de espera por clase de prioridad
+    def metricas(self):
+        return {
+            "trabajadores": len(self.trabajadores),
+            "en_ejecucion": self.en_ejecucion,
+            "prioridades": {
+                nombre: {
+                    "en_cola": self.en_cola[prioridad],
+                    "completados": self.completados[prioridad],
+                    "espera_media": self.espera_total[prioridad] / self.atendidos[prioridad]
+                    if self.atendidos[prioridad] else 0.0,
+                    "espera_maxima": self.espera_maxima[prioridad],
+                }
+                for prioridad, nombre in NOMBRES_PRIORIDADES.items()
+            },
+        }
@@ -1,32 +1,74 @@
 import asyncio
+import json
 import os
-import yt_dlp
+import re
 import time
 from fastapi import FastAPI, Form, Request, UploadFile, File
-from fastapi.responses import HTMLResponse
+from fastapi.responses import HTMLResponse, PlainTextResponse, Response, StreamingResponse
 import uvicorn
-import whisper
-import torch
 from fastapi.templating import Jinja2Templates
-from whisper.tokenizer import LANGUAGES
-from deep_translator import GoogleTranslator
+from idiomas import nombre_idioma
+from transcripcion import (RepartidorFragmentos, eventos_resultado, factor_tiempo_real, resultado_transcripcion,
+                           segmento_publico, transcribir_archivo, transcribir_en_streaming)
+import registro
+from planificador import crear_planificador
+from cache import crear_cache
+from backends import MODELOS_DISPONIBLES, TAMANO_MODELO, ModeloNoDisponible, nombre_modelo, tamano_solicitado
+from subidas import ArchivoDemasiadoGrande, TAMANO_MAXIMO_PETICION, guardar_subida
+from descargas import descargar_audio
+from subtitulos import FORMATOS, exportar
+from perfiles import (PERFIL_GRABACIONES, PERFILES, PERFIL_POR_DEFECTO, PerfilNoDisponible, idioma_fijado,
+                      opciones_transcripcion)
+from metricas import TIPO_CONTENIDO, exponer, medidores_replicas, observar, registrar_transcripcion
+from ejecutor import ColaLlena, EjecutorInferencia, PRIORIDAD_CORTA, PRIORIDAD_LARGA
 
 app = FastAPI()
 templates = Jinja2Templates(directory="templates")
-cola = asyncio.Queue()
 
-# Comprobar si hay disponible una GPU NVIDIA
-torch.cuda.is_available()
-device = "cuda" if torch.cuda.is_available() else "cpu"
+# Modelo Whisper con el backend y el tamaño de la configuración (por defecto, PyTorch y el modelo de tamaño medio,
+# lento, pero preciso en idiomas diferentes al inglés). El planificador tiene una réplica por GPU si CUDA está
+# disponible y, si no, las réplicas de CPU indicadas en REPLICAS_CPU, cada una fijada a su bloque de núcleos, y manda
+# cada trabajo a la que tiene menos en curso. Cada réplica se usa a través de un agrupador de lotes, que junta las
+# ventanas de los trabajos concurrentes en una sola pasada del modelo. El registro las carga en segundo plano al
+# arrancar, de modo que el servidor atiende desde el primer momento; los trabajos que lleguen antes esperan a la carga.
+# Cada petición puede elegir otro de los tamaños disponibles, que el registro carga en la réplica que atienda el
+# trabajo al pedirlo por primera vez
+planificador = crear_planificador()
 
-# Cargar el modelo Whisper. Inicializar el modelo de tamaño medio, lento, pero preciso en idiomas diferentes al inglés,
-# moviéndolo a GPU si CUDA está disponible
-model = whisper.load_model("medium").to(device)
+# Ejecutor de inferencia con admisión limitada: como máximo MAX_PENDIENTES trabajos en cola o en ejecución. Tiene
+# tantos trabajadores como ventanas caben en los lotes de todas las réplicas, para que haya con qué llenarlos
+ejecutor = EjecutorInferencia(planificador, int(os.environ.get("MAX_PENDIENTES", "8")))
+
+# Los audios largos se dividen por los silencios y sus fragmentos se transcriben en paralelo en todas las réplicas. El
+# trabajo del audio largo ocupa un puesto del ejecutor y reparte sus fragmentos directamente entre las réplicas
+repartidor = RepartidorFragmentos(planificador)
+
+# Caché de resultados por contenido del audio, modelo y opciones. Se consulta antes de encolar, de modo que los
+# archivos y vídeos repetidos se responden sin ocupar la cola de inferencia
+cache = crear_cache(nombre_modelo())
+
+# Los archivos subidos de hasta este tamaño (en bytes) se atienden con la prioridad de las grabaciones
+TAMANO_ARCHIVO_CORTO = int(os.environ.get("TAMANO_ARCHIVO_CORTO", str(1024 * 1024)))
+
+
+# Arrancar y parar los trabajadores del ejecutor junto con la aplicación
+@app.on_event("startup")
+async def startup_event():
+    planificador.cargar_en_segundo_plano()
+    ejecutor.iniciar()
+
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    await ejecutor.detener()
 
 
 @app.get("/", response_class=HTMLResponse)
 async def home(request: Request):
-    return templates.TemplateResponse("index.html", context={"request": request})
+    return templates.TemplateResponse("index.html", context={"request": request, "modelos": MODELOS_DISPONIBLES,
+                                                             "modeloPorDefecto": TAMANO_MODELO, "perfiles": PERFILES,
+                                                             "perfilPorDefecto": PERFIL_POR_DEFECTO,
+                                                             "perfilGrabaciones": PERFIL_GRABACIONES})
 
 
 #  Ignorar la solicitud de favicon.ico en la aplicación FastAPI agregando una ruta para manejarla específicamente
@@ -36,137 +78,334 @@ async def favicon():
     return ""
 
 
-# Definir la función que procesará las solicitudes
-async def procesar_archivo(localizacion_archivo, cola: asyncio.Queue):
+# Si la cola de inferencia está llena se responde 503 indicando cuándo reintentar
+@app.exception_handler(ColaLlena)
+async def cola_llena(request: Request, exc: ColaLlena):
+    return PlainTextResponse(str(exc), status_code=503, headers={"Retry-After": str(exc.reintentar_en)})
+
+
+# Los archivos que superan el tamaño máximo se rechazan con 413
+@app.exception_handler(ArchivoDemasiadoGrande)
+async def archivo_demasiado_grande(request: Request, exc: ArchivoDemasiadoGrande):
+    return PlainTextResponse(str(exc), status_code=413)
+
+
+# Rechazar con 413 las peticiones que declaran un cuerpo mayor que el permitido, antes de leerlo, y con 400 las que
+# declaran un tamaño que no es un entero no negativo. Las que no lo declaran se cortan al copiar el archivo subido
+@app.middleware("http")
+async def limitar_tamano_peticion(request: Request, call_next):
+    try:
+        tamano = int(request.headers.get("content-length", 0))
+    except ValueError:
+        tamano = -1
+    if tamano < 0:
+        return PlainTextResponse("Cabecera Content-Length no válida", status_code=400)
+    if tamano > TAMANO_MAXIMO_PETICION:
+        return PlainTextResponse("Archivo demasiado grande", status_code=413)
+    return await call_next(request)
+
+
+# Los modelos que no están entre los disponibles se rechazan con 400
+@app.exception_handler(ModeloNoDisponible)
+async def modelo_no_disponible(request: Request, exc: ModeloNoDisponible):
+    return PlainTextResponse(str(exc), status_code=400)
+
 
-    # Cargar audio y rellenarlo/recortarlo para que se ajuste a trozos de 30 segundos
-    audio = whisper.load_audio(localizacion_archivo)  # str, bytes or os.PathLike
-    audio = whisper.pad_or_trim(audio)
-    # Hacer un espectrograma log-Mel y pasar al mismo dispositivo que el modelo
-    mel = whisper.log_mel_spectrogram(audio).to(model.device)
+# Igual con los perfiles de decodificación y los idiomas que no existen
+@app.exception_handler(PerfilNoDisponible)
+async def perfil_no_disponible(request: Request, exc: PerfilNoDisponible):
+    return PlainTextResponse(str(exc), status_code=400)
 
-    # Detectar el idioma hablado
-    _, probs = model.detect_language(mel)
-    traductor = GoogleTranslator(source='auto', target='es')
-    idioma_detectado = traductor.translate(LANGUAGES[max(probs, key=probs.get)].title())
 
-    # Decodificamos el audio
-    # options = whisper.DecodingOptions(fp16 = False)
-    # transcripcion = whisper.decode(model, mel, options)
-    transcripcion = model.transcribe(localizacion_archivo)
+# Estado de la cola de inferencia: profundidad, trabajos en ejecución y tiempos de espera por prioridad
+@app.get("/estado_cola")
+async def estado_cola():
+    return ejecutor.metricas()
 
-    # Agregar los elementos a la cola asíncrona
-    await cola.put(idioma_detectado)
-    await cola.put(transcripcion)
 
-    # Eliminar el archivo del disco
-    os.remove(localizacion_archivo)
+# Aciertos y fallos de la caché de resultados
+@app.get("/estado_cache")
+async def estado_cache():
+    return await asyncio.to_thread(cache.metricas)
 
-    # Devolvemos la transcripción y el idioma
-    return idioma_detectado, transcripcion['text']
+
+# Descargar los segmentos de un resultado de la caché como subtítulos (srt, vtt) o en JSON, con las marcas de tiempo
+# de cada palabra si se pidieron. Se generan a partir de los segmentos guardados, sin volver a pasar por el modelo
+@app.get("/descargas/{clave}.{formato}")
+async def descargar_subtitulos(clave: str, formato: str):
+    # Las claves de la caché son huellas SHA-256; cualquier otra cosa no se busca
+    if formato not in FORMATOS or not re.fullmatch(r"[0-9a-f]{64}", clave):
+        return PlainTextResponse("Descarga no disponible", status_code=404)
+    resultado = await asyncio.to_thread(cache.obtener, clave)
+    if resultado is None or "segmentos" not in resultado:
+        return PlainTextResponse("La transcripción ya no está disponible", status_code=404)
+
+    texto, tipo = exportar([segmento_publico(segmento) for segmento in resultado["segmentos"]], formato)
+    return Response(texto, media_type=tipo, headers={"Content-Disposition": "attachment"})
+
+
+# Modelos cargados, memoria que ocupan y últimas cargas y expulsiones
+@app.get("/estado_modelos")
+async def estado_modelos():
+    return registro.estado()
+
+
+# Réplicas del modelo: dispositivo, núcleos, trabajos en curso y ocupación de cada una
+@app.get("/estado_replicas")
+async def estado_replicas():
+    return planificador.estado()
+
+
+# Métricas del servicio en el formato de Prometheus: las de las etapas se van guardando y la profundidad de la cola,
+# los trabajos en ejecución y los de cada réplica se leen del ejecutor y del planificador en el momento
+@app.get("/metrics")
+async def metrics():
+    en_cola = sum(prioridad["en_cola"] for prioridad in ejecutor.metricas()["prioridades"].values())
+    return PlainTextResponse(exponer({"whisper_cola_pendientes": en_cola,
+                                      "whisper_trabajos_en_curso": ejecutor.en_ejecucion,
+                                      **medidores_replicas(planificador.estado()["replicas"])}),
+                             media_type=TIPO_CONTENIDO)
+
+
+# Buscar en la caché el resultado de un archivo con el modelo y las opciones indicados. Devuelve la clave y el
+# resultado, o None si no está
+async def consultar_cache(localizacion_archivo, tamano=None, opciones=None):
+    inicio = time.perf_counter()
+    clave = await asyncio.to_thread(cache.clave_archivo, localizacion_archivo, opciones, nombre_modelo(tamano))
+    resultado = await asyncio.to_thread(cache.obtener, clave)
+    if resultado is not None:
+        resultado["tiempos"] = {"consulta_cache": time.perf_counter() - inicio}
+        resultado["rtf"] = factor_tiempo_real(resultado["tiempos"]["consulta_cache"], resultado["duracion_audio"])
+        registrar_transcripcion(resultado)
+    return clave, resultado
+
+
+# Definir la función que procesará las solicitudes
+async def procesar_archivo(localizacion_archivo, prioridad=PRIORIDAD_LARGA, tamano=None, opciones=None):
+    opciones = opciones or {}
+
+    # Decodificar el audio una sola vez y reutilizarlo, junto con su espectrograma log-Mel y el idioma detectado,
+    # en toda la transcripción. El trabajo se encola en el ejecutor con su prioridad y se espera su propio resultado,
+    # salvo que ya esté en la caché
+    try:
+        clave, resultado = await consultar_cache(localizacion_archivo, tamano, opciones)
+        if resultado is None:
+            resultado = await ejecutor.ejecutar(transcribir_archivo, localizacion_archivo, repartir=repartidor,
+                                                tamano=tamano, prioridad=prioridad, **opciones)
+            await asyncio.to_thread(cache.guardar, clave, resultado)
+    finally:
+        # Eliminar el archivo del disco
+        os.remove(localizacion_archivo)
+
+    # Obtener el nombre del idioma detectado a partir de la tabla local, sin llamadas a red
+    idioma_detectado = nombre_idioma(resultado["idioma"])
+
+    # Devolvemos el idioma y la transcripción, con los enlaces para descargar sus segmentos, que ya están en la caché,
+    # como subtítulos o en JSON
+    resultado["descargas"] = enlaces_descarga(clave)
+    return idioma_detectado, resultado
+
+
+# Enlaces de descarga de todos los formatos de un resultado de la caché (ver descargar_subtitulos)
+def enlaces_descarga(clave):
+    return {formato: f"/descargas/{clave}.{formato}" for formato in FORMATOS}
+
+
+# Definir la función que procesará las solicitudes en streaming. La transcripción se encola en el ejecutor como
+# cualquier otra y, desde su hilo, deja cada evento (el idioma, cada segmento con sus marcas de tiempo en cuanto se
+# decodifica y el fin con los tiempos de cada etapa, incluido el tiempo hasta el primer segmento) en una cola asíncrona
+# propia de la petición, de la que se generan las líneas JSON de la respuesta. Si el resultado ya está en la caché, los
+# eventos salen directamente de él
+async def procesar_archivo_streaming(localizacion_archivo, prioridad=PRIORIDAD_LARGA, tamano=None, opciones=None):
+    loop = asyncio.get_running_loop()
+    eventos = asyncio.Queue()
+    opciones = opciones or {}
+
+    try:
+        clave, resultado = await consultar_cache(localizacion_archivo, tamano, opciones)
+    except Exception:
+        os.remove(localizacion_archivo)
+        raise
+    if resultado is not None:
+        os.remove(localizacion_archivo)
+        for evento in eventos_resultado(resultado, resultado["tiempos"]):
+            eventos.put_nowait(evento)
+        eventos.put_nowait(None)
+        return lineas_eventos(eventos)
+
+    def transcribir_y_emitir(model, localizacion_archivo):
+        segmentos = []
+        try:
+            for evento in transcribir_en_streaming(model, localizacion_archivo, repartir=repartidor,
+                                                   tamano=tamano, **opciones):
+                if evento["tipo"] == "segmento":
+                    segmentos.append(evento["segmento"])
+                elif evento["tipo"] == "fin":
+                    cache.guardar(clave, resultado_transcripcion(segmentos, evento))
+                loop.call_soon_threadsafe(eventos.put_nowait, evento)
+        except Exception as e:
+            loop.call_soon_threadsafe(eventos.put_nowait, {"tipo": "error", "mensaje": str(e)})
+        finally:
+            # Eliminar el archivo del disco y marcar el final de los eventos
+            os.remove(localizacion_archivo)
+            loop.call_soon_threadsafe(eventos.put_nowait, None)
+
+    # Si la cola de inferencia está llena, ColaLlena se lanza aquí, antes de empezar a responder
+    try:
+        ejecutor.encolar(transcribir_y_emitir, localizacion_archivo, prioridad=prioridad)
+    except ColaLlena:
+        os.remove(localizacion_archivo)
+        raise
+
+    return lineas_eventos(eventos)
+
+
+# Generar las líneas JSON de la respuesta en streaming a partir de la cola de eventos, hasta encontrar None
+async def lineas_eventos(eventos):
+    while True:
+        evento = await eventos.get()
+        if evento is None:
+            return
+        if evento["tipo"] == "idioma":
+            evento["nombre"] = nombre_idioma(evento["idioma"])
+        elif evento["tipo"] == "segmento":
+            evento["segmento"] = segmento_publico(evento["segmento"])
+        yield json.dumps(evento) + "\n"
 
 
 @app.post('/transcripcion_grabacion', response_class=HTMLResponse)
-async def transcripcion_grabacion(request: Request, audiograbado: UploadFile = File(...)):
-    # Guardo el archivo en una ubicación (la raiz del directorio actual) temporal
-    localizacion_archivo = f"./{audiograbado.filename}"
+async def transcripcion_grabacion(request: Request, audiograbado: UploadFile = File(...), modelo: str = Form(""),
+                                  perfil: str = Form(""), idioma: str = Form(""), palabras: bool = Form(False)):
+    tamano = tamano_solicitado(modelo)
+    # Las grabaciones del micrófono son notas de voz cortas: si no eligen perfil, van por el rápido
+    opciones = opciones_transcripcion(perfil, idioma, palabras, por_defecto=PERFIL_GRABACIONES)
 
-    with open(localizacion_archivo, "wb+") as file_object:
-        file_object.write(await audiograbado.read())
+    # Copiar el archivo por trozos a un temporal con nombre único, sin cargarlo entero en memoria
+    inicio = time.perf_counter()
+    localizacion_archivo = await asyncio.to_thread(guardar_subida, audiograbado.file, audiograbado.filename)
+    observar("whisper_etapa_segundos", time.perf_counter() - inicio, etapa="subida")
 
     # Obtener el nombre del archivo y su formato
     nombre_archivo = audiograbado.filename.split(".")
 
     # Guardar el tiempo de inicio
-    tiempo_inicio = int(time.time())
+    tiempo_inicio = time.perf_counter()
 
-    # Se invoca a la función procesar_archivo y se espera a que se complete antes de continuar
-    await procesar_archivo(localizacion_archivo, cola)
-    # Obtener los elementos de la cola asíncrona
-    idioma_detectado = await cola.get()
-    transcripcion = await cola.get()
+    # Se invoca a la función procesar_archivo y se espera a que se complete antes de continuar. Las grabaciones
+    # son cortas y se atienden con prioridad
+    idioma_detectado, transcripcion = await procesar_archivo(localizacion_archivo, PRIORIDAD_CORTA, tamano, opciones)
 
     # Guardar el tiempo de finalización
-    tiempo_final = int(time.time())
+    tiempo_final = time.perf_counter()
     # Calcular el tiempo de transcripción en segundos
     tiempo_transcripcion = tiempo_final - tiempo_inicio
 
     # Renderizar la plantilla
     return templates.TemplateResponse("resultado.html", {"request": request, "nombreArchivo": nombre_archivo[0],
                                                       "formato": nombre_archivo[1], "idioma": idioma_detectado,
-                                                      "transcripcion": transcripcion['text'],
-                                                         "tiempoTranscripcion": tiempo_transcripcion})
+                                                      "transcripcion": transcripcion['texto'],
+                                                         "tiempoTranscripcion": tiempo_transcripcion,
+                                                         "tiemposEtapas": transcripcion['tiempos'],
+                                                         "rtf": transcripcion['rtf'], "modelo": nombre_modelo(tamano),
+                                                         "descargas": transcripcion['descargas'],
+                                                         "idiomaFijado": idioma_fijado(opciones)})
 
 
 @app.post('/transcripcion_archivo', response_class=HTMLResponse)
-async def transcripcion_archivo(request: Request, archivo_audio: UploadFile = File(...)):
+async def transcripcion_archivo(request: Request, archivo_audio: UploadFile = File(...), streaming: bool = Form(False),
+                                modelo: str = Form(""), perfil: str = Form(""), idioma: str = Form(""),
+                                palabras: bool = Form(False)):
+    tamano = tamano_solicitado(modelo)
+    opciones = opciones_transcripcion(perfil, idioma, palabras)
+
+    # Copiar el archivo por trozos a un temporal con nombre único, sin cargarlo entero en memoria
+    inicio = time.perf_counter()
+    localizacion_archivo = await asyncio.to_thread(guardar_subida, archivo_audio.file, archivo_audio.filename)
+    observar("whisper_etapa_segundos", time.perf_counter() - inicio, etapa="subida")
 
-    localizacion_archivo = f"./{archivo_audio.filename}"
+    # Los archivos pequeños se atienden con la prioridad de las grabaciones
+    prioridad = PRIORIDAD_CORTA if os.path.getsize(localizacion_archivo) <= TAMANO_ARCHIVO_CORTO else PRIORIDAD_LARGA
 
-    with open(localizacion_archivo, "wb+") as file_object:
-        file_object.write(await archivo_audio.read())
+    # Si se pide, devolver la transcripción en streaming, segmento a segmento
+    if streaming:
+        return StreamingResponse(await procesar_archivo_streaming(localizacion_archivo, prioridad, tamano, opciones),
+                                 media_type="application/x-ndjson")
 
     # Obtener el nombre del archivo y su formato
     nombre_archivo = archivo_audio.filename.split('.')
 
     # Guardar el tiempo de inicio
-    tiempo_inicio = int(time.time())
+    tiempo_inicio = time.perf_counter()
 
-    await procesar_archivo(localizacion_archivo, cola)
-    idioma_detectado = await cola.get()
-    transcripcion = await cola.get()
+    idioma_detectado, transcripcion = await procesar_archivo(localizacion_archivo, prioridad, tamano, opciones)
 
     # Guardar el tiempo de finalización
-    tiempo_final = int(time.time())
+    tiempo_final = time.perf_counter()
 
     # Calcular el tiempo de transcripción en segundos
     tiempo_transcripcion = tiempo_final - tiempo_inicio
 
     return templates.TemplateResponse("resultado.html", {"request": request, "nombreArchivo": nombre_archivo[0],
                                                          "formato": nombre_archivo[1], "idioma": idioma_detectado,
-                                                         "transcripcion": transcripcion['text'], "tiempoTranscripcion": tiempo_transcripcion})
+                                                         "transcripcion": transcripcion['texto'], "tiempoTranscripcion": tiempo_transcripcion,
+                                                         "tiemposEtapas": transcripcion['tiempos'],
+                                                         "rtf": transcripcion['rtf'], "modelo": nombre_modelo(tamano),
+                                                         "descargas": transcripcion['descargas'],
+                                                         "idiomaFijado": idioma_fijado(opciones)})
 
 
 @app.post('/transcripcion_video', response_class=HTMLResponse)
-async def transcripcion_video(request: Request, url: str = Form(...)):
-
-    # Configuración de yt-dlp
-    ydl_opts = {
-        "format": "bestaudio/best",
-        "outtmpl": "audio.%(ext)s",
-        "postprocessors": [{
-            "key": "FFmpegExtractAudio",
-            "preferredcodec": "mp3",
-            "preferredquality": "192",
-        }],
-    }
-
-    # Descarga el audio del video
-    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-        ydl.download([url])
-
-    # Obtiene el título del video
-    with yt_dlp.YoutubeDL() as ydl:
-        info = ydl.extract_info(url, download=False)
-        title = info.get("title", None)
+async def transcripcion_video(request: Request, url: str = Form(...), modelo: str = Form(""),
+                              perfil: str = Form(""), idioma: str = Form(""), palabras: bool = Form(False)):
+    tamano = tamano_solicitado(modelo)
+    opciones = opciones_transcripcion(perfil, idioma, palabras)
+
+    # Si el vídeo ya se transcribió con el mismo modelo, devolver el resultado sin volver a descargarlo
+    inicio_consulta = time.perf_counter()
+    clave = cache.clave_url(url, opciones, modelo=nombre_modelo(tamano))
+    resultado = await asyncio.to_thread(cache.obtener, clave)
+    if resultado is not None:
+        descargas = enlaces_descarga(clave) if "segmentos" in resultado else None
+        return templates.TemplateResponse("resultado.html", {"request": request, "nombreArchivo": resultado["titulo"],
+                                                             "formato": resultado.get("formato", "mp3"),
+                                                             "idioma": resultado["idioma"],
+                                                             "transcripcion": resultado["transcripcion"],
+                                                             "tiempoTranscripcion": 0,
+                                                             "tiemposEtapas": {"consulta_cache": time.perf_counter() - inicio_consulta},
+                                                             "descargas": descargas,
+                                                             "idiomaFijado": idioma_fijado(opciones)})
+
+    # Descarga el audio del video y obtiene su título con una sola llamada a yt-dlp, en un hilo aparte para no
+    # bloquear el bucle de eventos
+    inicio = time.perf_counter()
+    localizacion_archivo, title, formato = await asyncio.to_thread(descargar_audio, url)
+    observar("whisper_etapa_segundos", time.perf_counter() - inicio, etapa="descarga")
 
     # Guardar el tiempo de inicio
-    tiempo_inicio = int(time.time())
+    tiempo_inicio = time.perf_counter()
 
-    await procesar_archivo("audio.mp3", cola)
-    idioma_detectado = await cola.get()
-    transcripcion = await cola.get()
+    idioma_detectado, transcripcion = await procesar_archivo(localizacion_archivo, PRIORIDAD_LARGA, tamano, opciones)
 
     # Guardar el tiempo de finalización
-    tiempo_final = int(time.time())
+    tiempo_final = time.perf_counter()
 
     # Calcular el tiempo de transcripción en segundos
     tiempo_transcripcion = tiempo_final - tiempo_inicio
 
+    # Guardar también el resultado bajo la URL del vídeo, con sus segmentos para descargarlos
+    await asyncio.to_thread(cache.guardar, clave, {"titulo": title, "formato": formato, "idioma": idioma_detectado,
+                                                   "transcripcion": transcripcion['texto'],
+                                                   "segmentos": [segmento_publico(segmento)
+                                                                 for segmento in transcripcion['segmentos']]})
+
     return templates.TemplateResponse("resultado.html", {"request": request, "nombreArchivo": title,
-                                                         "formato": "mp3", "idioma": idioma_detectado,
-                                                         "transcripcion": transcripcion['text'],
-                                                         "tiempoTranscripcion": tiempo_transcripcion})
+                                                         "formato": formato, "idioma": idioma_detectado,
+                                                         "transcripcion": transcripcion['texto'],
+                                                         "tiempoTranscripcion": tiempo_transcripcion,
+                                                         "tiemposEtapas": transcripcion['tiempos'],
+                                                         "rtf": transcripcion['rtf'], "modelo": nombre_modelo(tamano),
+                                                         "descargas": transcripcion['descargas'],
+                                                         "idiomaFijado": idioma_fijado(opciones)})
 
 # Para ejecutarlo en local y depurarlo
 if __name__ == "__main__":
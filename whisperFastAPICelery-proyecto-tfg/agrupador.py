@@ -0,0 +1,156 @@
+import os
+import queue
+import threading
+import time
+
+import torch
+from whisper.timing import add_word_timestamps
+
+# Número máximo de ventanas de 30 segundos que se decodifican juntas y tiempo máximo (en milisegundos) que se espera
+# a que lleguen más ventanas antes de lanzar un lote incompleto. Con LOTE_MAXIMO = 1 no se agrupa nada
+LOTE_MAXIMO = int(os.environ.get("LOTE_MAXIMO", "1"))
+ESPERA_LOTE_MS = float(os.environ.get("ESPERA_LOTE_MS", "50"))
+
+
+# Petición de un hilo llamante: la ventana de espectrograma, lo que se quiere hacer con ella y dónde dejar el resultado
+class PeticionLote:
+    def __init__(self, tipo, mel, opciones=None):
+        self.tipo = tipo
+        self.mel = mel
+        self.opciones = opciones
+        self.resultado = None
+        self.error = None
+        self.terminada = threading.Event()
+
+
+# Agrupador de lotes: se coloca delante del modelo y se usa en su lugar (expone decode, detect_language,
+# alinear_palabras y el resto de atributos del modelo). Las ventanas que llegan de peticiones concurrentes se acumulan
+# durante ESPERA_LOTE_MS o hasta LOTE_MAXIMO elementos y se procesan en una sola pasada del codificador y el
+# decodificador; después cada resultado se devuelve a su hilo. Un único hilo usa el modelo, así que también es seguro
+# compartirlo entre hilos.
+# El hilo arranca con la primera petición. Al cerrar el agrupador (cuando el registro expulsa el modelo) el hilo
+# termina en cuanto se vacía la cola, y deja de retener el modelo; si aún llega alguna petición, vuelve a arrancar.
+# Si se indican núcleos, el hilo solo se ejecuta en ellos
+class AgrupadorLotes:
+
+    def __init__(self, model, lote_maximo=LOTE_MAXIMO, espera_ms=ESPERA_LOTE_MS, nucleos=None):
+        self.model = model
+        self.lote_maximo = lote_maximo
+        self.espera = espera_ms / 1000
+        self.nucleos = nucleos
+        self.cola = queue.Queue()
+        self.cerrojo = threading.Lock()
+        self.hilo = None
+        self.cerrado = False
+        # Número de lotes procesados y de ventanas en ellos, para conocer el tamaño medio de lote
+        self.lotes = 0
+        self.ventanas = 0
+
+    # Los atributos que no define el agrupador (device, dims, is_multilingual...) son los del modelo
+    def __getattr__(self, nombre):
+        return getattr(self.model, nombre)
+
+    def _encolar(self, peticion):
+        with self.cerrojo:
+            self.cola.put(peticion)
+            if self.hilo is None:
+                self.hilo = threading.Thread(target=self._bucle, name="agrupador-lotes", daemon=True)
+                self.hilo.start()
+        peticion.terminada.wait()
+        if peticion.error is not None:
+            raise peticion.error
+        return peticion.resultado
+
+    # Igual que model.decode para una ventana (n_mels, n_frames)
+    def decode(self, mel, opciones):
+        return self._encolar(PeticionLote("decode", mel, opciones))
+
+    # Igual que model.detect_language para una ventana (n_mels, n_frames)
+    def detect_language(self, mel):
+        return self._encolar(PeticionLote("idioma", mel))
+
+    # Igual que whisper.timing.add_word_timestamps con los segmentos de una ventana (n_mels, n_frames) y el resto de
+    # sus argumentos en opciones. La alineación instala ganchos en las capas de atención cruzada del modelo, así que no
+    # puede coincidir con otra pasada: se hace en el hilo del agrupador, sola
+    def alinear_palabras(self, mel, opciones):
+        return self._encolar(PeticionLote("palabras", mel, opciones))
+
+    # Terminar el hilo cuando no queden peticiones
+    def cerrar(self):
+        self.cerrado = True
+        # Despertar al hilo si está esperando peticiones
+        self.cola.put(None)
+
+    # Recoger las peticiones del siguiente lote. Si el agrupador está cerrado y no llega ninguna, el lote está vacío
+    def _recoger_lote(self):
+        try:
+            lote = [self.cola.get(timeout=self.espera if self.cerrado else None)]
+        except queue.Empty:
+            return []
+        limite = time.monotonic() + self.espera
+        while len(lote) < self.lote_maximo:
+            restante = limite - time.monotonic()
+            if restante <= 0:
+                break
+            try:
+                lote.append(self.cola.get(timeout=restante))
+            except queue.Empty:
+                break
+        return [peticion for peticion in lote if peticion is not None]
+
+    def _bucle(self):
+        # Fijar el hilo a sus núcleos; los hilos de torch que cree después los heredan
+        if self.nucleos:
+            os.sched_setaffinity(0, self.nucleos)
+        while True:
+            lote = self._recoger_lote()
+            if not lote:
+                with self.cerrojo:
+                    if self.cerrado and self.cola.empty():
+                        self.hilo = None
+                        return
+                continue
+
+            # Solo pueden ir en el mismo lote las ventanas con las mismas opciones de decodificación y el mismo tipo
+            grupos = {}
+            for peticion in lote:
+                grupos.setdefault(self._clave(peticion), []).append(peticion)
+
+            for peticiones in grupos.values():
+                self._procesar(peticiones)
+
+    @staticmethod
+    def _clave(peticion):
+        # Cada alineación de palabras va sola
+        if peticion.tipo == "palabras":
+            return peticion.tipo, id(peticion)
+        if peticion.opciones is None:
+            return peticion.tipo, peticion.mel.dtype
+        opciones = tuple((campo, tuple(valor) if isinstance(valor, list) else valor)
+                         for campo, valor in vars(peticion.opciones).items())
+        return peticion.tipo, peticion.mel.dtype, opciones
+
+    def _procesar(self, peticiones):
+        try:
+            if peticiones[0].tipo == "palabras":
+                peticion = peticiones[0]
+                peticion.resultado = add_word_timestamps(model=self.model, mel=peticion.mel, **peticion.opciones)
+                peticion.terminada.set()
+                return
+            mel = torch.stack([peticion.mel for peticion in peticiones])
+            if peticiones[0].tipo == "decode":
+                resultados = self.model.decode(mel, peticiones[0].opciones)
+            else:
+                tokens, probs = self.model.detect_language(mel)
+                resultados = list(zip(tokens, probs))
+        except Exception as e:
+            for peticion in peticiones:
+                peticion.error = e
+                peticion.terminada.set()
+            return
+
+        self.lotes += 1
+        self.ventanas += len(peticiones)
+        for peticion, resultado in zip(peticiones, resultados):
+            peticion.resultado = resultado
+            peticion.terminada.set()
@@ -0,0 +1,75 @@
+import os
+
+from celery import Celery
+from celery.worker import state
+from celery.worker.autoscale import Autoscaler
+from kombu import Queue
+
+# Configuración de Celery común a la API, los workers y la línea de comandos de los lotes. Cada clase de trabajo va a
+# su propia cola, para que un vídeo o un lote largo no deje esperando a las grabaciones detrás de él: cada cola puede
+# tener sus propios workers (ver docker-compose.yml), y un worker sin -Q atiende todas.
+# Las tareas se confirman al terminar (acks_late) y cada proceso reserva solo la tarea que está ejecutando
+# (prefetch 1): si el worker se cae, sus tareas vuelven a la cola en lugar de perderse, y una tarea larga nunca retiene
+# otras en un proceso ocupado mientras hay procesos libres
+BROKER_URL = os.environ.get("CELERY_BROKER_URL", "redis://localhost:6379/0")
+BACKEND_URL = os.environ.get("CELERY_RESULT_BACKEND", "redis://localhost:6379/0")
+
+COLA_GRABACIONES = "grabaciones"  # grabaciones del micrófono, cortas
+COLA_ARCHIVOS = "archivos"  # archivos subidos (y, por defecto, cualquier tarea sin ruta)
+COLA_VIDEOS = "videos"  # descarga y transcripción de vídeos
+COLA_LOTES = "lotes"  # archivos de los lotes (ver lotes.py)
+COLAS = (COLA_GRABACIONES, COLA_ARCHIVOS, COLA_VIDEOS, COLA_LOTES)
+
+# Cola de cada tarea. Las grabaciones usan la misma tarea que los archivos y se encolan indicando su cola, y los
+# fragmentos de un audio largo van a la cola de la tarea que los reparte
+RUTAS = {
+    "worker.procesar_archivo": {"queue": COLA_ARCHIVOS},
+    "worker.procesar_video": {"queue": COLA_VIDEOS},
+    "worker.transcribir_archivo_lote": {"queue": COLA_LOTES},
+}
+
+# Con acks_late, Redis vuelve a entregar las tareas que no se han confirmado pasado este tiempo (en segundos), así que
+# tiene que ser mayor que la tarea más larga o se ejecutaría dos veces
+VISIBILIDAD = int(os.environ.get("VISIBILIDAD_TAREAS", str(6 * 3600)))
+
+# Segundos que tiene cada proceso nuevo del worker para cargar el modelo antes de que Celery lo dé por muerto
+TIEMPO_CARGA_MODELO = float(os.environ.get("TIEMPO_CARGA_MODELO", "600"))
+
+# Memoria residente máxima de cada proceso del worker, en MB. Al pasarla, el proceso se sustituye por otro al terminar
+# su tarea. 0 (por defecto) para no limitarla
+MEMORIA_MAXIMA_PROCESO = int(os.environ.get("MEMORIA_MAXIMA_PROCESO", "0"))
+
+
+# Aplicación de Celery con el nombre indicado y la configuración común
+def crear_celery(nombre):
+    celery_app = Celery(nombre, broker=BROKER_URL, backend=BACKEND_URL)
+    celery_app.conf.update(
+        task_queues=[Queue(cola) for cola in COLAS],
+        task_default_queue=COLA_ARCHIVOS,
+        task_routes=RUTAS,
+        task_acks_late=True,
+        worker_prefetch_multiplier=1,
+        broker_transport_options={"visibility_timeout": VISIBILIDAD},
+        worker_proc_alive_timeout=TIEMPO_CARGA_MODELO,
+        worker_max_memory_per_child=MEMORIA_MAXIMA_PROCESO * 1024 or None,
+        worker_autoscaler="colas:AutoescaladorColas",
+    )
+    return celery_app
+
+
+# Tareas esperando en cada cola del broker (Redis guarda cada cola en una lista con su nombre)
+def profundidad_colas(celery_app, colas=COLAS):
+    with celery_app.pool.acquire(block=True) as conexion:
+        cliente = conexion.default_channel.client
+        return {cola: cliente.llen(cola) for cola in colas}
+
+
+# Autoescalado según la profundidad de las colas (con --autoscale=máximo,mínimo): el worker quiere tantos procesos
+# como tareas tiene reservadas más las que esperan en las colas que atiende, entre el mínimo y el máximo. Los procesos
+# de más se retiran después de estar parados el tiempo de gracia del autoescalado de Celery
+class AutoescaladorColas(Autoscaler):
+
+    @property
+    def qty(self):
+        colas = list(self.worker.app.amqp.queues.consume_from or COLAS)
+        return len(state.reserved_requests) + sum(profundidad_colas(self.worker.app, colas).values())
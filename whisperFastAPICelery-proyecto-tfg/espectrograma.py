@@ -0,0 +1,86 @@
+from functools import lru_cache
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+from whisper.audio import HOP_LENGTH, N_FFT, N_FRAMES, mel_filters
+
+# Espectrograma log-Mel de Whisper. Da el mismo resultado que whisper.log_mel_spectrogram, pero sin rehacer en cada
+# llamada la ventana de Hann y el banco de filtros Mel, que se guardan por dispositivo, con la potencia calculada
+# como parte real al cuadrado más parte imaginaria al cuadrado (sin la raíz del módulo que luego se vuelve a elevar
+# al cuadrado) y con los pasos del logaritmo en el sitio, sin un tensor intermedio por paso. El espectrograma de un
+# archivo se calcula una vez entero y las ventanas de 30 segundos se toman de él como vistas, sin copiarlo; los de
+# varios audios (los fragmentos de un audio largo) se pueden calcular juntos, en lotes de una sola STFT, lo que en GPU
+# ahorra lanzamientos de kernels. En CPU el lote no sale más rápido que uno a uno (ver benchmark_mel.py)
+
+# Bandas Mel de los modelos de Whisper
+N_MELS = 80
+
+# Audios que se juntan como máximo en la misma STFT, para acotar la memoria del espectro complejo del lote
+LOTE_MEL = 16
+
+
+@lru_cache(maxsize=None)
+def ventana_hann(dispositivo):
+    return torch.hann_window(N_FFT, device=dispositivo)
+
+
+@lru_cache(maxsize=None)
+def filtros_mel(dispositivo, n_mels=N_MELS):
+    return mel_filters(dispositivo, n_mels)
+
+
+# Audio como tensor en el dispositivo indicado. Los arrays de NumPy se convierten sin copiarlos
+def _tensor(audio, dispositivo):
+    if isinstance(audio, np.ndarray):
+        audio = torch.from_numpy(audio)
+    return audio.to(dispositivo)
+
+
+# Espectrogramas log-Mel de uno o más audios del mismo tamaño, ya con el relleno por reflexión de la STFT centrada
+# (tamaño, muestras) -> (tamaño, n_mels, tramas). Cada audio se normaliza con su propio máximo entre sus tramas válidas
+def _log_mel(audios, tramas, dispositivo, n_mels):
+    espectro = torch.stft(audios, N_FFT, HOP_LENGTH, window=ventana_hann(dispositivo), center=False,
+                          return_complex=True)[..., :-1]
+    potencia = espectro.real.square().add_(espectro.imag.square())
+    log_spec = torch.matmul(filtros_mel(dispositivo, n_mels), potencia).clamp_(min=1e-10).log10_()
+
+    mels = []
+    for numero, num_tramas in enumerate(tramas):
+        mel = log_spec[numero, :, :num_tramas]
+        mel.clamp_(min=mel.max().item() - 8.0).add_(4.0).div_(4.0)
+        mels.append(mel)
+    return mels
+
+
+# Espectrogramas log-Mel de varios audios (arrays de NumPy o tensores de una dimensión a 16 kHz), en el dispositivo
+# indicado, calculados en lotes de LOTE_MEL con una sola STFT por lote. Cada uno es una vista de su lote, con las
+# mismas tramas que el de whisper.log_mel_spectrogram
+def log_mel_lote(audios, dispositivo="cpu", n_mels=N_MELS):
+    dispositivo = torch.device(dispositivo)
+    mels = []
+    for inicio in range(0, len(audios), LOTE_MEL):
+        # Cada audio se rellena por separado, como en la STFT centrada, y después con ceros hasta el más largo del lote
+        rellenos = [F.pad(_tensor(audio, dispositivo)[None], (N_FFT // 2, N_FFT // 2), mode="reflect")[0]
+                    for audio in audios[inicio:inicio + LOTE_MEL]]
+        longitud = max(len(relleno) for relleno in rellenos)
+        lote = torch.stack([F.pad(relleno, (0, longitud - len(relleno))) for relleno in rellenos])
+        mels.extend(_log_mel(lote, [(len(relleno) - N_FFT) // HOP_LENGTH for relleno in rellenos], dispositivo,
+                             n_mels))
+    return mels
+
+
+# Espectrograma log-Mel de un audio completo
+def log_mel(audio, dispositivo="cpu", n_mels=N_MELS):
+    dispositivo = torch.device(dispositivo)
+    relleno = F.pad(_tensor(audio, dispositivo)[None], (N_FFT // 2, N_FFT // 2), mode="reflect")
+    return _log_mel(relleno, [(relleno.shape[-1] - N_FFT) // HOP_LENGTH], dispositivo, n_mels)[0]
+
+
+# Ventana de 30 segundos del espectrograma que empieza en la trama indicada. Es una vista del espectrograma, salvo la
+# última, que se completa con ceros hasta los 30 segundos
+def ventana_mel(mel, inicio=0):
+    ventana = mel[..., inicio:inicio + N_FRAMES]
+    if ventana.shape[-1] < N_FRAMES:
+        ventana = F.pad(ventana, (0, N_FRAMES - ventana.shape[-1]))
+    return ventana
@@ -0,0 +1,76 @@
+import os
+
+import numpy as np
+
+# Frecuencia de muestreo del audio que decodifica whisper
+FRECUENCIA_MUESTREO = 16000
+
+# Los audios de más de DURACION_MODO_LARGO segundos se transcriben por fragmentos en paralelo. Cada fragmento dura
+# como máximo DURACION_FRAGMENTO segundos, y los silencios de más de SILENCIO_MAXIMO segundos quedan fuera de los
+# fragmentos y no se transcriben
+DURACION_MODO_LARGO = float(os.environ.get("DURACION_MODO_LARGO", "600"))
+DURACION_FRAGMENTO = float(os.environ.get("DURACION_FRAGMENTO", "30"))
+SILENCIO_MAXIMO = float(os.environ.get("SILENCIO_MAXIMO", "3"))
+
+# Parámetros del detector de voz: duración de cada trama, decibelios por debajo del nivel de referencia (el percentil
+# 95 de la energía de las tramas) a partir de los que una trama se considera silencio, pausa más larga que se
+# considera parte del habla y margen que se deja antes y después de cada tramo de voz para no cortar palabras
+DURACION_TRAMA = 0.03
+UMBRAL_DB = 35.0
+PAUSA_MINIMA = 0.5
+MARGEN_VOZ = 0.2
+
+
+# Comprobar si un audio es lo bastante largo para transcribirlo por fragmentos
+def es_audio_largo(audio, duracion_minima=DURACION_MODO_LARGO):
+    return len(audio) / FRECUENCIA_MUESTREO > duracion_minima
+
+
+# Detector de voz por energía: devuelve los tramos con voz como pares (inicio, fin) en muestras, uniendo los que
+# están separados por pausas de menos de pausa_minima segundos
+def detectar_voz(audio, pausa_minima=PAUSA_MINIMA, umbral_db=UMBRAL_DB, margen=MARGEN_VOZ):
+    muestras_trama = int(DURACION_TRAMA * FRECUENCIA_MUESTREO)
+    num_tramas = len(audio) // muestras_trama
+    if num_tramas == 0:
+        return [(0, len(audio))] if len(audio) else []
+
+    tramas = audio[:num_tramas * muestras_trama].reshape(num_tramas, muestras_trama)
+    energia = 10 * np.log10(np.mean(tramas.astype(np.float64) ** 2, axis=1) + 1e-10)
+    voz = energia > np.percentile(energia, 95) - umbral_db
+
+    # Flancos de subida y bajada de la máscara de voz
+    cambios = np.diff(np.concatenate(([0], voz.astype(np.int8), [0])))
+    inicios = np.flatnonzero(cambios == 1)
+    fines = np.flatnonzero(cambios == -1)
+
+    tramos = []
+    tramas_pausa = pausa_minima / DURACION_TRAMA
+    for inicio, fin in zip(inicios, fines):
+        if tramos and inicio - tramos[-1][1] < tramas_pausa:
+            tramos[-1][1] = fin
+        else:
+            tramos.append([inicio, fin])
+
+    muestras_margen = int(margen * FRECUENCIA_MUESTREO)
+    return [(max(0, int(inicio) * muestras_trama - muestras_margen),
+             min(len(audio), int(fin) * muestras_trama + muestras_margen)) for inicio, fin in tramos]
+
+
+# Dividir el audio en fragmentos de voz de como máximo duracion_maxima segundos. Los tramos de voz consecutivos se
+# juntan en el mismo fragmento mientras quepan y no los separe un silencio de más de silencio_maximo segundos, y solo
+# se corta dentro de un tramo cuando es más largo que un fragmento. Devuelve pares (inicio, fin) en muestras; lo que
+# queda fuera de los fragmentos no tiene voz y no se transcribe
+def dividir_en_fragmentos(audio, duracion_maxima=DURACION_FRAGMENTO, silencio_maximo=SILENCIO_MAXIMO):
+    maximo = int(duracion_maxima * FRECUENCIA_MUESTREO)
+    silencio = int(silencio_maximo * FRECUENCIA_MUESTREO)
+    fragmentos = []
+    for inicio, fin in detectar_voz(audio):
+        # Un tramo demasiado largo se corta en trozos del tamaño máximo
+        while fin - inicio > maximo:
+            fragmentos.append((inicio, inicio + maximo))
+            inicio += maximo
+        if fragmentos and fin - fragmentos[-1][0] <= maximo and inicio - fragmentos[-1][1] <= silencio:
+            fragmentos[-1] = (fragmentos[-1][0], fin)
+        else:
+            fragmentos.append((inicio, fin))
+    return fragmentos
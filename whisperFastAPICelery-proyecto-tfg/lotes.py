@@ -0,0 +1,233 @@
+import argparse
+import hashlib
+import json
+import os
+import sys
+import threading
+import time
+
+from subtitulos import formato_srt, formato_vtt
+
+# Transcripción por lotes: los archivos de un directorio o de un manifiesto se reparten entre los workers de Celery
+# como tareas transcribir_archivo_lote, sin plantillas ni subidas. Los archivos y el directorio de salida tienen que
+# estar en un directorio que vean los workers y quien coordina el lote (la API o la línea de comandos).
+# Por cada archivo se escriben sus subtítulos (.srt y .vtt) y una línea en transcripciones.jsonl, que es también el
+# punto de control: si el lote se interrumpe, al lanzarlo de nuevo con la misma salida se saltan los archivos que ya
+# tienen su línea. Se puede lanzar desde la API (POST /lotes) o desde la línea de comandos:
+#   python lotes.py grabaciones/ salida/ --modelo small
+
+# Nombre de la tarea del worker que transcribe cada archivo
+TAREA = "worker.transcribir_archivo_lote"
+
+# Tareas del lote encoladas a la vez. Tienen que ser más que los procesos de los workers para que siempre haya una
+# esperando cuando termina otra y el modelo no se quede parado, pero no tantas como para que, si el lote se
+# interrumpe, se pierda mucho trabajo ya encolado
+EN_VUELO = int(os.environ.get("LOTE_EN_VUELO", "16"))
+
+# Directorio dentro del cual la API acepta los orígenes y las salidas de los lotes (ver ruta_lote). La línea de
+# comandos, que lanza quien administra el servicio, no tiene esta limitación
+DIRECTORIO_LOTES = os.environ.get("DIRECTORIO_LOTES", "./lotes")
+
+# Extensiones de los archivos que se recogen al recorrer un directorio
+EXTENSIONES_AUDIO = {".wav", ".mp3", ".ogg", ".flac", ".m4a", ".opus", ".webm", ".mp4"}
+
+# Segundos entre consultas del estado de las tareas encoladas
+ESPERA_CONSULTA = 0.2
+
+REGISTRO = "transcripciones.jsonl"
+
+
+# Ruta real (sin enlaces simbólicos ni ..) de un origen o una salida de un lote pedido a la API. Lanza ValueError si
+# queda fuera de base, para que un cliente no pueda leer ni escribir en otros directorios del servidor
+def ruta_lote(ruta, base=DIRECTORIO_LOTES):
+    base = os.path.realpath(base)
+    real = os.path.realpath(os.path.join(base, ruta))
+    if os.path.commonpath([base, real]) != base:
+        raise ValueError(f"La ruta {ruta} está fuera del directorio de los lotes")
+    return real
+
+
+# Archivos de un lote, con su ruta absoluta: los audios de un directorio, recorrido recursivamente, o los de un
+# manifiesto, que es una lista JSON (.json) o un archivo de texto con una ruta por línea. Las rutas relativas del
+# manifiesto son relativas a su directorio. Si se indica base, todos los archivos (los del manifiesto y los enlaces
+# simbólicos del directorio) tienen que estar dentro de ella (ver ruta_lote)
+def archivos_lote(origen, base=None):
+    if os.path.isdir(origen):
+        archivos = sorted(os.path.abspath(os.path.join(directorio, nombre))
+                          for directorio, _, nombres in os.walk(origen) for nombre in nombres
+                          if os.path.splitext(nombre)[1].lower() in EXTENSIONES_AUDIO)
+    else:
+        with open(origen) as archivo:
+            if origen.endswith(".json"):
+                rutas = json.load(archivo)
+            else:
+                rutas = [linea.strip() for linea in archivo if linea.strip() and not linea.startswith("#")]
+        directorio = os.path.dirname(os.path.abspath(origen))
+        archivos = [os.path.normpath(os.path.join(directorio, ruta)) for ruta in rutas]
+
+    if base is not None:
+        archivos = [ruta_lote(archivo, base) for archivo in archivos]
+    return archivos
+
+
+# Escribir un archivo de forma atómica, para que una interrupción no deje uno a medias
+def _escribir(ruta, contenido):
+    temporal = ruta + ".tmp"
+    with open(temporal, "w") as archivo:
+        archivo.write(contenido)
+    os.replace(temporal, ruta)
+
+
+# Lote de archivos que se transcriben con el mismo modelo y se guardan en el mismo directorio de salida. Su
+# identificador depende solo de los archivos, la salida y el modelo, así que el mismo lote lanzado otra vez continúa
+# donde se quedó
+class Lote:
+
+    def __init__(self, archivos, salida, tamano=None, en_vuelo=EN_VUELO):
+        self.archivos = archivos
+        self.salida = os.path.abspath(salida)
+        self.tamano = tamano
+        self.en_vuelo = en_vuelo
+        self.id = hashlib.sha256(json.dumps([archivos, self.salida, tamano]).encode()).hexdigest()[:16]
+        # Los subtítulos reproducen en la salida la estructura de directorios de los archivos
+        self.raiz = os.path.commonpath([os.path.dirname(archivo) for archivo in archivos]) if archivos else ""
+        self.registro = os.path.join(self.salida, REGISTRO)
+        self.hechos = self._leer_registro()
+        self.errores = {}
+        self.en_curso = 0
+        # Solo los archivos transcritos en esta ejecución, para medir el rendimiento
+        self.completados = 0
+        self.segundos_audio = 0.0
+        self.inicio = None
+        self.fin = None
+        self.cerrojo = threading.Lock()
+
+    # Archivos que ya tienen su línea en el registro. Una interrupción puede dejar la última línea a medias: se
+    # recorta, para que la siguiente empiece en una línea nueva, y ese archivo se vuelve a transcribir
+    def _leer_registro(self):
+        hechos = set()
+        if not os.path.exists(self.registro):
+            return hechos
+
+        with open(self.registro, "rb+") as archivo:
+            contenido = archivo.read()
+            if not contenido.endswith(b"\n"):
+                archivo.truncate(contenido.rfind(b"\n") + 1)
+        for linea in contenido.splitlines(keepends=True):
+            try:
+                hechos.add(json.loads(linea)["archivo"])
+            except (ValueError, KeyError):
+                continue
+        return hechos
+
+    # Escribir los subtítulos de un archivo transcrito y añadir su línea al registro, que se fuerza a disco para que
+    # el punto de control sobreviva a una caída
+    def _guardar(self, archivo, resultado):
+        base = os.path.join(self.salida, os.path.splitext(os.path.relpath(archivo, self.raiz))[0])
+        os.makedirs(os.path.dirname(base), exist_ok=True)
+        _escribir(base + ".srt", formato_srt(resultado["segmentos"]))
+        _escribir(base + ".vtt", formato_vtt(resultado["segmentos"]))
+
+        linea = json.dumps({"archivo": archivo, **resultado}, ensure_ascii=False) + "\n"
+        with self.cerrojo:
+            with open(self.registro, "a") as registro:
+                registro.write(linea)
+                registro.flush()
+                os.fsync(registro.fileno())
+            self.hechos.add(archivo)
+            self.errores.pop(archivo, None)
+            self.completados += 1
+            self.segundos_audio += resultado["duracion_audio"]
+
+    # Encolar los archivos pendientes en la aplicación de Celery indicada, manteniendo en_vuelo tareas encoladas, y
+    # guardar cada resultado según llega. Los archivos que fallan se anotan en errores y se reintentan al lanzar el
+    # lote otra vez. Si se indica, se llama a al_terminar con cada archivo y su error (None, si se transcribió)
+    def ejecutar(self, celery_app, al_terminar=None):
+        os.makedirs(self.salida, exist_ok=True)
+        pendientes = [archivo for archivo in self.archivos if archivo not in self.hechos]
+        pendientes.reverse()
+        tareas = {}
+        self.inicio = time.perf_counter()
+        self.fin = None
+
+        while pendientes or tareas:
+            while pendientes and len(tareas) < self.en_vuelo:
+                archivo = pendientes.pop()
+                tareas[archivo] = celery_app.send_task(TAREA, args=[archivo, self.tamano],
+                                                       kwargs={"encolado": time.time()})
+            self.en_curso = len(tareas)
+
+            terminadas = [archivo for archivo, tarea in tareas.items() if tarea.ready()]
+            if not terminadas:
+                time.sleep(ESPERA_CONSULTA)
+                continue
+            for archivo in terminadas:
+                tarea = tareas.pop(archivo)
+                error = None
+                try:
+                    self._guardar(archivo, tarea.get())
+                except Exception as e:
+                    error = str(e)
+                    with self.cerrojo:
+                        self.errores[archivo] = error
+                finally:
+                    # El resultado ya está en la salida; no hace falta que siga en el backend
+                    tarea.forget()
+                if al_terminar is not None:
+                    al_terminar(archivo, error)
+
+        self.en_curso = 0
+        self.fin = time.perf_counter()
+
+    def terminado(self):
+        return self.fin is not None
+
+    # Progreso del lote y rendimiento conjunto de esta ejecución: archivos y segundos de audio por segundo y factor
+    # de tiempo real del lote completo (segundos de reloj por segundo de audio)
+    def estado(self):
+        with self.cerrojo:
+            segundos = ((self.fin or time.perf_counter()) - self.inicio) if self.inicio is not None else 0.0
+            return {
+                "lote": self.id,
+                "salida": self.salida,
+                "total": len(self.archivos),
+                "hechos": len(self.hechos),
+                "en_curso": self.en_curso,
+                "errores": dict(self.errores),
+                "terminado": self.terminado(),
+                "segundos": segundos,
+                "archivos_por_segundo": self.completados / segundos if segundos else 0.0,
+                "segundos_audio_por_segundo": self.segundos_audio / segundos if segundos else 0.0,
+                "rtf": segundos / self.segundos_audio if self.segundos_audio else 0.0,
+            }
+
+
+# Línea de comandos: transcribir un directorio o un manifiesto con los workers de Celery, escribiendo el progreso en
+# la salida de errores y el estado final del lote en la salida estándar
+def main():
+    from backends import tamano_solicitado
+    from colas import crear_celery
+
+    parser = argparse.ArgumentParser(description="Transcribir por lotes con los workers de Celery")
+    parser.add_argument("origen", help="directorio de audios o manifiesto (.json o una ruta por línea)")
+    parser.add_argument("salida", help="directorio de los subtítulos y de transcripciones.jsonl")
+    parser.add_argument("--modelo", default="", help="tamaño del modelo (por defecto, el de la configuración)")
+    parser.add_argument("--en-vuelo", type=int, default=EN_VUELO, help="tareas encoladas a la vez")
+    args = parser.parse_args()
+
+    celery_app = crear_celery('lotes')
+    lote = Lote(archivos_lote(args.origen), args.salida, tamano_solicitado(args.modelo), args.en_vuelo)
+    print(f"Lote {lote.id}: {len(lote.archivos)} archivos, {len(lote.hechos)} ya transcritos", file=sys.stderr)
+
+    def al_terminar(archivo, error):
+        estado = lote.estado()
+        print(f"[{estado['hechos']}/{estado['total']}] {archivo}" + (f": {error}" if error else ""), file=sys.stderr)
+
+    lote.ejecutar(celery_app, al_terminar)
+    estado = lote.estado()
+    print(json.dumps(estado, indent=2, ensure_ascii=False))
+    sys.exit(1 if estado["errores"] else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,28 +1,52 @@
-from celery import Celery
-import redis
+import asyncio
+import json
+import os
+import threading
 import time
+from urllib.parse import quote
+from celery.result import AsyncResult
 from fastapi import FastAPI, Request, UploadFile, File, Form
-from fastapi.responses import HTMLResponse
+from fastapi.responses import (HTMLResponse, JSONResponse, PlainTextResponse, RedirectResponse, Response,
+                               StreamingResponse)
 from fastapi.templating import Jinja2Templates
-from worker import procesar_archivo, transcription_results
+from eventos import REDIS_URL, conexion, escuchar
+from resultados import AlmacenResultados
+from cache import crear_cache
+from backends import MODELOS_DISPONIBLES, TAMANO_MODELO, ModeloNoDisponible, nombre_modelo, tamano_solicitado
+from subidas import ArchivoDemasiadoGrande, TAMANO_MAXIMO_PETICION, guardar_subida
+from lotes import DIRECTORIO_LOTES, Lote, archivos_lote, ruta_lote
+from subtitulos import FORMATOS, exportar
+from perfiles import PERFIL_GRABACIONES, PERFILES, PERFIL_POR_DEFECTO, PerfilNoDisponible, opciones_transcripcion
+from colas import COLA_GRABACIONES, crear_celery, profundidad_colas
+import metricas
+from metricas import TIPO_CONTENIDO, exponer, medidores_colas, medidores_replicas, observar
 import uvicorn
-import yt_dlp
 
 app = FastAPI()
 
 # Configuración de Jinja2Templates
 templates = Jinja2Templates(directory="templates")
 
-# Configuración de Celery
-celery_app = Celery('app', broker='redis://localhost:6379/0', backend='redis://localhost:6379/0')
+# Configuración de Celery. Las tareas se encolan por su nombre, sin importar el worker, para que la API no cargue
+# torch ni whisper. La cola de cada tarea sale de la configuración común con los workers (ver colas.py)
+celery_app = crear_celery('app')
 
-# Crear una conexión a Redis con contraseña
-r = redis.Redis(host='localhost', port=6379, password='1234')
+# Resultados de las tareas que guardan los workers, leídos con la conexión a Redis de los eventos (ver resultados.py)
+almacen = AlmacenResultados(conexion)
+
+# Caché de resultados que comparten los workers, para consultar sus aciertos y fallos
+cache = crear_cache(nombre_modelo(), os.environ.get("CACHE_URL", REDIS_URL))
+
+# Métricas en el Redis de Celery, donde las guardan también los workers
+metricas.configurar(os.environ.get("METRICAS_URL", REDIS_URL))
 
 
 @app.get("/", response_class=HTMLResponse)
 async def home(request: Request):
-    return templates.TemplateResponse("index.html", context={"request": request})
+    return templates.TemplateResponse("index.html", context={"request": request, "modelos": MODELOS_DISPONIBLES,
+                                                             "modeloPorDefecto": TAMANO_MODELO, "perfiles": PERFILES,
+                                                             "perfilPorDefecto": PERFIL_POR_DEFECTO,
+                                                             "perfilGrabaciones": PERFIL_GRABACIONES})
 
 
 #  Ignorar la solicitud de favicon.ico en la aplicación FastAPI agregando una ruta para manejarla específicamente
@@ -32,159 +56,315 @@ async def favicon():
     return ""
 
 
-@app.post("/transcripcion_grabacion", response_class=HTMLResponse)
-async def transcripcion_grabacion(request: Request, audiograbado: UploadFile = File(...)):
-    # Guardo el archivo en una ubicación (la raiz del directorio actual) temporal
-    localizacion_archivo = f"uploads/{audiograbado.filename}"
-
-    with open(localizacion_archivo, "wb+") as file_object:
-        file_object.write(await audiograbado.read())
-
-    # Obtener el nombre del archivo y su formato
-    nombre_archivo = audiograbado.filename.split(".")
+# Los archivos que superan el tamaño máximo se rechazan con 413
+@app.exception_handler(ArchivoDemasiadoGrande)
+async def archivo_demasiado_grande(request: Request, exc: ArchivoDemasiadoGrande):
+    return PlainTextResponse(str(exc), status_code=413)
 
-    # Guardar el tiempo de inicio
-    tiempo_inicio = int(time.time())
 
-    # Encolar la tarea de procesamiento
-    task = procesar_archivo.delay(localizacion_archivo)
-    task_id = task.id
+# Los modelos que no están entre los disponibles se rechazan con 400, antes de encolar la tarea
+@app.exception_handler(ModeloNoDisponible)
+async def modelo_no_disponible(request: Request, exc: ModeloNoDisponible):
+    return PlainTextResponse(str(exc), status_code=400)
 
-    # Obtener los resultados de la transcripción desde la variable global
-    resultados = task.get()
 
-    # Guardar el tiempo de finalización
-    tiempo_final = int(time.time())
+# Igual con los perfiles de decodificación y los idiomas que no existen
+@app.exception_handler(PerfilNoDisponible)
+async def perfil_no_disponible(request: Request, exc: PerfilNoDisponible):
+    return PlainTextResponse(str(exc), status_code=400)
 
-    # Calcular el tiempo de transcripción en segundos
-    tiempo_transcripcion = tiempo_final - tiempo_inicio
 
-    # Renderizar la página de "Resultados"
-    return templates.TemplateResponse("resultados.html",
-                                      {"request": request, "nombreArchivo": nombre_archivo[0],
-                                                      "formato": nombre_archivo[1], "idioma": resultados["idioma"],
-                                                      "transcripcion": resultados['transcripcion'],
-                                       "tiempoTranscripcion": tiempo_transcripcion})
+# Rechazar con 413 las peticiones que declaran un cuerpo mayor que el permitido, antes de leerlo, y con 400 las que
+# declaran un tamaño que no es un entero no negativo. Las que no lo declaran se cortan al copiar el archivo subido
+@app.middleware("http")
+async def limitar_tamano_peticion(request: Request, call_next):
+    try:
+        tamano = int(request.headers.get("content-length", 0))
+    except ValueError:
+        tamano = -1
+    if tamano < 0:
+        return PlainTextResponse("Cabecera Content-Length no válida", status_code=400)
+    if tamano > TAMANO_MAXIMO_PETICION:
+        return PlainTextResponse("Archivo demasiado grande", status_code=413)
+    return await call_next(request)
 
 
-@app.post("/transcripcion_archivo", response_class=HTMLResponse)
-async def transcripcion_archivo(request: Request, archivo_audio: UploadFile = File(...)):
-    # Guardo el archivo en una ubicación (la raiz del directorio actual) temporal
-    localizacion_archivo = f"uploads/{archivo_audio.filename}"
+# Responder a un envío con el identificador de la tarea encolada: a los clientes que piden JSON se les devuelve
+# directamente y al navegador se le redirige a la página de "Procesando", que sigue el estado de la tarea
+def respuesta_tarea(request: Request, task_id: str):
+    if "application/json" in request.headers.get("accept", ""):
+        return JSONResponse({"task_id": task_id}, status_code=202)
+    return RedirectResponse(f"/procesando?task_id={task_id}", status_code=303)
 
-    with open(localizacion_archivo, "wb+") as file_object:
-        file_object.write(await archivo_audio.read())
 
-    # Obtener el nombre del archivo y su formato
-    nombre_archivo = archivo_audio.filename.split(".")
+# Generar una línea JSON por cada evento de la tarea (cambios de estado y segmentos con sus marcas de tiempo en cuanto
+# se decodifican) y, al terminar, una última con el resultado completo, que incluye el tiempo hasta el primer segmento
+async def lineas_tarea(task_id):
+    result = AsyncResult(task_id, app=celery_app)
+    async for evento in escuchar(task_id):
+        if evento is None:
+            if not result.ready():
+                continue
+            evento = {"tipo": "fin" if result.successful() else "error"}
+        if evento["tipo"] == "fin":
+            evento["resultado"] = almacen.obtener(task_id)
+        yield json.dumps(evento) + "\n"
+        if evento["tipo"] in ("fin", "error"):
+            return
 
-    # Guardar el tiempo de inicio
-    tiempo_inicio = int(time.time())
 
-    # Encolar la tarea de procesamiento
-    task = procesar_archivo.delay(localizacion_archivo)
-    task_id = task.id
+# Instantes (de reloj de pared, porque se comparan en el worker) en que empezó la petición y en que se encola su
+# tarea, para medir la espera en la cola y el tiempo total de la petición, subida incluida
+def marcas_tiempo(inicio_peticion):
+    return {"inicio_peticion": inicio_peticion, "encolado": time.time()}
 
-    # Obtener los resultados de la transcripción desde la variable global
-    resultados = task.get()
 
-    # Guardar el tiempo de finalización
-    tiempo_final = int(time.time())
+# Argumentos de la tarea: las marcas de tiempo y las opciones de la transcripción elegidas en el formulario (ver
+# perfiles.py)
+def argumentos_tarea(inicio_peticion, opciones):
+    return {**marcas_tiempo(inicio_peticion), "opciones": opciones}
 
-    # Calcular el tiempo de transcripción en segundos
-    tiempo_transcripcion = tiempo_final - tiempo_inicio
 
-    # Renderizar la página de "Resultados"
-    return templates.TemplateResponse("resultados.html",
-                                      {"request": request, "nombreArchivo": nombre_archivo[0],
-                                                      "formato": nombre_archivo[1], "idioma": resultados["idioma"],
-                                                      "transcripcion": resultados['transcripcion'],
-                                       "tiempoTranscripcion": tiempo_transcripcion})
+@app.post("/transcripcion_grabacion")
+async def transcripcion_grabacion(request: Request, audiograbado: UploadFile = File(...), modelo: str = Form(""),
+                                  perfil: str = Form(""), idioma: str = Form(""), palabras: bool = Form(False)):
+    tamano = tamano_solicitado(modelo)
+    # Las grabaciones del micrófono son notas de voz cortas: si no eligen perfil, van por el rápido
+    opciones = opciones_transcripcion(perfil, idioma, palabras, por_defecto=PERFIL_GRABACIONES)
 
+    # Copiar el archivo por trozos a un temporal con nombre único, sin cargarlo entero en memoria
+    inicio_peticion, inicio = time.time(), time.perf_counter()
+    localizacion_archivo = await asyncio.to_thread(guardar_subida, audiograbado.file, audiograbado.filename)
+    observar("whisper_etapa_segundos", time.perf_counter() - inicio, etapa="subida")
 
-@app.post("/transcripcion_video", response_class=HTMLResponse)
-async def transcripcion_video(request: Request, url: str = Form(...)):
-    # Configuración de yt-dlp
-    ydl_opts = {
-        "format": "bestaudio/best",
-        "outtmpl": "audio.%(ext)s",
-        "postprocessors": [{
-            "key": "FFmpegExtractAudio",
-            "preferredcodec": "mp3",
-            "preferredquality": "192",
-        }],
-    }
+    # Obtener el nombre del archivo y su formato
+    nombre_archivo = audiograbado.filename.split(".")
 
-    # Descarga el audio del video
-    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-        ydl.download([url])
+    # Encolar la tarea de procesamiento y responder sin esperar a que termine. Las grabaciones van a su propia cola,
+    # para no esperar detrás de los archivos y los vídeos
+    task = celery_app.send_task("worker.procesar_archivo",
+                                args=[localizacion_archivo, nombre_archivo[0], nombre_archivo[-1], tamano],
+                                kwargs=argumentos_tarea(inicio_peticion, opciones), queue=COLA_GRABACIONES)
+    return respuesta_tarea(request, task.id)
 
-    # Obtiene el título del video
-    with yt_dlp.YoutubeDL() as ydl:
-        info = ydl.extract_info(url, download=False)
-        title = info.get("title", None)
 
-    # Guardar el tiempo de inicio
-    tiempo_inicio = int(time.time())
+@app.post("/transcripcion_archivo")
+async def transcripcion_archivo(request: Request, archivo_audio: UploadFile = File(...), streaming: bool = Form(False),
+                                modelo: str = Form(""), perfil: str = Form(""), idioma: str = Form(""),
+                                palabras: bool = Form(False)):
+    tamano = tamano_solicitado(modelo)
+    opciones = opciones_transcripcion(perfil, idioma, palabras)
 
-    # Encolar la tarea de procesamiento
-    task = procesar_archivo.delay("audio.mp3")
-    task_id = task.id
+    # Copiar el archivo por trozos a un temporal con nombre único, sin cargarlo entero en memoria
+    inicio_peticion, inicio = time.time(), time.perf_counter()
+    localizacion_archivo = await asyncio.to_thread(guardar_subida, archivo_audio.file, archivo_audio.filename)
+    observar("whisper_etapa_segundos", time.perf_counter() - inicio, etapa="subida")
 
-    # Obtener los resultados de la transcripción desde la variable global
-    resultados = task.get()
+    # Obtener el nombre del archivo y su formato
+    nombre_archivo = archivo_audio.filename.split(".")
 
-    # Guardar el tiempo de finalización
-    tiempo_final = int(time.time())
+    # Encolar la tarea de procesamiento y responder sin esperar a que termine. Si se pide, se responde en streaming
+    # con los eventos de la tarea, segmento a segmento
+    task = celery_app.send_task("worker.procesar_archivo",
+                                args=[localizacion_archivo, nombre_archivo[0], nombre_archivo[-1], tamano],
+                                kwargs=argumentos_tarea(inicio_peticion, opciones))
+    if streaming:
+        return StreamingResponse(lineas_tarea(task.id), media_type="application/x-ndjson")
+    return respuesta_tarea(request, task.id)
 
-    # Calcular el tiempo de transcripción en segundos
-    tiempo_transcripcion = tiempo_final - tiempo_inicio
 
-    # Renderizar la página de "Resultados"
-    return templates.TemplateResponse("resultados.html",
-                                      {"request": request, "nombreArchivo": title,
-                                                      "formato": "mp3", "idioma": resultados["idioma"],
-                                                      "transcripcion": resultados['transcripcion'],
-                                       "tiempoTranscripcion": tiempo_transcripcion})
+@app.post("/transcripcion_video")
+async def transcripcion_video(request: Request, url: str = Form(...), modelo: str = Form(""),
+                              perfil: str = Form(""), idioma: str = Form(""), palabras: bool = Form(False)):
+    # Encolar la descarga y la transcripción del vídeo y responder sin esperar a que terminen
+    task = celery_app.send_task("worker.procesar_video", args=[url, tamano_solicitado(modelo)],
+                                kwargs=argumentos_tarea(time.time(), opciones_transcripcion(perfil, idioma, palabras)))
+    return respuesta_tarea(request, task.id)
 
 
-@app.get("/procesando")
+@app.get("/procesando", response_class=HTMLResponse)
 async def show_procesando(request: Request, task_id: str):
     return templates.TemplateResponse("procesando.html", {"request": request, "task_id": task_id})
 
 
-@app.post("/resultados")
-async def get_results(request: Request, localizacion_archivo: str):
-    # Obtener los resultados de la transcripción desde la variable global
-    resultados = transcription_results.get(localizacion_archivo)
-
-    if resultados:
-        nombreArchivo = localizacion_archivo
-        idioma = resultados["idioma"]
-        transcripcion = resultados["transcripcion"]
-    else:
-        nombreArchivo = "No disponible"
-        idioma = "No disponible"
-        transcripcion = "No disponible"
-
-    # Renderizar la página de "Resultados"
-    return templates.TemplateResponse("resultados.html", {"request": request, "nombreArchivo": nombreArchivo, "idioma": idioma, "transcripcion": transcripcion})
+@app.get("/resultados", response_class=HTMLResponse)
+async def get_results(request: Request, task_id: str):
+    # Obtener el estado de la tarea del backend de Celery y sus resultados del almacén
+    result = AsyncResult(task_id, app=celery_app)
+
+    if result.successful():
+        resultados = almacen.obtener(task_id)
+        if resultados is None:
+            # El resultado ya caducó
+            return templates.TemplateResponse("error.html", {"request": request}, status_code=404)
+        # Renderizar la página de "Resultados"
+        return templates.TemplateResponse("resultados.html",
+                                          {"request": request, "nombreArchivo": resultados["nombreArchivo"],
+                                           "formato": resultados["formato"], "idioma": resultados["idioma"],
+                                           "transcripcion": resultados["transcripcion"],
+                                           "tiempoTranscripcion": resultados["tiempoTranscripcion"],
+                                           "tiemposEtapas": resultados["tiempos"], "rtf": resultados.get("rtf"),
+                                           "modelo": resultados.get("modelo"), "task_id": task_id,
+                                           "idiomaFijado": resultados.get("idiomaFijado", False),
+                                           "descargas": {formato: f"/resultados/{task_id}/subtitulos.{formato}"
+                                                         for formato in FORMATOS}})
+
+    if result.failed():
+        return templates.TemplateResponse("error.html", {"request": request}, status_code=500)
+
+    # Si la tarea no ha terminado, volver a la página de "Procesando"
+    return RedirectResponse(f"/procesando?task_id={task_id}", status_code=303)
+
+
+@app.get("/resultados/{task_id}/transcripcion")
+async def get_transcripcion(task_id: str):
+    # Devolver el texto de la transcripción terminada en trozos, sin renderizar ninguna plantilla
+    result = AsyncResult(task_id, app=celery_app)
+    if not result.successful():
+        return JSONResponse({"status": result.status}, status_code=404 if result.failed() else 202)
+    resultados = almacen.obtener(task_id)
+    if resultados is None:
+        return JSONResponse({"status": "EXPIRED"}, status_code=404)
+
+    transcripcion = resultados["transcripcion"]
+
+    def trozos(tamano=64 * 1024):
+        for inicio in range(0, len(transcripcion), tamano):
+            yield transcripcion[inicio:inicio + tamano]
+
+    return StreamingResponse(trozos(), media_type="text/plain; charset=utf-8")
+
+
+# Descargar los segmentos de la transcripción terminada como subtítulos (srt, vtt) o en JSON, con las marcas de tiempo
+# de cada palabra si se pidieron. Se generan a partir de los segmentos guardados, sin volver a pasar por el modelo
+@app.get("/resultados/{task_id}/subtitulos.{formato}")
+async def get_subtitulos(task_id: str, formato: str):
+    if formato not in FORMATOS:
+        return JSONResponse({"error": f"Formato no disponible: {formato}"}, status_code=404)
+    result = AsyncResult(task_id, app=celery_app)
+    if not result.successful():
+        return JSONResponse({"status": result.status}, status_code=404 if result.failed() else 202)
+    resultados = almacen.obtener(task_id)
+    if resultados is None:
+        return JSONResponse({"status": "EXPIRED"}, status_code=404)
+
+    texto, tipo = exportar(resultados.get("segmentos", []), formato)
+    # El nombre del archivo (el título de un vídeo, por ejemplo) puede no ser ASCII, así que va codificado
+    nombre = quote(f"{resultados['nombreArchivo']}.{formato}")
+    return Response(texto, media_type=tipo, headers={"Content-Disposition": f"attachment; filename*=UTF-8''{nombre}"})
+
+
+# Canal de eventos enviados por el servidor (SSE) con el progreso de la tarea: cambios de estado, segmentos según se
+# decodifican y el aviso de fin o de error. Sustituye a la consulta periódica del estado desde la página de "Procesando"
+@app.get("/eventos/{task_id}")
+async def get_eventos(task_id: str):
+    result = AsyncResult(task_id, app=celery_app)
+
+    def formatear(evento):
+        return f"event: {evento['tipo']}\ndata: {json.dumps(evento)}\n\n"
+
+    async def eventos():
+        async for evento in escuchar(task_id):
+            if evento is not None:
+                yield formatear(evento)
+            elif result.ready():
+                # La tarea terminó sin que llegase su evento de fin (por ejemplo, antes de suscribirse)
+                yield formatear({"tipo": "fin" if result.successful() else "error"})
+                return
+            else:
+                # Comentario para mantener viva la conexión
+                yield ": \n\n"
+
+    # Si la tarea ya terminó no hace falta suscribirse
+    if result.ready():
+        return StreamingResponse(iter([formatear({"tipo": "fin" if result.successful() else "error"})]),
+                                 media_type="text/event-stream")
+    return StreamingResponse(eventos(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
 
 
 @app.get("/taskstatus")
 def get_task_status(task_id: str):
-    # Obtener estado de la tarea Celery
-    result = procesar_archivo.AsyncResult(task_id)
-    return {"status": result.status}
-
-
-# La función se ejecutará una vez que la aplicación FastAPI se haya iniciado
-# y establecerá la configuración de Celery indicada
-@app.on_event("startup")
-async def startup_event():
-    celery_app.conf.task_routes = {'worker.transcribe_file': {'queue': 'transcription_queue'}}
-    celery_app.conf.task_default_queue = 'default'
-    celery_app.conf.worker_prefetch_multiplier = 1
+    # Obtener estado de la tarea Celery y, mientras se procesa, la etapa en curso y la fracción completada
+    result = AsyncResult(task_id, app=celery_app)
+    estado = {"status": result.status}
+    if result.status == "PROGRESS" and isinstance(result.info, dict):
+        estado.update(result.info)
+    return estado
+
+
+# Aciertos y fallos de la caché de resultados, sumados los de todos los workers
+@app.get("/estado_cache")
+def estado_cache():
+    return cache.metricas()
+
+
+# Modelos cargados en cada proceso de los workers, memoria que ocupan y últimas cargas y expulsiones
+@app.get("/estado_modelos")
+def estado_modelos():
+    procesos = {clave.decode().split(":", 2)[2]: json.loads(estado)
+                for clave in conexion.scan_iter("modelos:estado:*")
+                if (estado := conexion.get(clave)) is not None}
+    eventos = [json.loads(evento) for evento in conexion.lrange("modelos:eventos", 0, -1)]
+    return {"procesos": procesos, "eventos": eventos}
+
+
+# Réplicas del modelo (una por proceso de los workers, identificada por la máquina y el proceso): dispositivo,
+# núcleos, trabajos en curso y ocupación de cada una
+def replicas():
+    return [json.loads(estado) for clave in conexion.scan_iter("replicas:estado:*")
+            if (estado := conexion.get(clave)) is not None]
+
+
+@app.get("/estado_replicas")
+def estado_replicas():
+    return {"replicas": replicas()}
+
+
+# Métricas de la API y de todos los workers en el formato de Prometheus. La profundidad de cada cola es la longitud
+# de su lista en el broker
+@app.get("/metrics")
+def metrics():
+    return PlainTextResponse(exponer({**medidores_colas(profundidad_colas(celery_app)),
+                                      **medidores_replicas(replicas())}),
+                             media_type=TIPO_CONTENIDO)
+
+
+# Lotes lanzados desde esta API, por identificador. Cada uno se coordina en un hilo propio, que encola sus archivos
+# en los workers y escribe los resultados en su directorio de salida
+lotes = {}
+
+
+# Transcribir por lotes los audios de un directorio o de un manifiesto que estén en un directorio compartido con los
+# workers (ver lotes.py). El origen y la salida son relativos a DIRECTORIO_LOTES y no pueden salir de él. Si el mismo
+# lote ya está en curso se devuelve su estado; si se interrumpió o terminó con errores, se continúa saltando los
+# archivos que ya están en la salida
+@app.post("/lotes")
+async def crear_lote(origen: str = Form(...), salida: str = Form(...), modelo: str = Form("")):
+    tamano = tamano_solicitado(modelo)
+    try:
+        origen, salida = ruta_lote(origen), ruta_lote(salida)
+    except ValueError as e:
+        return PlainTextResponse(str(e), status_code=400)
+    try:
+        archivos = await asyncio.to_thread(archivos_lote, origen, DIRECTORIO_LOTES)
+    except (OSError, ValueError) as e:
+        return PlainTextResponse(f"No se puede leer el lote: {e}", status_code=400)
+
+    lote = await asyncio.to_thread(Lote, archivos, salida, tamano)
+    if lote.id not in lotes or lotes[lote.id].terminado():
+        lotes[lote.id] = lote
+        threading.Thread(target=lote.ejecutar, args=(celery_app,), name=f"lote-{lote.id}", daemon=True).start()
+    return JSONResponse(lotes[lote.id].estado(), status_code=202)
+
+
+# Progreso de un lote y rendimiento conjunto: archivos y segundos de audio transcritos por segundo
+@app.get("/lotes/{lote_id}")
+def estado_lote(lote_id: str):
+    if lote_id not in lotes:
+        return PlainTextResponse("Lote no encontrado", status_code=404)
+    return lotes[lote_id].estado()
+
 
 # Para ejecutarlo en local y depurarlo
 if __name__ == "__main__":
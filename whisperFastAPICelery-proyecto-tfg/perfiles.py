@@ -0,0 +1,60 @@
+import os
+
+from idiomas import CODIGOS_POR_NOMBRE, NOMBRES_IDIOMAS
+
+# Perfiles de decodificación que se pueden elegir en cada petición. Cada uno es un conjunto de opciones de
+# generar_segmentos (ver transcripcion.py), que forman parte de la clave de la caché:
+# - rapido: decodificación voraz a temperatura 0, sin reintentos a temperaturas mayores cuando la decodificación sale
+#   repetitiva o poco probable. Es el de las grabaciones del micrófono, que son cortas y quieren la respuesta cuanto
+#   antes. Si IDIOMA_PERFIL_RAPIDO indica un idioma, lo fija y se ahorra la detección; si no, el idioma se detecta
+#   como en los demás perfiles, para no transcribir en un idioma equivocado el audio de quien habla otro
+# - equilibrado: las opciones de whisper.transcribe (voraz, con los reintentos a temperaturas mayores)
+# - preciso: búsqueda en haz de 5 hipótesis y, en los reintentos, 5 candidatos por temperatura
+# En CPU todos decodifican en fp32 (generar_segmentos solo usa fp16 en GPU). El backend de JAX tiene su propio
+# pipeline, que solo recibe el idioma
+IDIOMA_RAPIDO = os.environ.get("IDIOMA_PERFIL_RAPIDO", "")
+
+PERFILES = {
+    "rapido": {"temperatura": 0.0, **({"language": IDIOMA_RAPIDO} if IDIOMA_RAPIDO else {})},
+    "equilibrado": {},
+    "preciso": {"beam_size": 5, "best_of": 5},
+}
+
+# Perfil de las peticiones que no eligen ninguno y el de las grabaciones del micrófono
+PERFIL_POR_DEFECTO = os.environ.get("PERFIL_DECODIFICACION", "equilibrado")
+PERFIL_GRABACIONES = os.environ.get("PERFIL_GRABACIONES", "rapido")
+
+
+class PerfilNoDisponible(Exception):
+    def __init__(self, valor):
+        super().__init__(f"Perfil o idioma no disponible: {valor}. Perfiles: {', '.join(PERFILES)}")
+        self.valor = valor
+
+
+# Opciones de decodificación del perfil elegido en una petición (o del indicado en por_defecto, si no elige ninguno).
+# Si la petición indica el idioma del audio (su código o su nombre en inglés), se fija ese en cualquier perfil
+def opciones_perfil(perfil=None, idioma=None, por_defecto=PERFIL_POR_DEFECTO):
+    perfil = perfil or por_defecto
+    if perfil not in PERFILES:
+        raise PerfilNoDisponible(perfil)
+    opciones = dict(PERFILES[perfil])
+    if idioma:
+        codigo = CODIGOS_POR_NOMBRE.get(idioma.lower(), idioma.lower())
+        if codigo not in NOMBRES_IDIOMAS:
+            raise PerfilNoDisponible(idioma)
+        opciones["language"] = codigo
+    return opciones
+
+
+# Si las opciones de una transcripción fijan el idioma, que entonces no se detecta en el audio
+def idioma_fijado(opciones):
+    return "language" in opciones
+
+
+# Opciones de la transcripción de una petición: las de su perfil y, con palabras, la alineación de cada palabra con el
+# audio, para exportarla con sus marcas de tiempo
+def opciones_transcripcion(perfil=None, idioma=None, palabras=False, por_defecto=PERFIL_POR_DEFECTO):
+    opciones = opciones_perfil(perfil, idioma, por_defecto)
+    if palabras:
+        opciones["palabras"] = True
+    return opciones
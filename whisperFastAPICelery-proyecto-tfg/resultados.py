@@ -0,0 +1,47 @@
+import json
+import os
+import zlib
+
+# Almacén de los resultados de las tareas de transcripción en Redis. Cada resultado se guarda en una sola clave,
+# resultado:<tarea>, como JSON compacto comprimido con zlib (el texto y los segmentos de una transcripción larga se
+# quedan en una fracción de su tamaño), y caduca a los CADUCIDAD_RESULTADOS segundos, de modo que la memoria que
+# ocupan queda acotada aunque nadie los lea. Se leen con un solo GET, sin pasar por el backend de Celery, que de las
+# tareas con eventos solo guarda su estado y la clave del resultado (ver TareaConEventos en worker.py).
+# La conexión se recibe de fuera: la API y los workers usan la de eventos.py, con su grupo de conexiones compartido
+# entre hilos, y para probarlo basta con cualquier cliente compatible con el de Redis
+CADUCIDAD_RESULTADOS = int(os.environ.get("CADUCIDAD_RESULTADOS", str(24 * 3600)))
+
+# Nivel de compresión de zlib: el 6 comprime casi como el 9 en bastante menos tiempo
+NIVEL_COMPRESION = 6
+
+
+def clave_resultado(task_id):
+    return f"resultado:{task_id}"
+
+
+def serializar(resultado):
+    texto = json.dumps(resultado, ensure_ascii=False, separators=(",", ":"))
+    return zlib.compress(texto.encode("utf-8"), NIVEL_COMPRESION)
+
+
+def deserializar(datos):
+    return json.loads(zlib.decompress(datos).decode("utf-8"))
+
+
+class AlmacenResultados:
+
+    def __init__(self, conexion, caducidad=CADUCIDAD_RESULTADOS):
+        self.conexion = conexion
+        self.caducidad = caducidad
+
+    # Guardar el resultado de una tarea con su caducidad. Con pipe, la escritura se añade a esa tubería para que se
+    # envíe junto con otras en la misma ida y vuelta a Redis
+    def guardar(self, task_id, resultado, pipe=None):
+        destino = self.conexion if pipe is None else pipe
+        destino.set(clave_resultado(task_id), serializar(resultado), ex=self.caducidad)
+
+    # Resultado de una tarea, o None si no existe o ya caducó
+    def obtener(self, task_id):
+        datos = self.conexion.get(clave_resultado(task_id))
+        return deserializar(datos) if datos is not None else None
+
@@ -0,0 +1,48 @@
+import os
+import tempfile
+
+# Tamaño máximo de un archivo subido, en bytes, y tamaño de los trozos en que se copia. Así la memoria usada por cada
+# subida en curso no depende del tamaño del archivo
+TAMANO_MAXIMO_SUBIDA = int(os.environ.get("TAMANO_MAXIMO_SUBIDA", str(100 * 1024 * 1024)))
+TAMANO_TROZO = 1024 * 1024
+
+# Tamaño máximo de la petición completa: el archivo más un margen para el resto del formulario. Las peticiones que
+# declaran un Content-Length mayor se rechazan antes de leer el cuerpo
+TAMANO_MAXIMO_PETICION = TAMANO_MAXIMO_SUBIDA + 64 * 1024
+
+# Directorio donde se guardan las subidas mientras se transcriben. Si la API y quien transcribe son procesos o
+# contenedores distintos, tiene que ser un directorio compartido
+DIRECTORIO_SUBIDAS = os.environ.get("DIRECTORIO_SUBIDAS", tempfile.gettempdir())
+os.makedirs(DIRECTORIO_SUBIDAS, exist_ok=True)
+
+
+# Excepción que se lanza cuando una subida supera el tamaño máximo
+class ArchivoDemasiadoGrande(Exception):
+    def __init__(self, limite):
+        super().__init__(f"El archivo supera el tamaño máximo de {limite} bytes")
+        self.limite = limite
+
+
+# Crear un archivo temporal con nombre único, conservando solo la extensión del nombre que envía el cliente
+def crear_temporal(nombre_cliente):
+    extension = os.path.splitext(os.path.basename(nombre_cliente or ""))[1].lower()
+    descriptor, localizacion_archivo = tempfile.mkstemp(prefix="subida-", suffix=extension, dir=DIRECTORIO_SUBIDAS)
+    return os.fdopen(descriptor, "wb"), localizacion_archivo
+
+
+# Copiar por trozos un archivo subido (cualquier objeto con read(n)) a un archivo temporal, comprobando el límite
+# según se copia. Devuelve la localización del temporal, que se borra si la subida es demasiado grande
+def guardar_subida(origen, nombre_cliente, limite=TAMANO_MAXIMO_SUBIDA):
+    destino, localizacion_archivo = crear_temporal(nombre_cliente)
+    try:
+        with destino:
+            copiados = 0
+            while trozo := origen.read(TAMANO_TROZO):
+                copiados += len(trozo)
+                if copiados > limite:
+                    raise ArchivoDemasiadoGrande(limite)
+                destino.write(trozo)
+    except BaseException:
+        os.remove(localizacion_archivo)
+        raise
+    return localizacion_archivo
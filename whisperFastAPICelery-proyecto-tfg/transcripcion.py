@@ -0,0 +1,452 @@
+import contextlib
+import functools
+import math
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+import whisper
+from whisper.audio import HOP_LENGTH, N_FRAMES, N_SAMPLES, SAMPLE_RATE
+from whisper.timing import add_word_timestamps
+from whisper.tokenizer import get_tokenizer
+from whisper.utils import exact_div
+
+from espectrograma import log_mel, log_mel_lote, ventana_mel
+from fragmentos import dividir_en_fragmentos, es_audio_largo
+from metricas import registrar_transcripcion
+
+# Temperaturas de respaldo que usa whisper.transcribe cuando una decodificación sale repetitiva o poco probable
+TEMPERATURAS = (0.0, 0.2, 0.4, 0.6, 0.8, 1.0)
+
+
+# Decodificar el archivo una única vez con ffmpeg a un buffer float32 mono de 16 kHz
+def cargar_audio(localizacion_archivo):
+    return whisper.load_audio(localizacion_archivo)  # str, bytes or os.PathLike
+
+
+# Hacer el espectrograma log-Mel del audio completo directamente en el dispositivo del modelo
+def calcular_mel(model, audio):
+    return log_mel(audio, model.device, model.dims.n_mels)
+
+
+# Marcas de tiempo de cada palabra de los segmentos de una ventana, alineando con el modelo los tokens ya decodificados
+# (una pasada más del decodificador sobre ellos, no otra decodificación). Con un agrupador delante, la alineación se
+# hace en su hilo (ver AgrupadorLotes.alinear_palabras)
+def alinear_palabras(model, segmentos, tokenizer, mel, num_tramas, ultimo_fin_voz):
+    opciones = {"segments": segmentos, "tokenizer": tokenizer, "num_frames": num_tramas,
+                "last_speech_timestamp": ultimo_fin_voz}
+    if hasattr(model, "alinear_palabras"):
+        model.alinear_palabras(mel, opciones)
+    else:
+        add_word_timestamps(model=model, mel=mel, **opciones)
+
+
+# Detectar el idioma hablado con la primera ventana de 30 segundos del espectrograma ya calculado
+def detectar_idioma(model, mel):
+    segmento = ventana_mel(mel)
+    _, probs = model.detect_language(segmento)
+    return max(probs, key=probs.get)
+
+
+# Modelo fijo para todo un trabajo: una referencia perezosa del registro se resuelve una sola vez y no se expulsa
+# hasta que termina el bloque with (ver registro.usar); cualquier otro modelo se usa tal cual
+def fijar_modelo(model):
+    if hasattr(type(model), "reservar"):
+        return model.reservar()
+    return contextlib.nullcontext(model)
+
+
+# Detectar el idioma con los primeros 30 segundos de voz de un audio ya dividido en fragmentos
+def detectar_idioma_voz(model, audio, fragmentos):
+    inicio_voz = fragmentos[0][0] if fragmentos else 0
+    with fijar_modelo(model) as model:
+        return detectar_idioma(model, calcular_mel(model, audio[inicio_voz:inicio_voz + N_SAMPLES]))
+
+
+# Bucle de decodificación equivalente al de whisper.transcribe, pero partiendo del espectrograma y del idioma
+# ya obtenidos, de modo que no se vuelve a lanzar ffmpeg ni a detectar el idioma. Es un generador que entrega cada
+# segmento en cuanto termina la ventana de 30 segundos que lo contiene.
+# model puede ser el propio modelo o un AgrupadorLotes delante de él. Si el agrupador forma lotes no se condiciona
+# cada ventana al texto anterior salvo que se pida, porque solo se agrupan ventanas con el mismo prompt
+# Si se indica progreso, se llama con la fracción del audio ya decodificada tras cada ventana.
+# Cada segmento lleva su confianza: la probabilidad media de los tokens de su ventana (la exponencial de su logprob
+# media) o, con palabras, la media de las probabilidades de sus palabras, que se alinean ventana a ventana con los
+# tokens decodificados. La alineación no cambia los cortes de los segmentos, solo ajusta sus extremos a las palabras
+def generar_segmentos(model, mel, idioma, tarea="transcribe", temperatura=TEMPERATURAS, umbral_compresion=2.4,
+                      umbral_logprob=-1.0, umbral_silencio=0.6, condicionar_texto_previo=None, progreso=None,
+                      palabras=False, **opciones_decodificacion):
+    if condicionar_texto_previo is None:
+        condicionar_texto_previo = getattr(model, "lote_maximo", 1) <= 1
+
+    # En CPU no se puede usar fp16
+    fp16 = opciones_decodificacion.pop("fp16", model.device != torch.device("cpu"))
+    if model.device == torch.device("cpu"):
+        fp16 = False
+    dtype = torch.float16 if fp16 else torch.float32
+    # El espectrograma se convierte una sola vez, y no ventana a ventana
+    mel = mel.to(dtype)
+
+    tokenizer = get_tokenizer(model.is_multilingual, num_languages=model.num_languages, language=idioma, task=tarea)
+    temperaturas = [temperatura] if isinstance(temperatura, (int, float)) else temperatura
+
+    def decodificar_con_respaldo(segmento, prompt):
+        resultado = None
+        for t in temperaturas:
+            kwargs = {**opciones_decodificacion}
+            if t > 0:
+                # Con temperatura mayor que 0 no se usa búsqueda en haz
+                kwargs.pop("beam_size", None)
+                kwargs.pop("patience", None)
+            else:
+                kwargs.pop("best_of", None)
+
+            opciones = whisper.DecodingOptions(task=tarea, language=idioma, temperature=t, fp16=fp16,
+                                               prompt=prompt, **kwargs)
+            resultado = model.decode(segmento, opciones)
+
+            necesita_respaldo = False
+            if umbral_compresion is not None and resultado.compression_ratio > umbral_compresion:
+                necesita_respaldo = True  # demasiado repetitivo
+            if umbral_logprob is not None and resultado.avg_logprob < umbral_logprob:
+                necesita_respaldo = True  # probabilidad media demasiado baja
+
+            if not necesita_respaldo:
+                break
+
+        return resultado
+
+    seek = 0
+    input_stride = exact_div(N_FRAMES, model.dims.n_audio_ctx)  # tramas mel por token de salida: 2
+    precision_tiempo = input_stride * HOP_LENGTH / SAMPLE_RATE  # segundos por token de salida: 0.02
+    todos_tokens = []
+    num_segmentos = 0
+    inicio_prompt = 0
+    num_tramas = mel.shape[-1]
+    ultimo_fin_voz = 0.0
+
+    def crear_segmento(inicio, fin, tokens_texto, resultado):
+        texto = tokenizer.decode([token for token in tokens_texto if token < tokenizer.eot])
+        if len(texto.strip()) == 0:
+            return None
+        return {
+            "id": None,
+            "seek": seek,
+            "start": inicio,
+            "end": fin,
+            "text": texto,
+            "tokens": tokens_texto.tolist(),
+            "temperature": resultado.temperature,
+            "avg_logprob": resultado.avg_logprob,
+            "compression_ratio": resultado.compression_ratio,
+            "no_speech_prob": resultado.no_speech_prob,
+            "confianza": math.exp(resultado.avg_logprob),
+        }
+
+    while seek < num_tramas:
+        desplazamiento = float(seek * HOP_LENGTH / SAMPLE_RATE)
+        # Las ventanas son vistas del espectrograma completo, sin volver a calcularlo ni copiarlo
+        segmento = ventana_mel(mel, seek)
+        # La ventana está rellenada hasta N_FRAMES, pero la última del audio dura menos: su duración es la de sus
+        # tramas reales, para que ningún segmento termine después del audio
+        tramas_ventana = min(N_FRAMES, num_tramas - seek)
+        duracion_segmento = tramas_ventana * HOP_LENGTH / SAMPLE_RATE
+
+        resultado = decodificar_con_respaldo(segmento, todos_tokens[inicio_prompt:])
+        tokens = torch.tensor(resultado.tokens)
+
+        # Saltar las ventanas sin voz
+        if umbral_silencio is not None:
+            saltar = resultado.no_speech_prob > umbral_silencio
+            if umbral_logprob is not None and resultado.avg_logprob > umbral_logprob:
+                saltar = False
+            if saltar:
+                seek += tramas_ventana
+                if progreso is not None:
+                    progreso("decodificacion", min(seek, num_tramas) / num_tramas)
+                continue
+
+        nuevos = []
+        tokens_tiempo = tokens.ge(tokenizer.timestamp_begin)
+        consecutivos = torch.where(tokens_tiempo[:-1] & tokens_tiempo[1:])[0].add_(1)
+        if len(consecutivos) > 0:
+            # La salida contiene marcas de tiempo consecutivas: se divide en varios segmentos
+            ultimo_corte = 0
+            for corte in consecutivos:
+                tokens_cortados = tokens[ultimo_corte:corte]
+                posicion_inicio = tokens_cortados[0].item() - tokenizer.timestamp_begin
+                posicion_fin = tokens_cortados[-1].item() - tokenizer.timestamp_begin
+                nuevos.append(crear_segmento(desplazamiento + posicion_inicio * precision_tiempo,
+                                             desplazamiento + posicion_fin * precision_tiempo,
+                                             tokens_cortados[1:-1], resultado))
+                ultimo_corte = corte
+            ultima_posicion = tokens[ultimo_corte - 1].item() - tokenizer.timestamp_begin
+            seek += ultima_posicion * input_stride
+            todos_tokens.extend(tokens[: ultimo_corte + 1].tolist())
+        else:
+            duracion = duracion_segmento
+            marcas = tokens[tokens_tiempo.nonzero().flatten()]
+            if len(marcas) > 0 and marcas[-1].item() != tokenizer.timestamp_begin:
+                duracion = (marcas[-1].item() - tokenizer.timestamp_begin) * precision_tiempo
+            nuevos.append(crear_segmento(desplazamiento, desplazamiento + duracion, tokens, resultado))
+            seek += tramas_ventana
+            todos_tokens.extend(tokens.tolist())
+
+        nuevos = [nuevo for nuevo in nuevos if nuevo is not None]
+        if palabras and nuevos:
+            alinear_palabras(model, nuevos, tokenizer, segmento, tramas_ventana, ultimo_fin_voz)
+            for nuevo in nuevos:
+                nuevo["palabras"] = nuevo.pop("words")
+                if nuevo["palabras"]:
+                    probabilidades = [palabra["probability"] for palabra in nuevo["palabras"]]
+                    nuevo["confianza"] = sum(probabilidades) / len(probabilidades)
+                    ultimo_fin_voz = nuevo["end"]
+
+        if not condicionar_texto_previo or resultado.temperature > 0.5:
+            inicio_prompt = len(todos_tokens)
+
+        if progreso is not None:
+            progreso("decodificacion", min(seek, num_tramas) / num_tramas)
+
+        for nuevo in nuevos:
+            nuevo["id"] = num_segmentos
+            num_segmentos += 1
+            yield nuevo
+
+
+# Transcribir un fragmento del audio y llevar las marcas de tiempo de sus segmentos a su posición en el audio completo.
+# Si su espectrograma ya está calculado se puede pasar en mel
+def transcribir_fragmento(model, fragmento, desplazamiento, idioma, mel=None, **opciones_decodificacion):
+    with fijar_modelo(model) as model:
+        mel = calcular_mel(model, fragmento) if mel is None else mel.to(model.device)
+        segmentos = list(generar_segmentos(model, mel, idioma, **opciones_decodificacion))
+    for segmento in segmentos:
+        segmento["start"] += desplazamiento
+        segmento["end"] += desplazamiento
+        for palabra in segmento.get("palabras", ()):
+            palabra["start"] += desplazamiento
+            palabra["end"] += desplazamiento
+    return segmentos
+
+
+# Repartidor de fragmentos entre las réplicas de un planificador: se llama con una función (modelo, fragmento) y la
+# lista de fragmentos, y los transcribe en paralelo, cada uno en la réplica con menos trabajos en curso en ese momento,
+# devolviendo los resultados en orden. Hay tantos hilos como trabajos caben en el planificador, de modo que las
+# ventanas de varios fragmentos pueden ir en el mismo lote de una réplica
+class RepartidorFragmentos:
+
+    def __init__(self, planificador, hilos=None, tamano=None):
+        self.planificador = planificador
+        self.hilos = hilos or ThreadPoolExecutor(max_workers=planificador.capacidad(),
+                                                 thread_name_prefix="fragmentos")
+        self.tamano = tamano
+
+    # El mismo reparto, con los mismos hilos, para otro tamaño de modelo
+    def variante(self, tamano):
+        return RepartidorFragmentos(self.planificador, self.hilos, tamano)
+
+    def _transcribir(self, funcion, fragmento):
+        with self.planificador.reservar(self.tamano) as modelo:
+            return funcion(modelo, fragmento)
+
+    def __call__(self, funcion, fragmentos):
+        return self.hilos.map(functools.partial(self._transcribir, funcion), fragmentos)
+
+
+# Pipeline completo en streaming: una sola decodificación del archivo, un solo espectrograma y una sola detección de
+# idioma, entregando eventos según se producen: {"tipo": "idioma"} al conocer el idioma, {"tipo": "segmento"} con
+# cada segmento decodificado y {"tipo": "fin"} con la duración del audio y el tiempo de cada etapa, incluido el tiempo
+# hasta el primer segmento. Si se indica progreso, se llama con el nombre y la fracción completada de la etapa en curso.
+# Si se indica una caché, se busca antes el resultado por el contenido del archivo, el modelo y las opciones; si está,
+# se entregan los mismos eventos sin pasar por el modelo, y si no, se guarda al terminar. En los dos casos el evento de
+# fin lleva la clave del resultado en la caché, con la que se puede volver a consultar (por ejemplo, para exportarlo).
+# Si el audio ya está decodificado se puede pasar en audio. Si se indica un repartidor y el audio es largo, se divide
+# por los silencios en fragmentos de voz que se transcriben en paralelo (ver transcribir_por_fragmentos).
+# Si la petición elige un tamaño de modelo, se usa esa variante del modelo (y del repartidor) en lugar del de la
+# configuración
+def transcribir_en_streaming(model, localizacion_archivo, progreso=None, cache=None, audio=None, repartir=None,
+                             tamano=None, **opciones_decodificacion):
+    if tamano is not None:
+        model = model.variante(tamano)
+        repartir = repartir.variante(tamano) if repartir is not None else None
+
+    if cache is not None:
+        inicio = time.perf_counter()
+        clave = cache.clave_archivo(localizacion_archivo, opciones_decodificacion, model.nombre)
+        resultado = cache.obtener(clave)
+        if resultado is not None:
+            for evento in eventos_resultado(resultado, {"consulta_cache": time.perf_counter() - inicio}):
+                if evento["tipo"] == "fin":
+                    registrar_transcripcion(evento)
+                    evento["clave"] = clave
+                yield evento
+            return
+
+        segmentos = []
+        for evento in transcribir_en_streaming(model, localizacion_archivo, progreso, audio=audio, repartir=repartir,
+                                               **opciones_decodificacion):
+            if evento["tipo"] == "segmento":
+                segmentos.append(evento["segmento"])
+            elif evento["tipo"] == "fin":
+                cache.guardar(clave, resultado_transcripcion(segmentos, evento))
+                evento["clave"] = clave
+            yield evento
+        return
+
+    tiempos = {}
+    inicio_total = time.perf_counter()
+
+    def etapa(nombre):
+        if progreso is not None:
+            progreso(nombre, 0.0)
+        return time.perf_counter()
+
+    inicio = etapa("carga_audio")
+    if audio is None:
+        audio = cargar_audio(localizacion_archivo)
+    tiempos["carga_audio"] = time.perf_counter() - inicio
+
+    # El modelo se resuelve una sola vez y se mantiene hasta el último segmento
+    with fijar_modelo(model) as model:
+        if hasattr(model, "transcribir_audio"):
+            eventos = transcribir_con_pipeline(model, audio, tiempos, etapa, **opciones_decodificacion)
+        elif repartir is not None and es_audio_largo(audio):
+            eventos = transcribir_por_fragmentos(model, audio, repartir, tiempos, etapa, progreso,
+                                                 **opciones_decodificacion)
+        else:
+            eventos = transcribir_secuencial(model, audio, tiempos, etapa, progreso, **opciones_decodificacion)
+
+        for evento in eventos:
+            if evento["tipo"] == "idioma":
+                idioma = evento["idioma"]
+            elif "primer_segmento" not in tiempos:
+                tiempos["primer_segmento"] = time.perf_counter() - inicio_total
+            yield evento
+
+    duracion_audio = len(audio) / SAMPLE_RATE
+    fin = {"tipo": "fin", "idioma": idioma, "duracion_audio": duracion_audio, "tiempos": tiempos,
+           "rtf": factor_tiempo_real(time.perf_counter() - inicio_total, duracion_audio)}
+    # Las métricas de las etapas se registran al terminar, cuando ya se conocen todos los tiempos
+    registrar_transcripcion(fin)
+    yield fin
+
+
+# Factor de tiempo real: segundos de proceso por segundo de audio. Por debajo de 1 se transcribe más rápido que el
+# tiempo real
+def factor_tiempo_real(segundos, duracion_audio):
+    return segundos / duracion_audio if duracion_audio else 0.0
+
+
+# Transcribir con un backend que trae su propio pipeline (el de JAX, ver backends.py): recibe el audio completo y
+# devuelve el idioma y los segmentos, que se entregan con los mismos eventos que el resto de backends
+def transcribir_con_pipeline(model, audio, tiempos, etapa, language=None, tarea="transcribe", **opciones):
+    inicio = etapa("pipeline")
+    idioma, segmentos = model.transcribir_audio(audio, idioma=language, tarea=tarea)
+    tiempos["pipeline"] = time.perf_counter() - inicio
+
+    yield {"tipo": "idioma", "idioma": idioma}
+    for segmento in segmentos:
+        yield {"tipo": "segmento", "segmento": segmento}
+
+
+# Transcribir el audio completo ventana a ventana, entregando el idioma y cada segmento según se decodifica
+def transcribir_secuencial(model, audio, tiempos, etapa, progreso, **opciones_decodificacion):
+    inicio = etapa("mel")
+    mel = calcular_mel(model, audio)
+    tiempos["mel"] = time.perf_counter() - inicio
+
+    inicio = etapa("deteccion_idioma")
+    idioma = opciones_decodificacion.pop("language", None) or detectar_idioma(model, mel)
+    tiempos["deteccion_idioma"] = time.perf_counter() - inicio
+    yield {"tipo": "idioma", "idioma": idioma}
+
+    inicio = etapa("decodificacion")
+    for segmento in generar_segmentos(model, mel, idioma, progreso=progreso, **opciones_decodificacion):
+        yield {"tipo": "segmento", "segmento": segmento}
+    tiempos["bucle_decodificacion"] = time.perf_counter() - inicio
+
+
+# Modo para audios largos: el detector de voz divide el audio por los silencios en fragmentos, descartando los tramos
+# sin voz, y los fragmentos se transcriben en paralelo con el repartidor. En GPU los espectrogramas de todos los
+# fragmentos se calculan antes juntos, por lotes; en CPU el lote no sale más rápido (ver benchmark_mel.py), así que
+# cada fragmento calcula el suyo en su hilo, en paralelo con los demás. El idioma se detecta con el primer fragmento
+# con voz. Los segmentos se entregan en orden, fragmento a fragmento, con sus marcas de tiempo en el audio completo
+def transcribir_por_fragmentos(model, audio, repartir, tiempos, etapa, progreso, **opciones_decodificacion):
+    inicio = etapa("deteccion_voz")
+    fragmentos = dividir_en_fragmentos(audio)
+    tiempos["deteccion_voz"] = time.perf_counter() - inicio
+
+    mels = [None] * len(fragmentos)
+    if model.device.type == "cuda":
+        inicio = etapa("mel")
+        mels = log_mel_lote([audio[inicio_fragmento:fin_fragmento] for inicio_fragmento, fin_fragmento in fragmentos],
+                            model.device, model.dims.n_mels)
+        tiempos["mel"] = time.perf_counter() - inicio
+
+    inicio = etapa("deteccion_idioma")
+    idioma = opciones_decodificacion.pop("language", None) or detectar_idioma_voz(model, audio, fragmentos)
+    tiempos["deteccion_idioma"] = time.perf_counter() - inicio
+    yield {"tipo": "idioma", "idioma": idioma}
+
+    def transcribir(modelo, fragmento):
+        (inicio_fragmento, fin_fragmento), mel = fragmento
+        return transcribir_fragmento(modelo, audio[inicio_fragmento:fin_fragmento], inicio_fragmento / SAMPLE_RATE,
+                                     idioma, mel=mel, **opciones_decodificacion)
+
+    inicio = etapa("fragmentos")
+    num_segmentos = 0
+    for completados, segmentos in enumerate(repartir(transcribir, list(zip(fragmentos, mels))), start=1):
+        for segmento in segmentos:
+            segmento["id"] = num_segmentos
+            num_segmentos += 1
+            yield {"tipo": "segmento", "segmento": segmento}
+        if progreso is not None:
+            progreso("fragmentos", completados / len(fragmentos))
+    tiempos["fragmentos"] = time.perf_counter() - inicio
+
+
+# Campos de un segmento que se envían a los clientes mientras se transcribe y que se exportan (ver subtitulos.py): sus
+# marcas de tiempo, su texto y, si los tiene, su confianza y sus palabras
+def segmento_publico(segmento):
+    campos = ("id", "start", "end", "text", "confianza", "palabras")
+    return {campo: segmento[campo] for campo in campos if campo in segmento}
+
+
+# Resultado final de una transcripción a partir de sus segmentos y del evento de fin
+def resultado_transcripcion(segmentos, fin):
+    return {
+        "idioma": fin["idioma"],
+        "texto": "".join(segmento["text"] for segmento in segmentos),
+        "segmentos": segmentos,
+        "duracion_audio": fin["duracion_audio"],
+        "tiempos": fin["tiempos"],
+        "rtf": fin["rtf"],
+    }
+
+
+# Eventos de streaming de un resultado ya terminado (por ejemplo, uno guardado en la caché), con los tiempos indicados
+def eventos_resultado(resultado, tiempos):
+    yield {"tipo": "idioma", "idioma": resultado["idioma"]}
+    for segmento in resultado["segmentos"]:
+        yield {"tipo": "segmento", "segmento": segmento}
+    yield {"tipo": "fin", "idioma": resultado["idioma"], "duracion_audio": resultado["duracion_audio"],
+           "tiempos": tiempos, "rtf": factor_tiempo_real(sum(tiempos.values()), resultado["duracion_audio"])}
+
+
+# Pipeline completo esperando al final. Si se indica al_segmento, se llama con cada segmento decodificado. Con caché, el
+# resultado lleva su clave en ella
+def transcribir_archivo(model, localizacion_archivo, progreso=None, al_segmento=None, cache=None, audio=None,
+                        repartir=None, tamano=None, **opciones_decodificacion):
+    segmentos = []
+    for evento in transcribir_en_streaming(model, localizacion_archivo, progreso=progreso, cache=cache, audio=audio,
+                                           repartir=repartir, tamano=tamano, **opciones_decodificacion):
+        if evento["tipo"] == "segmento":
+            segmentos.append(evento["segmento"])
+            if al_segmento is not None:
+                al_segmento(evento["segmento"])
+        elif evento["tipo"] == "fin":
+            fin = evento
+
+    resultado = resultado_transcripcion(segmentos, fin)
+    if "clave" in fin:
+        resultado["clave"] = fin["clave"]
+    return resultado
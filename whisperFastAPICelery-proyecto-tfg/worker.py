@@ -1,52 +1,381 @@
-from celery import Celery
-import whisper
-import torch
+from celery import chord
+from celery.signals import (task_postrun, task_prerun, worker_init, worker_process_init, worker_process_shutdown,
+                            worker_shutdown)
+from billiard.process import current_process
+import json
+import numpy as np
 import os
-from whisper.tokenizer import LANGUAGES
-from deep_translator import GoogleTranslator
+import socket
+import time
+from idiomas import nombre_idioma
 from fastapi.templating import Jinja2Templates
+from transcripcion import (cargar_audio, detectar_idioma_voz, factor_tiempo_real, fijar_modelo, segmento_publico,
+                           transcribir_archivo, transcribir_fragmento)
+from fragmentos import FRECUENCIA_MUESTREO, dividir_en_fragmentos, es_audio_largo
+from subidas import crear_temporal
+from descargas import descargar_audio
+from eventos import REDIS_URL, conexion, publicar
+from resultados import AlmacenResultados, clave_resultado
+from cache import crear_cache
+from backends import nombre_modelo
+from perfiles import idioma_fijado
+import registro
+from registro import precargar
+from planificador import planificador_proceso
+from colas import COLA_ARCHIVOS, crear_celery
+import metricas
+from metricas import observar, registrar_transcripcion, sumar_indicador
 
-celery_app = Celery('worker', broker='redis://localhost:6379/0', backend='redis://localhost:6379/0')
+# Colas, confirmación al terminar, prefetch 1 y autoescalado por la profundidad de las colas (ver colas.py)
+celery_app = crear_celery('worker')
 
-# Comprobar si hay disponible una GPU NVIDIA
-torch.cuda.is_available()
-device = "cuda" if torch.cuda.is_available() else "cpu"
+# Modelo Whisper con el backend y el tamaño de la configuración (por defecto, PyTorch y el modelo de tamaño medio,
+# lento, pero preciso en idiomas diferentes al inglés). Se usa a través del agrupador de lotes, que junta las ventanas
+# de las peticiones concurrentes en una sola pasada del modelo. No se carga al importar el módulo, sino al arrancar el
+# worker o con la primera tarea. Cada tarea puede elegir otro de los tamaños disponibles, que el registro carga en el
+# worker que la atienda al pedirlo por primera vez.
+# Cada proceso del worker es una réplica: Celery ya manda cada tarea a un proceso libre, así que el planificador del
+# proceso solo elige su dispositivo (las GPU por turno entre los procesos, o la CPU si no hay CUDA), le fija su bloque
+# de núcleos si hay varios procesos en CPU y lleva la cuenta de su ocupación. Hasta que se crean los procesos hijos
+# (o si el worker no los crea, con --pool=solo) hay un solo proceso, con el primer dispositivo
+planificador = planificador_proceso(0, 1)
+model = planificador.replicas[0]
 
-# Cargar el modelo Whisper. Inicializar el modelo de tamaño medio, lento, pero preciso en idiomas diferentes al inglés,
-# moviéndolo a GPU si CUDA está disponible
-model = whisper.load_model("medium").to(device)
+# Procesos hijos del worker, para repartir entre ellos los dispositivos y los núcleos. Con --autoscale, los que puede
+# llegar a tener
+procesos = 1
+
+
+# En CPU, cargar los pesos en el proceso principal del worker antes de crear los procesos hijos: los comparten por
+# copia en escritura en lugar de cargar cada uno su copia. En GPU cada proceso necesita su propio contexto de CUDA,
+# así que se cargan en cada hijo al crearlo
+@worker_init.connect
+def precargar_modelo(sender=None, **kwargs):
+    global procesos
+    if sender is not None:
+        # --autoscale llega como (máximo, mínimo)
+        autoescalado = sender.options.get("autoscale")
+        procesos = autoescalado[0] if autoescalado else sender.concurrency
+    if model.dispositivo == "cpu":
+        precargar(dispositivo=model.dispositivo)
+
+
+# Al crear cada proceso hijo (también los que añade el autoescalado), darle su réplica según su número dentro del
+# worker y cargar en ella el modelo antes de que reciba tareas, para que la primera no espere a la carga y la memoria
+# de cada proceso sea la misma desde el principio
+@worker_process_init.connect
+def asignar_replica(**kwargs):
+    global planificador, model
+    planificador = planificador_proceso(current_process().index, procesos)
+    model = planificador.replicas[0]
+    model.cargar()
+
+
+# Los modelos están en los workers, no en la API: cada proceso guarda en Redis los modelos que tiene cargados después
+# de cada carga o expulsión, y las últimas cargas y expulsiones de todos en una lista, para que la API pueda mostrarlos
+def clave_estado_modelos():
+    return f"modelos:estado:{socket.gethostname()}:{os.getpid()}"
+
+
+def publicar_estado_modelos(evento):
+    with conexion.pipeline() as pipe:
+        pipe.lpush("modelos:eventos", json.dumps(evento))
+        pipe.ltrim("modelos:eventos", 0, 99)
+        pipe.set(clave_estado_modelos(), json.dumps(registro.estado()))
+        pipe.execute()
+
+
+registro.suscribir(publicar_estado_modelos)
+
+
+# Cada proceso guarda también en Redis el estado de su réplica al empezar y al terminar cada tarea, identificada por
+# la máquina y el proceso
+def clave_estado_replica():
+    return f"replicas:estado:{socket.gethostname()}:{os.getpid()}"
+
+
+def publicar_estado_replica():
+    replica = planificador.estado()["replicas"][0]
+    replica["replica"] = f"{socket.gethostname()}:{os.getpid()}"
+    conexion.set(clave_estado_replica(), json.dumps(replica))
+
+
+# Tareas en ejecución en todos los workers y en cada réplica
+@task_prerun.connect
+def empezar_tarea(**kwargs):
+    sumar_indicador("whisper_trabajos_en_curso")
+    planificador.asignar()
+    publicar_estado_replica()
+
+
+@task_postrun.connect
+def terminar_tarea(**kwargs):
+    sumar_indicador("whisper_trabajos_en_curso", -1)
+    planificador.liberar(0)
+    publicar_estado_replica()
+
+
+# Al terminar un proceso sus modelos dejan de estar cargados y su réplica desaparece
+@worker_shutdown.connect
+@worker_process_shutdown.connect
+def borrar_estado_modelos(**kwargs):
+    conexion.delete(clave_estado_modelos(), clave_estado_replica())
+
+# Caché de resultados por contenido del audio, modelo y opciones. Se guarda en el Redis de Celery para que la
+# compartan todos los workers
+cache = crear_cache(nombre_modelo(), os.environ.get("CACHE_URL", REDIS_URL))
+
+# Métricas en el Redis de Celery, para que la API exponga las de todos los workers
+metricas.configurar(os.environ.get("METRICAS_URL", REDIS_URL))
 
 # Configuración de Jinja2Templates
 templates = Jinja2Templates(directory="templates")
 
-# Variable global para almacenar los resultados de transcripción
-transcription_results = {}
+# Resultados de las tareas, en el Redis de los eventos (ver resultados.py)
+almacen = AlmacenResultados(conexion)
+
+
+# Transcribir un archivo ya guardado publicando el progreso en la tarea indicada (estado PROGRESS con la etapa en
+# curso, la fracción completada, los segmentos ya decodificados y el tiempo hasta el primero), para que la API pueda
+# consultarlo sin esperar al resultado. Los cambios de estado y cada segmento decodificado se publican además en Redis
+# para enviarlos a la página de "Procesando".
+# El resultado se busca antes en la caché y, si no está, se guarda en ella bajo el contenido del archivo y, si se
+# indica, también bajo clave_url. Los audios largos no se transcriben aquí: la tarea se sustituye por las de sus
+# fragmentos, que se reparten entre los workers (ver transcribir_por_fragmentos). Si la tarea elige un tamaño de
+# modelo, se usa ese en lugar del de la configuración, y las opciones de la transcripción (las del perfil de
+# decodificación y, si se piden, las marcas de tiempo de cada palabra; ver perfiles.py) forman parte de la clave de la
+# caché.
+# El tiempo de transcripción se cuenta desde inicio_peticion, que la API toma antes de recibir la subida, de modo que
+# incluye la subida y la espera en la cola. Como se mide entre procesos, se usa el reloj de pared
+def transcribir(tarea, localizacion_archivo, nombre_archivo, formato, clave_url=None, tamano=None,
+                inicio_peticion=None, opciones=None):
+    task_id = tarea.request.id
+    opciones = opciones or {}
+    modelo = model.variante(tamano)
+    estado = {"etapa": None, "progreso": 0.0, "segmentos": []}
+
+    # Guardar el tiempo de inicio
+    tiempo_inicio = inicio_peticion or time.time()
+    inicio_tarea = time.perf_counter()
+
+    def progreso(etapa, fraccion):
+        estado.update(etapa=etapa, progreso=fraccion)
+        tarea.update_state(state="PROGRESS", meta=estado)
+        publicar(task_id, "estado", etapa=etapa, progreso=fraccion)
+
+    def al_segmento(segmento):
+        segmento = segmento_publico(segmento)
+        if not estado["segmentos"]:
+            estado["tiempo_primer_segmento"] = time.perf_counter() - inicio_tarea
+        estado["segmentos"].append(segmento)
+        tarea.update_state(state="PROGRESS", meta=estado)
+        publicar(task_id, "segmento", **segmento)
+
+    # Decodificar el audio una sola vez y reutilizarlo, junto con su espectrograma log-Mel y el idioma detectado,
+    # en toda la transcripción, salvo que el resultado ya esté en la caché
+    try:
+        clave = cache.clave_archivo(localizacion_archivo, opciones, modelo=modelo.nombre)
+        resultado = cache.obtener(clave)
+        if resultado is not None:
+            resultado["tiempos"] = {"consulta_cache": time.perf_counter() - inicio_tarea}
+            resultado["rtf"] = factor_tiempo_real(resultado["tiempos"]["consulta_cache"], resultado["duracion_audio"])
+            registrar_transcripcion(resultado)
+            for segmento in resultado["segmentos"]:
+                al_segmento(segmento)
+        else:
+            progreso("carga_audio", 0.0)
+            inicio = time.perf_counter()
+            audio = cargar_audio(localizacion_archivo)
+            carga_audio = time.perf_counter() - inicio
+            # El modelo se resuelve una sola vez para toda la tarea. El backend de JAX tiene su propio pipeline y no se
+            # divide en fragmentos
+            with fijar_modelo(modelo) as modelo_tarea:
+                if es_audio_largo(audio) and not hasattr(modelo_tarea, "transcribir_audio"):
+                    raise tarea.replace(transcribir_por_fragmentos(tarea, audio, [clave, clave_url], nombre_archivo,
+                                                                   formato, tiempo_inicio, tamano, carga_audio,
+                                                                   opciones))
+                resultado = transcribir_archivo(modelo_tarea, localizacion_archivo, progreso=progreso,
+                                                al_segmento=al_segmento, audio=audio, **opciones)
+            cache.guardar(clave, resultado)
+    finally:
+        # Eliminar el archivo después de usar Whisper
+        os.remove(localizacion_archivo)
+
+    # Devolver los resultados, que se guardan en el almacén de resultados
+    resultado = resultado_tarea(resultado, nombre_archivo, formato, tiempo_inicio, tamano, idioma_fijado(opciones))
+    if clave_url is not None:
+        cache.guardar(clave_url, resultado)
+    return resultado
+
+
+# Resultado de una tarea de transcripción a partir del de la transcripción, con los segmentos para exportarlos y si
+# el idioma estaba fijado en las opciones o se detectó
+def resultado_tarea(resultado, nombre_archivo, formato, tiempo_inicio, tamano=None, fijado=False):
+    # Obtener el nombre del idioma detectado a partir de la tabla local, sin llamadas a red
+    idioma_detectado = nombre_idioma(resultado["idioma"])
+
+    # Calcular el tiempo de transcripción en segundos
+    tiempo_transcripcion = time.time() - tiempo_inicio
+
+    return {"nombreArchivo": nombre_archivo, "formato": formato, "transcripcion": resultado["texto"],
+            "idioma": idioma_detectado, "tiempos": resultado["tiempos"], "tiempoTranscripcion": tiempo_transcripcion,
+            "rtf": resultado["rtf"], "modelo": nombre_modelo(tamano), "idiomaFijado": fijado,
+            "segmentos": [segmento_publico(segmento) for segmento in resultado["segmentos"]]}
+
+
+# Modo para audios largos: el detector de voz divide el audio por los silencios en fragmentos, descartando los tramos
+# sin voz, y cada fragmento se guarda en el directorio de subidas compartido y se transcribe en una tarea propia, de
+# modo que los fragmentos se reparten entre todos los workers. Una tarea final une los segmentos en orden. Devuelve el
+# chord que sustituye a la tarea; la tarea final hereda su identificador, así que la API sigue consultando el mismo.
+# Los fragmentos y la unión van a la misma cola que la tarea, para no adelantar a los trabajos de otras colas
+def transcribir_por_fragmentos(tarea, audio, claves, nombre_archivo, formato, tiempo_inicio, tamano=None,
+                               carga_audio=0.0, opciones=None):
+    task_id = tarea.request.id
+    cola = (tarea.request.delivery_info or {}).get("routing_key") or COLA_ARCHIVOS
+    tiempos = {"carga_audio": carga_audio}
+
+    inicio = time.perf_counter()
+    fragmentos = dividir_en_fragmentos(audio)
+    tiempos["deteccion_voz"] = time.perf_counter() - inicio
+
+    # Si las opciones fijan el idioma (ver perfiles.py), no se detecta
+    inicio = time.perf_counter()
+    opciones = dict(opciones or {})
+    fijado = idioma_fijado(opciones)
+    idioma = opciones.pop("language", None) or detectar_idioma_voz(model.variante(tamano), audio, fragmentos)
+    tiempos["deteccion_idioma"] = time.perf_counter() - inicio
+
+    tarea.update_state(state="PROGRESS", meta={"etapa": "fragmentos", "progreso": 0.0, "segmentos": []})
+    publicar(task_id, "estado", etapa="fragmentos", progreso=0.0)
+
+    tareas_fragmentos = []
+    for inicio_fragmento, fin_fragmento in fragmentos:
+        archivo, localizacion_fragmento = crear_temporal("fragmento.npy")
+        with archivo:
+            np.save(archivo, audio[inicio_fragmento:fin_fragmento])
+        tareas_fragmentos.append(procesar_fragmento.s(localizacion_fragmento, inicio_fragmento / FRECUENCIA_MUESTREO,
+                                                      idioma, task_id, len(fragmentos), tamano,
+                                                      opciones).set(queue=cola))
+
+    # Los fragmentos pueden ejecutarse en otras máquinas, así que su duración se mide con el reloj de pared
+    union = unir_fragmentos.s(claves, nombre_archivo, formato, idioma, len(audio) / FRECUENCIA_MUESTREO, tiempos,
+                              tiempo_inicio, time.time(), tamano, fijado).set(queue=cola)
+    if not tareas_fragmentos:
+        return union.clone(args=([],))
+    return chord(tareas_fragmentos, union)
+
+
+# Transcribir uno de los fragmentos de un audio largo y publicar cuántos fragmentos de la tarea van terminados
+@celery_app.task
+def procesar_fragmento(localizacion_fragmento, desplazamiento, idioma, task_id, num_fragmentos, tamano=None,
+                       opciones=None):
+    try:
+        fragmento = np.load(localizacion_fragmento)
+    finally:
+        os.remove(localizacion_fragmento)
+    segmentos = [segmento_publico(segmento)
+                 for segmento in transcribir_fragmento(model.variante(tamano), fragmento, desplazamiento, idioma,
+                                                       **(opciones or {}))]
+
+    completados = conexion.incr(f"tarea:{task_id}:fragmentos")
+    conexion.expire(f"tarea:{task_id}:fragmentos", 3600)
+    publicar(task_id, "estado", etapa="fragmentos", progreso=completados / num_fragmentos)
+    return segmentos
+
+
+# Tarea cuyo resultado se guarda en el almacén de resultados, comprimido y con caducidad, antes de que el backend de
+# Celery la dé por terminada; el backend guarda solo la clave del resultado. Al terminar se avisa del fin o del error
+# cuando su estado ya está guardado en el backend, para que la página de "Procesando" pueda redirigir a los resultados
+# sin encontrarlos aún pendientes
+class TareaConEventos(celery_app.Task):
+    def __call__(self, *args, **kwargs):
+        resultado = super().__call__(*args, **kwargs)
+        task_id = self.request.id
+        with conexion.pipeline(transaction=False) as pipe:
+            almacen.guardar(task_id, resultado, pipe)
+            # El contador de fragmentos ya no hace falta
+            pipe.delete(f"tarea:{task_id}:fragmentos")
+            pipe.execute()
+        return {"resultado": clave_resultado(task_id)}
+
+    def after_return(self, status, retval, task_id, args, kwargs, einfo):
+        # Una tarea sustituida por las de sus fragmentos aún no ha terminado
+        if status in ("SUCCESS", "FAILURE"):
+            publicar(task_id, "fin" if status == "SUCCESS" else "error")
+
+
+# Unir los segmentos de los fragmentos de un audio largo, en orden, publicarlos y guardar el resultado en la caché.
+# Se ejecuta con el identificador de la tarea sustituida, así que su resultado es el de esa tarea
+@celery_app.task(bind=True, base=TareaConEventos)
+def unir_fragmentos(self, resultados, claves, nombre_archivo, formato, idioma, duracion_audio, tiempos, tiempo_inicio,
+                    inicio_fragmentos, tamano=None, fijado=False):
+    segmentos = []
+    for segmento in (segmento for segmentos_fragmento in resultados for segmento in segmentos_fragmento):
+        segmento["id"] = len(segmentos)
+        segmentos.append(segmento)
+        publicar(self.request.id, "segmento", **segmento)
+
+    tiempos["fragmentos"] = time.time() - inicio_fragmentos
+    resultado = {"idioma": idioma, "texto": "".join(segmento["text"] for segmento in segmentos),
+                 "segmentos": segmentos, "duracion_audio": duracion_audio, "tiempos": tiempos,
+                 "rtf": factor_tiempo_real(sum(tiempos.values()), duracion_audio)}
+    registrar_transcripcion(resultado)
+
+    clave_archivo, clave_url = claves
+    cache.guardar(clave_archivo, resultado)
+    resultado = resultado_tarea(resultado, nombre_archivo, formato, tiempo_inicio, tamano, fijado)
+    if clave_url is not None:
+        cache.guardar(clave_url, resultado)
+    return resultado
+
+
+# Registrar el tiempo que la tarea esperó en la cola desde que la API la encoló
+def espera_cola(encolado):
+    if encolado is not None:
+        observar("whisper_etapa_segundos", max(0.0, time.time() - encolado), etapa="espera_cola")
+
+
+@celery_app.task(bind=True, base=TareaConEventos)
+def procesar_archivo(self, localizacion_archivo, nombre_archivo=None, formato=None, tamano=None, inicio_peticion=None,
+                     encolado=None, opciones=None):
+    espera_cola(encolado)
+    return transcribir(self, localizacion_archivo, nombre_archivo or localizacion_archivo, formato, tamano=tamano,
+                       inicio_peticion=inicio_peticion, opciones=opciones)
+
+
+# Descargar el audio de un vídeo y transcribirlo. La descarga se hace en el worker para que la API responda en cuanto
+# encola la tarea
+@celery_app.task(bind=True, base=TareaConEventos)
+def procesar_video(self, url, tamano=None, inicio_peticion=None, encolado=None, opciones=None):
+    espera_cola(encolado)
+
+    # Si el vídeo ya se transcribió con el mismo modelo, devolver el resultado sin volver a descargarlo
+    inicio_consulta = time.perf_counter()
+    clave = cache.clave_url(url, opciones, modelo=nombre_modelo(tamano))
+    resultado = cache.obtener(clave)
+    if resultado is not None:
+        return {**resultado, "tiempos": {"consulta_cache": time.perf_counter() - inicio_consulta},
+                "tiempoTranscripcion": 0}
+
+    self.update_state(state="PROGRESS", meta={"etapa": "descarga", "progreso": 0.0})
+    publicar(self.request.id, "estado", etapa="descarga", progreso=0.0)
+
+    # Descarga el audio del video y obtiene su título con una sola llamada a yt-dlp
+    inicio = time.perf_counter()
+    localizacion_archivo, title, formato = descargar_audio(url)
+    observar("whisper_etapa_segundos", time.perf_counter() - inicio, etapa="descarga")
+
+    # Guardar también el resultado bajo la URL del vídeo
+    return transcribir(self, localizacion_archivo, title, formato, clave_url=clave, tamano=tamano,
+                       inicio_peticion=inicio_peticion, opciones=opciones)
 
 
+# Transcribir un archivo de un lote (ver lotes.py) y devolver el resultado con los segmentos que necesitan los
+# subtítulos. El archivo es del usuario, así que no se borra, y no se divide en fragmentos: el lote ya reparte sus
+# archivos entre los workers
 @celery_app.task
-def procesar_archivo(localizacion_archivo):
-    # Cargar audio y rellenarlo/recortarlo para que se ajuste a trozos de 30 segundos
-    audio = whisper.load_audio(localizacion_archivo)  # str, bytes or os.PathLike
-    audio = whisper.pad_or_trim(audio)
-    # Hacer un espectrograma log-Mel y pasar al mismo dispositivo que el modelo
-    mel = whisper.log_mel_spectrogram(audio).to(model.device)
-
-    # Detectar el idioma hablado
-    _, probs = model.detect_language(mel)
-    traductor = GoogleTranslator(source='auto', target='es')
-    idioma_detectado = traductor.translate(LANGUAGES[max(probs, key=probs.get)].title())
-
-    # Decodificamos el audio
-    # options = whisper.DecodingOptions(fp16 = False)
-    # transcripcion = whisper.decode(model, mel, options)
-    transcripcion = model.transcribe(localizacion_archivo)
-
-    # Eliminar el archivo después de usar Whisper
-    os.remove(localizacion_archivo)
-
-    # Almacenar los resultados en la variable global
-    resultados = {"nombreArchivo": localizacion_archivo, "transcripcion": transcripcion['text'], "idioma": idioma_detectado}
-
-    # Redirigir a la página de resultados en la misma pestaña
-    url = f"/resultados?localizacion_archivo={localizacion_archivo}"
-    return resultados
\ No newline at end of file
+def transcribir_archivo_lote(localizacion_archivo, tamano=None, encolado=None):
+    espera_cola(encolado)
+    resultado = transcribir_archivo(model, localizacion_archivo, cache=cache, tamano=tamano)
+    resultado["segmentos"] = [segmento_publico(segmento) for segmento in resultado["segmentos"]]
+    return resultado
@@ -0,0 +1,215 @@
+import os
+import time
+
+# Backend de inferencia y tamaño del modelo, elegidos por configuración:
+#   - torch: el modelo de PyTorch tal cual (fp32 en CPU, fp16 en GPU)
+#   - torch_int8: el modelo de PyTorch con las capas lineales cuantizadas dinámicamente a int8, solo en CPU
+#   - jax: el pipeline de Whisper JAX
+BACKEND = os.environ.get("BACKEND", "torch")
+TAMANO_MODELO = os.environ.get("TAMANO_MODELO", "medium")
+# Tamaños de modelo que se pueden elegir en cada petición, además del de la configuración
+MODELOS_DISPONIBLES = os.environ.get("MODELOS_DISPONIBLES", "tiny,base,small,medium,large-v2").split(",")
+
+# Tipo de los pesos y de las activaciones del modelo de JAX (float32, float16 o bfloat16). Con auto, media precisión
+# donde el hardware la acelera (float16 en GPU, bfloat16 en TPU) y float32 en CPU, donde XLA la emula y va más lenta
+JAX_DTYPE = os.environ.get("JAX_DTYPE", "auto")
+
+# Ventanas de 30 segundos que el pipeline de JAX transcribe juntas en cada pasada del modelo. El pipeline completa
+# cada lote con ventanas vacías hasta este tamaño, así que en CPU conviene 1 por dispositivo, para que una grabación
+# corta no pague las vacías; con auto son 8 por dispositivo en GPU y TPU y 1 en CPU. Se redondea a un múltiplo de
+# los dispositivos, entre los que se reparte el lote
+JAX_BATCH_SIZE = os.environ.get("JAX_BATCH_SIZE", "auto")
+
+# Millones de parámetros de cada tamaño de Whisper, para estimar la memoria de un modelo antes de cargarlo
+MILLONES_PARAMETROS = {"tiny": 39, "base": 74, "small": 244, "medium": 769, "large": 1550}
+
+# Frecuencia de muestreo del audio y muestras de una ventana de 30 segundos
+FRECUENCIA_MUESTREO = 16000
+MUESTRAS_VENTANA = 30 * FRECUENCIA_MUESTREO
+
+
+# Excepción que se lanza cuando una petición elige un modelo que no está entre los disponibles
+class ModeloNoDisponible(Exception):
+    def __init__(self, tamano):
+        super().__init__(f"Modelo no disponible: {tamano}. Disponibles: {', '.join(MODELOS_DISPONIBLES)}")
+        self.tamano = tamano
+
+
+# Nombre con el que se identifica un modelo cargado (en la caché de resultados, en las métricas...)
+def nombre_modelo(tamano=None, backend=None):
+    return f"{backend or BACKEND}-{tamano or TAMANO_MODELO}"
+
+
+# Tamaño de modelo elegido en una petición. Si no se elige ninguno se devuelve None, que es el de la configuración
+def tamano_solicitado(valor):
+    if not valor or valor == TAMANO_MODELO:
+        return None
+    if valor not in MODELOS_DISPONIBLES:
+        raise ModeloNoDisponible(valor)
+    return valor
+
+
+# Memoria estimada en bytes de un modelo aún sin cargar: sus parámetros en float32
+def memoria_estimada(tamano=None):
+    tamano = (tamano or TAMANO_MODELO).split(".")[0].split("-")[0]
+    return MILLONES_PARAMETROS.get(tamano, 0) * 4 * 10 ** 6
+
+
+# Memoria en bytes que ocupan los pesos de un modelo cargado. En los modelos cuantizados los pesos de las capas
+# lineales están empaquetados y no aparecen entre los parámetros, pero sí en el state_dict
+def memoria_modelo(model):
+    if hasattr(model, "memoria"):
+        return model.memoria()
+
+    import torch
+
+    total = 0
+    for valor in model.state_dict().values():
+        for tensor in (valor if isinstance(valor, tuple) else (valor,)):
+            if isinstance(tensor, torch.Tensor):
+                total += tensor.numel() * tensor.element_size()
+    return total
+
+
+def cargar_torch(tamano, dispositivo):
+    import whisper
+
+    return whisper.load_model(tamano, device=dispositivo)
+
+
+# Cuantización dinámica: los pesos de las capas lineales se guardan en int8 y las activaciones se cuantizan al vuelo.
+# Whisper usa su propia subclase de Linear, que quantize_dynamic no reconoce, así que antes se convierten en
+# torch.nn.Linear (en CPU no hace falta la conversión de tipos que añade la subclase)
+def cargar_torch_int8(tamano, dispositivo):
+    import torch
+    import whisper
+
+    if dispositivo != "cpu":
+        raise ValueError("El backend torch_int8 solo puede usarse en CPU")
+
+    model = whisper.load_model(tamano, device="cpu")
+    for modulo in model.modules():
+        if isinstance(modulo, whisper.model.Linear):
+            modulo.__class__ = torch.nn.Linear
+    return torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+
+
+def cargar_jax(tamano, dispositivo):
+    return ModeloJax(tamano)
+
+
+CARGADORES = {"torch": cargar_torch, "torch_int8": cargar_torch_int8, "jax": cargar_jax}
+
+
+# Cargar el modelo del backend y tamaño indicados (por defecto, los de la configuración). Los modelos de PyTorch se
+# usan con el pipeline de transcripcion.py; el de JAX trae su propio pipeline y se usa a través de transcribir_audio
+def cargar_modelo(tamano=None, backend=None, dispositivo="cpu"):
+    backend = backend or BACKEND
+    if backend not in CARGADORES:
+        raise ValueError(f"Backend desconocido: {backend}. Disponibles: {', '.join(CARGADORES)}")
+    model = CARGADORES[backend](tamano or TAMANO_MODELO, dispositivo)
+    model.backend = backend
+    model.nombre = nombre_modelo(tamano, backend)
+    return model
+
+
+# Tipo y tamaño del lote del modelo de JAX en la plataforma indicada (cpu, gpu o tpu), según la configuración
+def tipo_jax(plataforma):
+    if JAX_DTYPE != "auto":
+        return JAX_DTYPE
+    return {"gpu": "float16", "tpu": "bfloat16"}.get(plataforma, "float32")
+
+
+def lote_jax(plataforma, dispositivos):
+    lote = (1 if plataforma == "cpu" else 8) * dispositivos if JAX_BATCH_SIZE == "auto" else int(JAX_BATCH_SIZE)
+    return max(dispositivos, -(-lote // dispositivos) * dispositivos)
+
+
+# Modelo de Whisper JAX con la misma interfaz que usan los servicios para los backends con pipeline propio:
+# cargar_audio y transcribir_audio, que devuelve el idioma y los segmentos con sus marcas de tiempo.
+# XLA compila cada función la primera vez que se llama con una forma de entrada nueva. El pipeline completa siempre
+# el lote hasta su tamaño y la detección del idioma hasta el número de dispositivos, así que cada una tiene una sola
+# forma y se compila una sola vez: calentar lo hace antes de la primera petición y mide cuánto tarda
+class ModeloJax:
+
+    def __init__(self, tamano):
+        import jax
+        import jax.numpy as jnp
+        from transformers.models.whisper.tokenization_whisper import LANGUAGES
+        from whisper_jax import FlaxWhisperPipline
+
+        self.dispositivos = jax.local_device_count()
+        self.dtype = tipo_jax(jax.default_backend())
+        self.lote = lote_jax(jax.default_backend(), self.dispositivos)
+        self.pipeline = FlaxWhisperPipline(f"openai/whisper-{tamano}", dtype=getattr(jnp, self.dtype),
+                                           batch_size=self.lote)
+        self.compilacion = None
+
+        # Tokens de los idiomas que conoce el tokenizador del modelo, en el orden de LANGUAGES
+        tokenizador = self.pipeline.tokenizer
+        tokens = {codigo: tokenizador.convert_tokens_to_ids(f"<|{codigo}|>") for codigo in LANGUAGES}
+        self.idiomas = [codigo for codigo, token in tokens.items() if token != tokenizador.unk_token_id]
+        tokens_idiomas = jnp.asarray([tokens[codigo] for codigo in self.idiomas])
+        inicio = tokenizador.convert_tokens_to_ids("<|startoftranscript|>")
+
+        # Logits de los tokens de idioma tras el de inicio, en una sola pasada del decodificador, repartida entre los
+        # dispositivos con los mismos parámetros replicados que usa el pipeline
+        def logits_idiomas(params, caracteristicas):
+            tokens_inicio = jnp.full((caracteristicas.shape[0], 1), inicio, dtype="i4")
+            logits = self.pipeline.model(caracteristicas, decoder_input_ids=tokens_inicio, params=params).logits
+            return logits[:, -1, tokens_idiomas]
+
+        self.p_logits_idiomas = jax.pmap(logits_idiomas, "input_features")
+
+    # Memoria en bytes de los parámetros del modelo
+    def memoria(self):
+        import jax
+
+        return sum(hoja.nbytes for hoja in jax.tree_util.tree_leaves(self.pipeline.params))
+
+    # Decodificar el archivo con ffmpeg a un buffer float32 mono de 16 kHz
+    def cargar_audio(self, localizacion_archivo):
+        from transformers.pipelines.audio_utils import ffmpeg_read
+
+        with open(localizacion_archivo, "rb") as archivo:
+            return ffmpeg_read(archivo.read(), FRECUENCIA_MUESTREO)
+
+    # Detectar el idioma con la primera ventana de 30 segundos: el token de idioma más probable tras el de inicio.
+    # La ventana se repite en todos los dispositivos, para que la entrada tenga siempre la misma forma
+    def detectar_idioma(self, audio):
+        import numpy as np
+        from flax.training.common_utils import shard
+
+        caracteristicas = self.pipeline.feature_extractor(audio[:MUESTRAS_VENTANA], sampling_rate=FRECUENCIA_MUESTREO,
+                                                          return_tensors="np").input_features
+        caracteristicas = np.repeat(caracteristicas, self.dispositivos, axis=0)
+        logits = self.p_logits_idiomas(self.pipeline.params, shard(caracteristicas))
+        return self.idiomas[int(np.argmax(np.asarray(logits)[0, 0]))]
+
+    # Compilar la detección del idioma y la generación del pipeline antes de la primera petición, transcribiendo dos
+    # veces una ventana de silencio: la primera compila y la segunda ya no. Devuelve los segundos de compilación (la
+    # diferencia entre las dos) y los de la segunda pasada
+    def calentar(self):
+        import numpy as np
+
+        silencio = np.zeros(MUESTRAS_VENTANA, dtype=np.float32)
+        tiempos = []
+        for _ in range(2):
+            inicio = time.perf_counter()
+            self.transcribir_audio(silencio)
+            tiempos.append(time.perf_counter() - inicio)
+        self.compilacion = max(0.0, tiempos[0] - tiempos[1])
+        return {"compilacion": self.compilacion, "pasada": tiempos[1]}
+
+    def transcribir_audio(self, audio, idioma=None, tarea="transcribe"):
+        idioma = idioma or self.detectar_idioma(audio)
+        salida = self.pipeline({"array": audio, "sampling_rate": FRECUENCIA_MUESTREO}, batch_size=self.lote,
+                               task=tarea, language=f"<|{idioma}|>", return_timestamps=True)
+        segmentos = []
+        for numero, trozo in enumerate(salida["chunks"]):
+            inicio, fin = trozo["timestamp"]
+            # El último trozo puede quedar sin marca de fin: termina con el audio
+            if fin is None:
+                fin = len(audio) / FRECUENCIA_MUESTREO
+            segmentos.append({"id": numero, "start": inicio, "end": fin, "text": trozo["text"]})
+        return idioma, segmentos
@@ -1,118 +1,187 @@
+import json
 import os
+import re
 import time
-from flask import Flask, request, render_template
-import whisper
-import torch
-from whisper.tokenizer import LANGUAGES
-from deep_translator import GoogleTranslator
-import yt_dlp
+from flask import Flask, Response, jsonify, request, render_template, stream_with_context
+from idiomas import nombre_idioma
+from transcripcion import RepartidorFragmentos, segmento_publico, transcribir_archivo, transcribir_en_streaming
+import registro
+from planificador import crear_planificador
+from cache import crear_cache
+from backends import MODELOS_DISPONIBLES, TAMANO_MODELO, ModeloNoDisponible, nombre_modelo, tamano_solicitado
+from subidas import ArchivoDemasiadoGrande, TAMANO_MAXIMO_PETICION, guardar_subida
+from descargas import descargar_audio
+from subtitulos import FORMATOS, exportar
+from perfiles import (PERFIL_GRABACIONES, PERFILES, PERFIL_POR_DEFECTO, PerfilNoDisponible, idioma_fijado,
+                      opciones_transcripcion)
+from metricas import TIPO_CONTENIDO, exponer, medidores_replicas, observar, sumar_indicador
 
 app = Flask(__name__)
 app.config['ALLOWED_EXTENSIONS'] = {'wav', 'mp3', 'ogg', 'flac'}
+# Werkzeug corta la lectura del cuerpo en cuanto supera este tamaño y responde 413
+app.config['MAX_CONTENT_LENGTH'] = TAMANO_MAXIMO_PETICION
 
-# Comprobar si hay disponible una GPU NVIDIA
-torch.cuda.is_available()
-device = "cuda" if torch.cuda.is_available() else "cpu"
+# Modelo Whisper con el backend y el tamaño de la configuración (por defecto, PyTorch y el modelo de tamaño medio,
+# lento, pero preciso en idiomas diferentes al inglés). El planificador tiene una réplica por GPU si CUDA está
+# disponible y, si no, las réplicas de CPU configuradas (por defecto, una por cada bloque de núcleos; ver
+# planificador.py), y manda cada trabajo a la que tiene menos en curso. Cada réplica se usa a través de su agrupador
+# de lotes, que junta las ventanas de las peticiones concurrentes en una sola pasada del modelo. El registro las carga
+# en segundo plano, de modo que el servidor arranca sin esperar; las peticiones que lleguen antes esperan a la carga.
+# Cada petición puede elegir otro de los tamaños disponibles, que el registro carga al pedirlo por primera vez
+planificador = crear_planificador()
+planificador.cargar_en_segundo_plano()
 
-# Cargar el modelo Whisper. Inicializar el modelo de tamaño medio, lento, pero preciso en idiomas diferentes al inglés,
-# moviéndolo a GPU si CUDA está disponible
-model = whisper.load_model("medium").to(device)
+# Caché de resultados por contenido del audio, modelo y opciones, para que los archivos y vídeos repetidos no se
+# vuelvan a transcribir
+cache = crear_cache(nombre_modelo())
+
+# Los audios largos se dividen por los silencios y sus fragmentos se transcriben en paralelo, repartidos entre las
+# réplicas: tantos a la vez como ventanas caben en los lotes de todas ellas
+repartidor = RepartidorFragmentos(planificador)
 
 
 @app.route("/")
 def home():
-    return render_template("index.html")
-
-
-# Definir la función que procesará las archivos
-def procesar_archivo(localizacion_archivo):
-
-    # Cargar audio y rellenarlo/recortarlo para que se ajuste a trozos de 30 segundos
-    audio = whisper.load_audio(localizacion_archivo)  # str, bytes or os.PathLike
-    audio = whisper.pad_or_trim(audio)
-    # Hacer un espectrograma log-Mel y pasar al mismo dispositivo que el modelo
-    mel = whisper.log_mel_spectrogram(audio).to(model.device)
+    return render_template("index.html", modelos=MODELOS_DISPONIBLES, modeloPorDefecto=TAMANO_MODELO,
+                           perfiles=PERFILES, perfilPorDefecto=PERFIL_POR_DEFECTO, perfilGrabaciones=PERFIL_GRABACIONES)
 
-    # Detectar el idioma hablado
-    _, probs = model.detect_language(mel)
-    traductor = GoogleTranslator(source='auto', target='es')
-    idioma_detectado = traductor.translate(LANGUAGES[max(probs, key=probs.get)].title())
 
-    # Decodificamos el audio
-    # options = whisper.DecodingOptions(fp16 = False)
-    # transcripcion = whisper.decode(model, mel, options)
-    transcripcion = model.transcribe(localizacion_archivo)
+# Opciones de la transcripción elegidas en el formulario de la petición: el perfil de decodificación, el idioma del
+# audio y si se quieren las marcas de tiempo de cada palabra (ver perfiles.py)
+def opciones_formulario(por_defecto=PERFIL_POR_DEFECTO):
+    return opciones_transcripcion(request.form.get("perfil"), request.form.get("idioma"),
+                                  bool(request.form.get("palabras")), por_defecto)
 
-    # Eliminar el archivo del disco
-    os.remove(localizacion_archivo)
 
-    # Devolvemos la transcripción y el idioma
-    return idioma_detectado, transcripcion['text']
+# Definir la función que procesará las archivos
+def procesar_archivo(localizacion_archivo, tamano=None, opciones=None):
+    opciones = opciones or {}
+
+    # Decodificar el audio una sola vez y reutilizarlo, junto con su espectrograma log-Mel y el idioma detectado,
+    # en toda la transcripción
+    sumar_indicador("whisper_trabajos_en_curso")
+    try:
+        with planificador.reservar() as model:
+            resultado = transcribir_archivo(model, localizacion_archivo, cache=cache, repartir=repartidor,
+                                            tamano=tamano, **opciones)
+    finally:
+        sumar_indicador("whisper_trabajos_en_curso", -1)
+        # Eliminar el archivo del disco, también si la transcripción falla
+        os.remove(localizacion_archivo)
+
+    # Obtener el nombre del idioma detectado a partir de la tabla local, sin llamadas a red
+    idioma_detectado = nombre_idioma(resultado["idioma"])
+
+    # Devolvemos el idioma y la transcripción, con los tiempos de cada etapa, el factor de tiempo real y los enlaces
+    # para descargar sus segmentos, que ya están en la caché, como subtítulos o en JSON
+    resultado["descargas"] = enlaces_descarga(resultado["clave"])
+    return idioma_detectado, resultado
+
+
+# Enlaces de descarga de todos los formatos de un resultado de la caché (ver descargar_subtitulos)
+def enlaces_descarga(clave):
+    return {formato: f"/descargas/{clave}.{formato}" for formato in FORMATOS}
+
+
+# Definir la función que procesará los archivos en streaming: genera una línea JSON por evento (el idioma, cada
+# segmento con sus marcas de tiempo en cuanto se decodifica y el fin con los tiempos de cada etapa, incluido el tiempo
+# hasta el primer segmento)
+def procesar_archivo_streaming(localizacion_archivo, tamano=None, opciones=None):
+    opciones = opciones or {}
+    sumar_indicador("whisper_trabajos_en_curso")
+    try:
+        with planificador.reservar() as model:
+            for evento in transcribir_en_streaming(model, localizacion_archivo, cache=cache, repartir=repartidor,
+                                                   tamano=tamano, **opciones):
+                if evento["tipo"] == "idioma":
+                    evento["nombre"] = nombre_idioma(evento["idioma"])
+                elif evento["tipo"] == "segmento":
+                    evento["segmento"] = segmento_publico(evento["segmento"])
+                yield json.dumps(evento) + "\n"
+    finally:
+        sumar_indicador("whisper_trabajos_en_curso", -1)
+        # Eliminar el archivo del disco
+        os.remove(localizacion_archivo)
 
 
 @app.route('/transcripcion_grabacion', methods=['POST'])
 def transcripcion_grabacion():
+    # Guardar el tiempo de inicio, con el reloj monótono de alta resolución. La subida incluye la lectura del cuerpo
+    inicio = time.perf_counter()
 
     audiograbado = request.files['audiograbado']
+    tamano = tamano_solicitado(request.form.get("modelo"))
+    # Las grabaciones del micrófono son notas de voz cortas: si no eligen perfil, van por el rápido
+    opciones = opciones_formulario(PERFIL_GRABACIONES)
 
     if audiograbado and allowed_file(audiograbado.filename):
-        # Guardo el archivo en una ubicación (la raiz del directorio actual) temporal
-        localizacion_archivo = f"./{audiograbado.filename}"
-
-        with open(localizacion_archivo, "wb+") as file_object:
-            file_object.write(audiograbado.read())
+        # Copiar el archivo por trozos a un temporal con nombre único, sin cargarlo entero en memoria
+        localizacion_archivo = guardar_subida(audiograbado.stream, audiograbado.filename)
+        observar("whisper_etapa_segundos", time.perf_counter() - inicio, etapa="subida")
 
         # Obtener el nombre del archivo y su formato
         nombre_archivo = audiograbado.filename.split(".")
 
         # Guardar el tiempo de inicio
-        tiempo_inicio = int(time.time())
+        tiempo_inicio = time.perf_counter()
 
         # Se obtienen los valores de idioma y transcripción de la función procesar_archivo
-        idioma_detectado, transcripcion = procesar_archivo(localizacion_archivo)
+        idioma_detectado, transcripcion = procesar_archivo(localizacion_archivo, tamano, opciones)
 
         # Guardar el tiempo de finalización
-        tiempo_final = int(time.time())
+        tiempo_final = time.perf_counter()
         # Calcular el tiempo de transcripción en segundos
         tiempo_transcripcion = tiempo_final - tiempo_inicio
 
         # Renderizar la plantilla
         return render_template("resultado.html", nombreArchivo=nombre_archivo[0], formato=nombre_archivo[1],
-                               idioma=idioma_detectado, transcripcion=transcripcion, tiempoTranscripcion=tiempo_transcripcion)
+                               idioma=idioma_detectado, transcripcion=transcripcion["texto"],
+                               tiempoTranscripcion=tiempo_transcripcion, tiemposEtapas=transcripcion["tiempos"],
+                               rtf=transcripcion["rtf"], modelo=nombre_modelo(tamano),
+                               descargas=transcripcion["descargas"], idiomaFijado=idioma_fijado(opciones))
     else:
         return "Error: Archivo no válido."
 
 
 @app.route('/transcripcion_archivo', methods=['POST'])
 def transcripcion_archivo():
+    # Guardar el tiempo de inicio, con el reloj monótono de alta resolución. La subida incluye la lectura del cuerpo
+    inicio = time.perf_counter()
 
     archivo_audio = request.files['archivo_audio']
+    tamano = tamano_solicitado(request.form.get("modelo"))
+    opciones = opciones_formulario()
 
     if archivo_audio and allowed_file(archivo_audio.filename):
-        # Guardo el archivo en una ubicación (la raiz del directorio actual) temporal
-        localizacion_archivo = f"./{archivo_audio.filename}"
+        # Copiar el archivo por trozos a un temporal con nombre único, sin cargarlo entero en memoria
+        localizacion_archivo = guardar_subida(archivo_audio.stream, archivo_audio.filename)
+        observar("whisper_etapa_segundos", time.perf_counter() - inicio, etapa="subida")
 
-        with open(localizacion_archivo, "wb+") as file_object:
-            file_object.write(archivo_audio.read())
+        # Si se pide, devolver la transcripción en streaming, segmento a segmento
+        if request.form.get("streaming"):
+            return Response(stream_with_context(procesar_archivo_streaming(localizacion_archivo, tamano, opciones)),
+                            mimetype="application/x-ndjson")
 
         # Obtener el nombre del archivo y su formato
         nombre_archivo = archivo_audio.filename.split('.')
 
         # Guardar el tiempo de inicio
-        tiempo_inicio = int(time.time())
+        tiempo_inicio = time.perf_counter()
 
         # Se obtienen los valores de idioma y transcripción de la función procesar_archivo
-        idioma_detectado, transcripcion = procesar_archivo(localizacion_archivo)
+        idioma_detectado, transcripcion = procesar_archivo(localizacion_archivo, tamano, opciones)
 
         # Guardar el tiempo de finalización
-        tiempo_final = int(time.time())
+        tiempo_final = time.perf_counter()
 
         # Calcular el tiempo de transcripción en segundos
         tiempo_transcripcion = tiempo_final - tiempo_inicio
 
         return render_template("resultado.html", nombreArchivo=nombre_archivo[0], formato=nombre_archivo[1],
-                           idioma=idioma_detectado, transcripcion=transcripcion,
-                           tiempoTranscripcion=tiempo_transcripcion)
+                           idioma=idioma_detectado, transcripcion=transcripcion["texto"],
+                           tiempoTranscripcion=tiempo_transcripcion, tiemposEtapas=transcripcion["tiempos"],
+                           rtf=transcripcion["rtf"], modelo=nombre_modelo(tamano),
+                           descargas=transcripcion["descargas"], idiomaFijado=idioma_fijado(opciones))
     else:
         return "Error: Archivo no válido."
 
@@ -120,41 +189,105 @@ def transcripcion_archivo():
 @app.route('/transcripcion_video', methods=['POST'])
 def transcripcion_video():
     url = request.form['url']
-
-    # Configuración de yt-dlp
-    ydl_opts = {
-        "format": "bestaudio/best",
-        "outtmpl": "audio.%(ext)s",
-        "postprocessors": [{
-            "key": "FFmpegExtractAudio",
-            "preferredcodec": "mp3",
-            "preferredquality": "192",
-        }],
-    }
-
-    # Descarga el audio del video
-    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-        ydl.download([url])
-
-    # Obtiene el título del video
-    with yt_dlp.YoutubeDL() as ydl:
-        info = ydl.extract_info(url, download=False)
-        title = info.get("title", None)
+    tamano = tamano_solicitado(request.form.get("modelo"))
+    opciones = opciones_formulario()
+
+    # Si el vídeo ya se transcribió con el mismo modelo, devolver el resultado sin volver a descargarlo
+    inicio_consulta = time.perf_counter()
+    clave = cache.clave_url(url, opciones, modelo=nombre_modelo(tamano))
+    resultado = cache.obtener(clave)
+    if resultado is not None:
+        return render_template("resultado.html", nombreArchivo=resultado["titulo"],
+                               formato=resultado.get("formato", "mp3"),
+                               idioma=resultado["idioma"], transcripcion=resultado["transcripcion"],
+                               tiempoTranscripcion=0,
+                               tiemposEtapas={"consulta_cache": time.perf_counter() - inicio_consulta},
+                               descargas=enlaces_descarga(clave) if "segmentos" in resultado else None,
+                               idiomaFijado=idioma_fijado(opciones))
+
+    # Descarga el audio del video y obtiene su título con una sola llamada a yt-dlp
+    inicio = time.perf_counter()
+    localizacion_archivo, title, formato = descargar_audio(url)
+    observar("whisper_etapa_segundos", time.perf_counter() - inicio, etapa="descarga")
 
     # Guardar el tiempo de inicio
-    tiempo_inicio = int(time.time())
+    tiempo_inicio = time.perf_counter()
 
     # Se obtienen los valores de idioma y transcripción de la función procesar_archivo
-    idioma_detectado, transcripcion = procesar_archivo("audio.mp3")
+    idioma_detectado, transcripcion = procesar_archivo(localizacion_archivo, tamano, opciones)
 
     # Guardar el tiempo de finalización
-    tiempo_final = int(time.time())
+    tiempo_final = time.perf_counter()
 
     # Calcular el tiempo de transcripción en segundos
     tiempo_transcripcion = tiempo_final - tiempo_inicio
 
-    return render_template("resultado.html", nombreArchivo=title, formato="mp3", idioma=idioma_detectado,
-                           transcripcion=transcripcion, tiempoTranscripcion=tiempo_transcripcion)
+    # Guardar también el resultado bajo la URL del vídeo, con sus segmentos para descargarlos
+    cache.guardar(clave, {"titulo": title, "formato": formato, "idioma": idioma_detectado,
+                          "transcripcion": transcripcion["texto"],
+                          "segmentos": [segmento_publico(segmento) for segmento in transcripcion["segmentos"]]})
+
+    return render_template("resultado.html", nombreArchivo=title, formato=formato, idioma=idioma_detectado,
+                           transcripcion=transcripcion["texto"], tiempoTranscripcion=tiempo_transcripcion,
+                           tiemposEtapas=transcripcion["tiempos"], rtf=transcripcion["rtf"],
+                           modelo=nombre_modelo(tamano), descargas=transcripcion["descargas"],
+                           idiomaFijado=idioma_fijado(opciones))
+
+
+# Descargar los segmentos de un resultado de la caché como subtítulos (srt, vtt) o en JSON, con las marcas de tiempo
+# de cada palabra si se pidieron. Se generan a partir de los segmentos guardados, sin volver a pasar por el modelo
+@app.route('/descargas/<clave>.<formato>')
+def descargar_subtitulos(clave, formato):
+    # Las claves de la caché son huellas SHA-256; cualquier otra cosa no se busca
+    if formato not in FORMATOS or not re.fullmatch(r"[0-9a-f]{64}", clave):
+        return "Error: Descarga no disponible.", 404
+    resultado = cache.obtener(clave)
+    if resultado is None or "segmentos" not in resultado:
+        return "Error: La transcripción ya no está disponible.", 404
+
+    texto, tipo = exportar([segmento_publico(segmento) for segmento in resultado["segmentos"]], formato)
+    return Response(texto, content_type=tipo, headers={"Content-Disposition": "attachment"})
+
+
+# Aciertos y fallos de la caché de resultados
+@app.route('/estado_cache')
+def estado_cache():
+    return jsonify(cache.metricas())
+
+
+# Métricas del servicio en el formato de Prometheus. Sin cola de trabajos, la profundidad de la cola son las ventanas
+# que esperan al modelo en los agrupadores de lotes
+@app.route('/metrics')
+def metrics():
+    medidores = {"whisper_cola_pendientes": registro.ventanas_pendientes(),
+                 **medidores_replicas(planificador.estado()["replicas"])}
+    return Response(exponer(medidores), content_type=TIPO_CONTENIDO)
+
+
+# Modelos cargados, memoria que ocupan y últimas cargas y expulsiones
+@app.route('/estado_modelos')
+def estado_modelos():
+    return jsonify(registro.estado())
+
+
+# Réplicas del modelo: dispositivo, núcleos, trabajos en curso y ocupación de cada una
+@app.route('/estado_replicas')
+def estado_replicas():
+    return jsonify(planificador.estado())
+
+
+# Los modelos, los perfiles de decodificación y los idiomas que no están entre los disponibles se rechazan con 400
+@app.errorhandler(ModeloNoDisponible)
+@app.errorhandler(PerfilNoDisponible)
+def modelo_no_disponible(error):
+    return f"Error: {error}", 400
+
+
+# Los archivos que superan el tamaño máximo se rechazan con 413
+@app.errorhandler(413)
+@app.errorhandler(ArchivoDemasiadoGrande)
+def archivo_demasiado_grande(error):
+    return "Error: Archivo demasiado grande.", 413
 
 
 def allowed_file(filename):
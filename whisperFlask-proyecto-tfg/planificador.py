@@ -0,0 +1,165 @@
+import contextlib
+import os
+import threading
+import time
+
+import torch
+
+from agrupador import LOTE_MAXIMO
+from registro import ModeloPerezoso
+
+# Planificador de dispositivos: una réplica del modelo por dispositivo y cada trabajo a la réplica con menos trabajos
+# en curso. Con DISPOSITIVOS = auto (por defecto) hay una réplica por GPU si CUDA está disponible y, si no,
+# REPLICAS_CPU réplicas en CPU; también se puede dar la lista de dispositivos, por ejemplo cuda:0,cuda:1 o cpu,cpu.
+# Con REPLICAS_CPU = auto (por defecto) hay una réplica de CPU por cada NUCLEOS_REPLICA_CPU núcleos del proceso, de
+# modo que los fragmentos de un audio largo se transcriben en paralelo sin configurar nada; cada réplica tiene sus
+# propios pesos, así que con poca memoria conviene fijar menos (REPLICAS_CPU = 1 es una sola). En GPU, con una sola,
+# los fragmentos solo van en paralelo si el agrupador junta sus ventanas en lotes (LOTE_MAXIMO mayor que 1).
+# Las réplicas de CPU se reparten los núcleos del proceso en bloques consecutivos: cada una se ejecuta solo en los
+# suyos, con tantos hilos de torch como núcleos tiene el bloque (o HILOS_CPU, si se indica), para que las réplicas no
+# se quiten los núcleos entre ellas. Con una sola réplica de CPU se mantienen los hilos de torch por defecto
+DISPOSITIVOS = os.environ.get("DISPOSITIVOS", "auto")
+REPLICAS_CPU = os.environ.get("REPLICAS_CPU", "auto")
+NUCLEOS_REPLICA_CPU = int(os.environ.get("NUCLEOS_REPLICA_CPU", "4"))
+HILOS_CPU = int(os.environ.get("HILOS_CPU", "0"))
+
+
+def dispositivos_disponibles():
+    if DISPOSITIVOS != "auto":
+        return [dispositivo.strip() for dispositivo in DISPOSITIVOS.split(",") if dispositivo.strip()]
+    if torch.cuda.is_available():
+        return [f"cuda:{numero}" for numero in range(torch.cuda.device_count())]
+    return ["cpu"] * replicas_cpu()
+
+
+# Número de réplicas de CPU: el configurado o, con auto, una por cada NUCLEOS_REPLICA_CPU núcleos que puede usar el
+# proceso, al menos una
+def replicas_cpu():
+    if REPLICAS_CPU != "auto":
+        return int(REPLICAS_CPU)
+    return max(1, len(os.sched_getaffinity(0)) // NUCLEOS_REPLICA_CPU)
+
+
+# Repartir los núcleos que puede usar el proceso en partes bloques consecutivos, lo más iguales posible. Si hay más
+# partes que núcleos, cada parte se queda con uno y varias comparten el mismo
+def repartir_nucleos(partes, nucleos=None):
+    nucleos = sorted(os.sched_getaffinity(0) if nucleos is None else nucleos)
+    if partes >= len(nucleos):
+        return [{nucleos[numero % len(nucleos)]} for numero in range(partes)]
+
+    tamano, resto = divmod(len(nucleos), partes)
+    bloques, inicio = [], 0
+    for numero in range(partes):
+        fin = inicio + tamano + (1 if numero < resto else 0)
+        bloques.append(set(nucleos[inicio:fin]))
+        inicio = fin
+    return bloques
+
+
+# Hilos de torch para réplicas de CPU con los bloques de núcleos indicados. El número de hilos es el mismo en todo el
+# proceso, así que se ajusta al bloque más pequeño
+def configurar_hilos(bloques):
+    torch.set_num_threads(HILOS_CPU or min(len(bloque) for bloque in bloques))
+
+
+# Réplicas del modelo y sus trabajos en curso. Cada réplica lleva la cuenta de los trabajos que se le han asignado y
+# del tiempo que ha tenido alguno en curso, para conocer su ocupación
+class Planificador:
+
+    def __init__(self, replicas):
+        self.replicas = replicas
+        self.en_curso = [0] * len(replicas)
+        self.asignados = [0] * len(replicas)
+        self.ocupada = [0.0] * len(replicas)
+        self.ocupada_desde = [None] * len(replicas)
+        self.inicio = time.perf_counter()
+        self.cerrojo = threading.Lock()
+
+    # Trabajos que caben a la vez: tantos por réplica como ventanas caben en un lote del agrupador
+    def capacidad(self):
+        return len(self.replicas) * LOTE_MAXIMO
+
+    # Elegir la réplica con menos trabajos en curso (a igualdad, la que menos ha recibido) y contar el trabajo en ella.
+    # Devuelve su número, que se pasa a liberar al terminar
+    def asignar(self):
+        with self.cerrojo:
+            numero = min(range(len(self.replicas)), key=lambda n: (self.en_curso[n], self.asignados[n]))
+            self.en_curso[numero] += 1
+            self.asignados[numero] += 1
+            if self.en_curso[numero] == 1:
+                self.ocupada_desde[numero] = time.perf_counter()
+        return numero
+
+    def liberar(self, numero):
+        with self.cerrojo:
+            self.en_curso[numero] -= 1
+            if self.en_curso[numero] == 0:
+                self.ocupada[numero] += time.perf_counter() - self.ocupada_desde[numero]
+                self.ocupada_desde[numero] = None
+
+    # Réplica para un trabajo, con el tamaño de modelo que pida, mientras dura el bloque with
+    @contextlib.contextmanager
+    def reservar(self, tamano=None):
+        numero = self.asignar()
+        try:
+            replica = self.replicas[numero]
+            yield replica if tamano is None else replica.variante(tamano)
+        finally:
+            self.liberar(numero)
+
+    # Calentar todas las réplicas en segundo plano
+    def cargar_en_segundo_plano(self):
+        for replica in self.replicas:
+            replica.cargar_en_segundo_plano()
+
+    # Dispositivo, núcleos, trabajos en curso y ocupación de cada réplica: la fracción del tiempo desde que arrancó el
+    # planificador en que ha tenido algún trabajo
+    def estado(self):
+        ahora = time.perf_counter()
+        with self.cerrojo:
+            replicas = []
+            for numero, replica in enumerate(self.replicas):
+                ocupada = self.ocupada[numero]
+                if self.ocupada_desde[numero] is not None:
+                    ocupada += ahora - self.ocupada_desde[numero]
+                replicas.append({
+                    "dispositivo": replica.dispositivo,
+                    "replica": numero,
+                    "nucleos": sorted(replica.nucleos) if replica.nucleos else None,
+                    "en_curso": self.en_curso[numero],
+                    "trabajos": self.asignados[numero],
+                    "ocupada_segundos": ocupada,
+                    "ocupacion": ocupada / max(ahora - self.inicio, 1e-9),
+                })
+        return {"hilos_torch": torch.get_num_threads(), "replicas": replicas}
+
+
+# Planificador de un proceso con varias réplicas: una por dispositivo disponible, cada réplica de CPU con su bloque
+# de núcleos
+def crear_planificador(tamano=None, backend=None):
+    dispositivos = dispositivos_disponibles()
+    cpus = [numero for numero, dispositivo in enumerate(dispositivos) if dispositivo == "cpu"]
+    nucleos = {}
+    if len(cpus) > 1:
+        nucleos = dict(zip(cpus, repartir_nucleos(len(cpus))))
+        configurar_hilos(nucleos.values())
+    elif HILOS_CPU:
+        torch.set_num_threads(HILOS_CPU)
+    return Planificador([ModeloPerezoso(tamano, backend, dispositivo, numero, nucleos.get(numero))
+                         for numero, dispositivo in enumerate(dispositivos)])
+
+
+# Planificador de uno de varios procesos iguales (los de un worker de Celery), con una sola réplica: el dispositivo le
+# toca por turno y, en CPU, un bloque de núcleos propio al que se fija todo el proceso. La réplica es siempre la
+# número 0, para que los procesos compartan los pesos cargados antes de crearlos
+def planificador_proceso(indice, procesos, tamano=None, backend=None):
+    dispositivos = dispositivos_disponibles()
+    dispositivo = dispositivos[indice % len(dispositivos)]
+    nucleos = None
+    if dispositivo == "cpu" and procesos > 1:
+        nucleos = repartir_nucleos(procesos)[indice % procesos]
+        os.sched_setaffinity(0, nucleos)
+        configurar_hilos([nucleos])
+    elif HILOS_CPU:
+        torch.set_num_threads(HILOS_CPU)
+    return Planificador([ModeloPerezoso(tamano, backend, dispositivo, 0, nucleos)])
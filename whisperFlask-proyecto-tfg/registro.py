@@ -0,0 +1,204 @@
+import collections
+import contextlib
+import os
+import resource
+import threading
+import time
+
+from agrupador import AgrupadorLotes
+from backends import cargar_modelo, memoria_estimada, memoria_modelo, nombre_modelo
+
+# Registro de modelos: cada modelo se carga una sola vez por proceso, la primera vez que se usa o en el
+# calentamiento, y nunca en los procesos que solo encolan trabajo. Los pesos cargados antes de un fork (por ejemplo,
+# en el proceso principal de un worker de Celery) se comparten con los procesos hijos por copia en escritura; cada
+# proceso crea su propio agrupador de lotes, porque los hilos no sobreviven al fork.
+# Las réplicas de un mismo modelo en un mismo dispositivo se distinguen por su número: cada una tiene sus propios pesos,
+# porque whisper no admite dos decodificaciones a la vez sobre el mismo modelo.
+# Pueden estar cargados varios modelos a la vez mientras sus pesos quepan en MEMORIA_MODELOS megabytes por
+# dispositivo (0, sin límite). Al cargar uno que no cabe, se expulsan los usados hace más tiempo que no tengan
+# trabajos en curso
+MEMORIA_MODELOS = int(os.environ.get("MEMORIA_MODELOS", "0")) * 1024 * 1024
+
+# Pesos y memoria de cada modelo cargado, del usado hace más tiempo al más reciente
+_pesos = collections.OrderedDict()
+_memoria = {}
+_agrupadores = {}
+# Trabajos en curso con cada modelo (ver usar): mientras tenga alguno no se expulsa
+_en_uso = collections.Counter()
+# Un cerrojo por modelo para cargarlo una sola vez sin bloquear el uso de los demás mientras tanto
+_cargas = {}
+_cerrojo = threading.Lock()
+
+# Últimas cargas y expulsiones, y funciones a las que se avisa de cada una
+_eventos = collections.deque(maxlen=100)
+_oyentes = []
+
+
+def _clave(tamano, backend, dispositivo, replica):
+    return nombre_modelo(tamano, backend), str(dispositivo), replica
+
+
+# Avisar de una carga o una expulsión
+def _registrar_evento(tipo, clave, memoria, segundos=None):
+    evento = {"tipo": tipo, "modelo": clave[0], "dispositivo": clave[1], "replica": clave[2], "memoria": memoria,
+              "segundos": segundos, "instante": time.time()}
+    _eventos.append(evento)
+    for oyente in _oyentes:
+        oyente(evento)
+
+
+# Expulsar los modelos del dispositivo usados hace más tiempo hasta que quepan adicional bytes más, sin tocar el que
+# se está cargando ni los que tienen trabajos en curso, aunque entonces se supere el límite. Se llama con el cerrojo
+# tomado y devuelve las claves expulsadas con su memoria
+def _liberar(clave_nueva, adicional):
+    expulsados = []
+    if not MEMORIA_MODELOS:
+        return expulsados
+
+    dispositivo = clave_nueva[1]
+    while sum(memoria for clave, memoria in _memoria.items() if clave[1] == dispositivo) + adicional > MEMORIA_MODELOS:
+        candidatas = [clave for clave in _pesos
+                      if clave[1] == dispositivo and clave != clave_nueva and not _en_uso[clave]]
+        if not candidatas:
+            break
+        clave = candidatas[0]
+        del _pesos[clave]
+        expulsados.append((clave, _memoria.pop(clave)))
+        # Nadie usa ya su agrupador; los trabajos siguientes vuelven a cargar el modelo
+        for clave_agrupador in [clave_agrupador for clave_agrupador in _agrupadores if clave_agrupador[1:] == clave]:
+            _agrupadores.pop(clave_agrupador).cerrar()
+    return expulsados
+
+
+# Cargar los pesos del modelo si aún no lo están, sin crear el agrupador. Cada uso lo marca como el más reciente
+def precargar(tamano=None, backend=None, dispositivo="cpu", replica=0):
+    clave = _clave(tamano, backend, dispositivo, replica)
+    with _cerrojo:
+        if clave in _pesos:
+            _pesos.move_to_end(clave)
+            return _pesos[clave]
+        carga = _cargas.setdefault(clave, threading.Lock())
+
+    with carga:
+        with _cerrojo:
+            if clave in _pesos:
+                _pesos.move_to_end(clave)
+                return _pesos[clave]
+            # Hacer sitio antes de cargar, con la memoria estimada, para no superar el límite mientras se carga
+            expulsados = _liberar(clave, memoria_estimada(tamano))
+        for clave_expulsada, memoria in expulsados:
+            _registrar_evento("expulsion", clave_expulsada, memoria)
+
+        inicio = time.perf_counter()
+        pesos = cargar_modelo(tamano, backend, dispositivo)
+        segundos = time.perf_counter() - inicio
+        memoria = memoria_modelo(pesos)
+
+        with _cerrojo:
+            _pesos[clave] = pesos
+            _memoria[clave] = memoria
+            # Ajustar con la memoria real, que puede ser mayor que la estimada
+            expulsados = _liberar(clave, 0)
+        _registrar_evento("carga", clave, memoria, segundos)
+        for clave_expulsada, memoria in expulsados:
+            _registrar_evento("expulsion", clave_expulsada, memoria)
+        return pesos
+
+
+# Modelo listo para usar en este proceso: los pesos del registro detrás de un agrupador de lotes propio del proceso.
+# Si se indican núcleos, el agrupador, que es quien ejecuta el modelo, solo usa esos
+def obtener_modelo(tamano=None, backend=None, dispositivo="cpu", replica=0, nucleos=None):
+    pesos = precargar(tamano, backend, dispositivo, replica)
+    clave = (os.getpid(),) + _clave(tamano, backend, dispositivo, replica)
+    with _cerrojo:
+        if clave not in _agrupadores:
+            _agrupadores[clave] = AgrupadorLotes(pesos, nucleos=nucleos)
+        return _agrupadores[clave]
+
+
+# Modelo de un trabajo: se resuelve una sola vez al empezar y el registro no lo expulsa hasta que termina el bloque
+# with, de modo que todo el trabajo usa los mismos pesos y el mismo agrupador
+@contextlib.contextmanager
+def usar(tamano=None, backend=None, dispositivo="cpu", replica=0, nucleos=None):
+    clave = _clave(tamano, backend, dispositivo, replica)
+    with _cerrojo:
+        _en_uso[clave] += 1
+    try:
+        yield obtener_modelo(tamano, backend, dispositivo, replica, nucleos)
+    finally:
+        with _cerrojo:
+            _en_uso[clave] -= 1
+            if not _en_uso[clave]:
+                del _en_uso[clave]
+
+
+# Modelos cargados en este proceso, por nombre, dispositivo y réplica
+def modelos_cargados():
+    with _cerrojo:
+        return list(_pesos)
+
+
+# Ventanas esperando en los agrupadores de lotes de este proceso
+def ventanas_pendientes():
+    with _cerrojo:
+        return sum(agrupador.cola.qsize() for clave, agrupador in _agrupadores.items() if clave[0] == os.getpid())
+
+
+# Llamar a funcion con cada evento de carga o expulsión de este proceso
+def suscribir(funcion):
+    _oyentes.append(funcion)
+
+
+# Modelos cargados con la memoria de sus pesos, memoria ocupada por dispositivo, memoria máxima que ha llegado a usar
+# el proceso y últimas cargas y expulsiones
+def estado():
+    with _cerrojo:
+        modelos = [{"modelo": clave[0], "dispositivo": clave[1], "replica": clave[2], "memoria": _memoria[clave]}
+                   for clave in reversed(_pesos)]
+        eventos = list(_eventos)
+    memoria = {}
+    for modelo in modelos:
+        memoria[modelo["dispositivo"]] = memoria.get(modelo["dispositivo"], 0) + modelo["memoria"]
+    return {
+        "presupuesto": MEMORIA_MODELOS or None,
+        "memoria": memoria,
+        # En Linux ru_maxrss está en kilobytes
+        "memoria_maxima_proceso": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+        "modelos": modelos,
+        "eventos": eventos,
+    }
+
+
+# Referencia perezosa a un modelo del registro: se usa igual que el modelo (decode, detect_language, device...), pero
+# no se carga hasta que se accede a él por primera vez. Cada acceso vuelve a pasar por el registro, así que un trabajo
+# no lo usa directamente, sino el modelo que devuelve reservar. Las réplicas de CPU pueden llevar el juego de núcleos
+# en el que se ejecutan
+class ModeloPerezoso:
+
+    def __init__(self, tamano=None, backend=None, dispositivo="cpu", replica=0, nucleos=None):
+        self._tamano = tamano
+        self._backend = backend
+        self.dispositivo = dispositivo
+        self.replica = replica
+        self.nucleos = nucleos
+        self.nombre = nombre_modelo(tamano, backend)
+
+    def cargar(self):
+        return obtener_modelo(self._tamano, self._backend, self.dispositivo, self.replica, self.nucleos)
+
+    # El modelo resuelto para un trabajo, que no se expulsa hasta que termina el bloque with (ver usar)
+    def reservar(self):
+        return usar(self._tamano, self._backend, self.dispositivo, self.replica, self.nucleos)
+
+    # Calentar el modelo en un hilo aparte, para que el servicio empiece a atender mientras se carga
+    def cargar_en_segundo_plano(self):
+        threading.Thread(target=self.cargar, name="carga-modelo", daemon=True).start()
+
+    # La misma réplica, en el mismo dispositivo y con los mismos núcleos, con otro tamaño de modelo
+    def variante(self, tamano):
+        return ModeloPerezoso(tamano, self._backend, self.dispositivo, self.replica, self.nucleos)
+
+    def __getattr__(self, nombre):
+        if nombre.startswith("_"):
+            raise AttributeError(nombre)
+        return getattr(self.cargar(), nombre)
@@ -0,0 +1,66 @@
+import json
+import os
+
+import redis
+import redis.asyncio as aioredis
+
+# Los eventos de cada tarea (cambios de estado, segmentos decodificados, fin y error) se publican en un canal de Redis.
+# Los segmentos se guardan además en una lista durante CADUCIDAD_EVENTOS segundos, para que quien se suscriba tarde
+# pueda recuperar los que ya se publicaron
+CADUCIDAD_EVENTOS = 3600
+
+# Conexión a Redis
+REDIS_URL = os.environ.get("REDIS_URL", "redis://localhost:6379/0")
+conexion = redis.Redis.from_url(REDIS_URL)
+
+
+def canal(task_id):
+    return f"tarea:{task_id}:eventos"
+
+
+def lista_segmentos(task_id):
+    return f"tarea:{task_id}:segmentos"
+
+
+# Publicar un evento de la tarea. Se llama desde el worker
+def publicar(task_id, tipo, **datos):
+    evento = json.dumps({"tipo": tipo, **datos})
+    with conexion.pipeline() as pipe:
+        if tipo == "segmento":
+            pipe.rpush(lista_segmentos(task_id), evento)
+            pipe.expire(lista_segmentos(task_id), CADUCIDAD_EVENTOS)
+        pipe.publish(canal(task_id), evento)
+        pipe.execute()
+
+
+# Escuchar los eventos de la tarea desde la API: primero los segmentos ya publicados y después los nuevos, hasta el
+# evento de fin o de error. Si pasan espera segundos sin eventos se entrega None, para que quien escucha pueda
+# mantener viva la conexión y comprobar si la tarea terminó mientras no había nadie suscrito
+async def escuchar(task_id, espera=15):
+    cliente = aioredis.Redis.from_url(REDIS_URL)
+    pubsub = cliente.pubsub()
+    # Suscribirse antes de leer la lista para no perder los segmentos publicados entre ambas operaciones
+    await pubsub.subscribe(canal(task_id))
+    try:
+        ultimo_segmento = -1
+        for evento in await cliente.lrange(lista_segmentos(task_id), 0, -1):
+            evento = json.loads(evento)
+            ultimo_segmento = evento["id"]
+            yield evento
+
+        while True:
+            mensaje = await pubsub.get_message(ignore_subscribe_messages=True, timeout=espera)
+            if mensaje is None:
+                yield None
+                continue
+
+            evento = json.loads(mensaje["data"])
+            if evento["tipo"] == "segmento" and evento["id"] <= ultimo_segmento:
+                continue
+            yield evento
+            if evento["tipo"] in ("fin", "error"):
+                return
+    finally:
+        await pubsub.unsubscribe(canal(task_id))
+        await pubsub.close()
+        await cliente.close()
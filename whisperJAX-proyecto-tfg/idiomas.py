@@ -0,0 +1,127 @@
+import os
+from functools import lru_cache
+
+# Idioma en el que se muestran los nombres de los idiomas detectados
+IDIOMA_DESTINO = os.environ.get("IDIOMA_DESTINO", "es")
+
+# Nombres de todos los idiomas que reconoce Whisper (whisper.tokenizer.LANGUAGES), en inglés y en español.
+# La tabla es local, así que localizar el idioma detectado no necesita ninguna llamada a red
+NOMBRES_IDIOMAS = {
+    "en": ("English", "Inglés"),
+    "zh": ("Chinese", "Chino"),
+    "de": ("German", "Alemán"),
+    "es": ("Spanish", "Español"),
+    "ru": ("Russian", "Ruso"),
+    "ko": ("Korean", "Coreano"),
+    "fr": ("French", "Francés"),
+    "ja": ("Japanese", "Japonés"),
+    "pt": ("Portuguese", "Portugués"),
+    "tr": ("Turkish", "Turco"),
+    "pl": ("Polish", "Polaco"),
+    "ca": ("Catalan", "Catalán"),
+    "nl": ("Dutch", "Neerlandés"),
+    "ar": ("Arabic", "Árabe"),
+    "sv": ("Swedish", "Sueco"),
+    "it": ("Italian", "Italiano"),
+    "id": ("Indonesian", "Indonesio"),
+    "hi": ("Hindi", "Hindi"),
+    "fi": ("Finnish", "Finés"),
+    "vi": ("Vietnamese", "Vietnamita"),
+    "he": ("Hebrew", "Hebreo"),
+    "uk": ("Ukrainian", "Ucraniano"),
+    "el": ("Greek", "Griego"),
+    "ms": ("Malay", "Malayo"),
+    "cs": ("Czech", "Checo"),
+    "ro": ("Romanian", "Rumano"),
+    "da": ("Danish", "Danés"),
+    "hu": ("Hungarian", "Húngaro"),
+    "ta": ("Tamil", "Tamil"),
+    "no": ("Norwegian", "Noruego"),
+    "th": ("Thai", "Tailandés"),
+    "ur": ("Urdu", "Urdu"),
+    "hr": ("Croatian", "Croata"),
+    "bg": ("Bulgarian", "Búlgaro"),
+    "lt": ("Lithuanian", "Lituano"),
+    "la": ("Latin", "Latín"),
+    "mi": ("Maori", "Maorí"),
+    "ml": ("Malayalam", "Malayalam"),
+    "cy": ("Welsh", "Galés"),
+    "sk": ("Slovak", "Eslovaco"),
+    "te": ("Telugu", "Telugu"),
+    "fa": ("Persian", "Persa"),
+    "lv": ("Latvian", "Letón"),
+    "bn": ("Bengali", "Bengalí"),
+    "sr": ("Serbian", "Serbio"),
+    "az": ("Azerbaijani", "Azerí"),
+    "sl": ("Slovenian", "Esloveno"),
+    "kn": ("Kannada", "Canarés"),
+    "et": ("Estonian", "Estonio"),
+    "mk": ("Macedonian", "Macedonio"),
+    "br": ("Breton", "Bretón"),
+    "eu": ("Basque", "Euskera"),
+    "is": ("Icelandic", "Islandés"),
+    "hy": ("Armenian", "Armenio"),
+    "ne": ("Nepali", "Nepalí"),
+    "mn": ("Mongolian", "Mongol"),
+    "bs": ("Bosnian", "Bosnio"),
+    "kk": ("Kazakh", "Kazajo"),
+    "sq": ("Albanian", "Albanés"),
+    "sw": ("Swahili", "Suajili"),
+    "gl": ("Galician", "Gallego"),
+    "mr": ("Marathi", "Maratí"),
+    "pa": ("Punjabi", "Panyabí"),
+    "si": ("Sinhala", "Cingalés"),
+    "km": ("Khmer", "Jemer"),
+    "sn": ("Shona", "Shona"),
+    "yo": ("Yoruba", "Yoruba"),
+    "so": ("Somali", "Somalí"),
+    "af": ("Afrikaans", "Afrikáans"),
+    "oc": ("Occitan", "Occitano"),
+    "ka": ("Georgian", "Georgiano"),
+    "be": ("Belarusian", "Bielorruso"),
+    "tg": ("Tajik", "Tayiko"),
+    "sd": ("Sindhi", "Sindi"),
+    "gu": ("Gujarati", "Guyaratí"),
+    "am": ("Amharic", "Amárico"),
+    "yi": ("Yiddish", "Ídish"),
+    "lo": ("Lao", "Lao"),
+    "uz": ("Uzbek", "Uzbeko"),
+    "fo": ("Faroese", "Feroés"),
+    "ht": ("Haitian Creole", "Criollo haitiano"),
+    "ps": ("Pashto", "Pastún"),
+    "tk": ("Turkmen", "Turcomano"),
+    "nn": ("Nynorsk", "Noruego nynorsk"),
+    "mt": ("Maltese", "Maltés"),
+    "sa": ("Sanskrit", "Sánscrito"),
+    "lb": ("Luxembourgish", "Luxemburgués"),
+    "my": ("Myanmar", "Birmano"),
+    "bo": ("Tibetan", "Tibetano"),
+    "tl": ("Tagalog", "Tagalo"),
+    "mg": ("Malagasy", "Malgache"),
+    "as": ("Assamese", "Asamés"),
+    "tt": ("Tatar", "Tártaro"),
+    "haw": ("Hawaiian", "Hawaiano"),
+    "ln": ("Lingala", "Lingala"),
+    "ha": ("Hausa", "Hausa"),
+    "ba": ("Bashkir", "Baskir"),
+    "jw": ("Javanese", "Javanés"),
+    "su": ("Sundanese", "Sundanés"),
+    "yue": ("Cantonese", "Cantonés"),
+}
+
+# Posición de cada idioma de destino dentro de las tuplas de NOMBRES_IDIOMAS
+IDIOMAS_DESTINO = {"en": 0, "es": 1}
+
+# Permitir buscar también por el nombre en inglés, que es lo que devuelven algunos modelos
+CODIGOS_POR_NOMBRE = {ingles.lower(): codigo for codigo, (ingles, _) in NOMBRES_IDIOMAS.items()}
+
+
+# Devolver el nombre del idioma detectado (código o nombre en inglés) en el idioma de destino elegido.
+# Las consultas se memorizan en una caché acotada
+@lru_cache(maxsize=256)
+def nombre_idioma(idioma, destino=IDIOMA_DESTINO):
+    codigo = idioma.lower()
+    codigo = CODIGOS_POR_NOMBRE.get(codigo, codigo)
+    if codigo not in NOMBRES_IDIOMAS:
+        return idioma.title()
+    return NOMBRES_IDIOMAS[codigo][IDIOMAS_DESTINO.get(destino, IDIOMAS_DESTINO["es"])]
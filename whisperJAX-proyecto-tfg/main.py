@@ -1,16 +1,26 @@
-#import yt_dlp
 from celery import Celery
+from celery.signals import task_postrun, task_prerun, worker_process_init
+import asyncio
+import json
 import os
+import threading
 import time
+from urllib.parse import quote
 
 from fastapi import FastAPI, Form, Request, UploadFile, File
-from fastapi.responses import HTMLResponse
-from tempfile import NamedTemporaryFile
+from fastapi.responses import HTMLResponse, JSONResponse, PlainTextResponse, Response, StreamingResponse
 import uvicorn
 from fastapi.templating import Jinja2Templates
-from deep_translator import GoogleTranslator
+from idiomas import nombre_idioma
+from eventos import REDIS_URL, conexion, escuchar, publicar
+from subidas import ArchivoDemasiadoGrande, TAMANO_MAXIMO_PETICION, guardar_subida
+from descargas import descargar_audio
+from subtitulos import FORMATOS, exportar
+from perfiles import PERFIL_GRABACIONES, PERFILES, PERFIL_POR_DEFECTO, PerfilNoDisponible, opciones_perfil
+import metricas
+from metricas import TIPO_CONTENIDO, exponer, observar, registrar_transcripcion, sumar_indicador
 
-from whisper_jax import FlaxWhisperPipline
+from backends import FRECUENCIA_MUESTREO, cargar_modelo
 
 # Configurar la aplicación FastAPI
 app = FastAPI()
@@ -21,159 +31,282 @@ templates = Jinja2Templates(directory="templates")
 # Configurar Celery con Redis
 celery_app = Celery('tasks', broker='redis://localhost:6379/0', backend='redis://localhost:6379/0')
 
-# Configurar Whisper JAX. Inicializar el modelo de tamaño grande v2
-whisperjax_pipeline = FlaxWhisperPipline("openai/whisper-large-v2")
+# Configurar Whisper JAX a través de la interfaz común de backends, por defecto con el modelo de tamaño grande v2. Solo
+# lo usa el worker, que lo carga al arrancar cada uno de sus procesos (ver calentar_modelo); la API no carga JAX
+model = None
+cerrojo_modelo = threading.Lock()
+
+# Métricas en Redis: las tareas se ejecutan en el worker de Celery y la API las expone en /metrics
+metricas.configurar(os.environ.get("METRICAS_URL", REDIS_URL))
+
 
 @app.get("/", response_class=HTMLResponse)
 async def home(request: Request):
-    return templates.TemplateResponse("index.html", context={"request": request})
+    return templates.TemplateResponse("index.html", context={"request": request, "perfiles": PERFILES,
+                                                             "perfilPorDefecto": PERFIL_POR_DEFECTO,
+                                                             "perfilGrabaciones": PERFIL_GRABACIONES})
+
+
+# Los perfiles de decodificación y los idiomas que no existen se rechazan con 400, antes de encolar la tarea
+@app.exception_handler(PerfilNoDisponible)
+async def perfil_no_disponible(request: Request, exc: PerfilNoDisponible):
+    return PlainTextResponse(str(exc), status_code=400)
+
+
+# Idioma que fija el perfil elegido en la petición, o None para detectarlo. El pipeline de JAX decodifica siempre
+# igual, así que de los perfiles (ver perfiles.py) solo usa el idioma, que se fija si la petición lo indica o si el
+# perfil rápido lo tiene configurado
+def idioma_perfil(perfil, idioma, por_defecto=PERFIL_POR_DEFECTO):
+    return opciones_perfil(perfil, idioma, por_defecto).get("language")
+
+
+# Rechazar con 413 las peticiones que declaran un cuerpo mayor que el permitido, antes de leerlo, y con 400 las que
+# declaran un tamaño que no es un entero no negativo. Las que no lo declaran se cortan al copiar el archivo subido
+@app.middleware("http")
+async def limitar_tamano_peticion(request: Request, call_next):
+    try:
+        tamano = int(request.headers.get("content-length", 0))
+    except ValueError:
+        tamano = -1
+    if tamano < 0:
+        return PlainTextResponse("Cabecera Content-Length no válida", status_code=400)
+    if tamano > TAMANO_MAXIMO_PETICION:
+        return PlainTextResponse("Archivo demasiado grande", status_code=413)
+    return await call_next(request)
 
 
 # Definir la ruta que maneja las solicitudes de envío de archivos
 @app.post('/transcripcion_grabacion', response_class=HTMLResponse)
-async def transcripcion_grabacion(request: Request, audiograbado: UploadFile = File(...)):
+async def transcripcion_grabacion(request: Request, audiograbado: UploadFile = File(...), perfil: str = Form(""),
+                                  idioma: str = Form("")):
+    # Las grabaciones del micrófono son notas de voz cortas: si no eligen perfil, van por el rápido
+    idioma = idioma_perfil(perfil, idioma, por_defecto=PERFIL_GRABACIONES)
 
-    # Compruebo que se trata de un archivo de audio y limito su tamaño a un máximo de 100Mb
+    # Compruebo que se trata de un archivo de audio y limito su tamaño a un máximo de 100Mb. El archivo se copia por
+    # trozos a un temporal con nombre único, contando los bytes según se copian
     if audiograbado.content_type.startswith('audio/'):
-        if audiograbado.__sizeof__() > 100000000:
+        inicio_peticion = time.time()
+        inicio = time.perf_counter()
+        try:
+            localizacion_archivo = await asyncio.to_thread(guardar_subida, audiograbado.file, audiograbado.filename)
+        except ArchivoDemasiadoGrande:
             return {"error": "Archivo demasiado grande. Supera los 100MB. Pruebe otro"}
-        else:
-            # Guardo el archivo en una ubicación (la raiz del directorio actual) temporal
-            localizacion_archivo = f"./{audiograbado.filename}"
-            with open(localizacion_archivo, "wb+") as archivo:
-                archivo.write(await audiograbado.read())
+        observar("whisper_etapa_segundos", time.perf_counter() - inicio, etapa="subida")
 
-            # Añadir la tarea de procesamiento a la cola de Celery
-            tarea_transcripcion_audio.delay(audiograbado.filename)
+        # Añadir la tarea de procesamiento a la cola de Celery
+        task = tarea_transcripcion_audio.delay(localizacion_archivo, audiograbado.filename, idioma=idioma,
+                                               inicio_peticion=inicio_peticion, encolado=time.time())
 
-            # Renderizar una página de carga mientras se procesa el audio
-            return templates.TemplateResponse("procesando.html", {"request": request, "task_id": task.id})
+        # Renderizar una página de carga mientras se procesa el audio
+        return templates.TemplateResponse("procesando.html", {"request": request, "task_id": task.id})
     else:
         return {"error": "Tipo de archivo no permitido"}
 
 
 @app.post('/transcripcion_archivo', response_class=HTMLResponse)
-async def transcripcion_archivo(request: Request, archivo_audio: UploadFile = File(...)):
+async def transcripcion_archivo(request: Request, archivo_audio: UploadFile = File(...), perfil: str = Form(""),
+                                idioma: str = Form("")):
+    idioma = idioma_perfil(perfil, idioma)
 
-    # Compruebo que se trata de un archivo de audio y limito su tamaño a un máximo de 100Mb
+    # Compruebo que se trata de un archivo de audio y limito su tamaño a un máximo de 100Mb. El archivo se copia por
+    # trozos a un temporal con nombre único, contando los bytes según se copian
     if archivo_audio.content_type.startswith('audio/'):
-        if archivo_audio.__sizeof__() > 100000000:
+        inicio_peticion = time.time()
+        inicio = time.perf_counter()
+        try:
+            localizacion_archivo = await asyncio.to_thread(guardar_subida, archivo_audio.file, archivo_audio.filename)
+        except ArchivoDemasiadoGrande:
             return {"error": "Archivo demasiado grande. Supera los 100MB. Pruebe otro"}
-        else:
-            # Guardo el archivo en una ubicación (la raiz del directorio actual) temporal
-            localizacion_archivo = f"./{archivo_audio.filename}"
-            with open(localizacion_archivo, "wb+") as archivo:
-                archivo.write(await archivo_audio.read())
+        observar("whisper_etapa_segundos", time.perf_counter() - inicio, etapa="subida")
 
-            # Añadir la tarea de procesamiento a la cola de Celery
-            tarea_transcripcion_audio.delay(archivo_audio.filename)
+        # Añadir la tarea de procesamiento a la cola de Celery
+        task = tarea_transcripcion_audio.delay(localizacion_archivo, archivo_audio.filename, idioma=idioma,
+                                               inicio_peticion=inicio_peticion, encolado=time.time())
 
-            # Renderizar una página de carga mientras se procesa el audio
-            return templates.TemplateResponse("procesando.html", {"request": request, "task_id": task.id})
+        # Renderizar una página de carga mientras se procesa el audio
+        return templates.TemplateResponse("procesando.html", {"request": request, "task_id": task.id})
     else:
         return {"error": "Tipo de archivo no permitido"}
 
 
 @app.post('/transcripcion_video', response_class=HTMLResponse)
-async def transcripcion_video(request: Request, url: str = Form(...)):
-    
-    # Configuración de yt-dlp
-    ydl_opts = {
-        "format": "bestaudio/best",
-        "outtmpl": "audio.%(ext)s",
-        "postprocessors": [{
-            "key": "FFmpegExtractAudio",
-            "preferredcodec": "mp3",
-            "preferredquality": "192",
-        }],
-    }
-
-    # Descarga el audio del video
-    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-        ydl.download([url])
-
-    # Obtiene el título del video
-    with yt_dlp.YoutubeDL() as ydl:
-        info = ydl.extract_info(url, download=False)
-        title = info.get("title", None)
-
-    # Guardar el tiempo de inicio
-    tiempo_inicio = int(time.time())
-
-    # Añadir la tarea de procesamiento a la cola de Celery
-    resultados_tarea = tarea_transcripcion_audio.delay("audio.mp3")
-
-    # Obtener los resultados de la transcripción desde la variable global
-    nombre_archivo, transcripcion, idioma_detectado = resultados_tarea.get()
-
-    # Guardar el tiempo de finalización
-    tiempo_final = int(time.time())
-
-    # Calcular el tiempo de transcripción en segundos
-    tiempo_transcripcion = tiempo_final - tiempo_inicio
-
-    return templates.TemplateResponse("result.html",
-                                      {"request": request,
-                                       "nombreArchivo": nombre_archivo,
-                                       # "formato": ,
-                                       "transcripcion": transcripcion,
-                                       "idioma": idioma_detectado,
-                                       "tiempoTranscripcion": tiempo_transcripcion})
-
-
-@celery_app.task
-def tarea_transcripcion_audio(localizacion_archivo):
-
-    # Leer el archivo de audio
-    with open(localizacion_archivo, 'rb') as f:
-        datos_audio = f.read()
-
-    # Obtener el nombre del archivo y su formato
-    nombre_archivo = datos_audio.filename.split(".")
-
-    # Obtener la transcripción y el idioma del archivo de audio
-    transcripcion = whisperjax_pipeline.transcribe_audio(localizacion_archivo)
-    traductor = GoogleTranslator(source='auto', target='es')
-    idioma_detectado = traductor.translate(whisperjax_pipeline.detect_language(localizacion_archivo))
-
-    # Eliminar el archivo del disco
-    os.remove(localizacion_archivo)
+async def transcripcion_video(request: Request, url: str = Form(...), perfil: str = Form(""), idioma: str = Form("")):
+    inicio_peticion = time.time()
+    idioma = idioma_perfil(perfil, idioma)
+
+    # Descarga el audio del video y obtiene su título con una sola llamada a yt-dlp, en un hilo aparte para no
+    # bloquear el bucle de eventos
+    inicio = time.perf_counter()
+    localizacion_archivo, title, formato = await asyncio.to_thread(descargar_audio, url)
+    observar("whisper_etapa_segundos", time.perf_counter() - inicio, etapa="descarga")
+
+    # Añadir la tarea de procesamiento a la cola de Celery, sin esperar a su resultado: la página de "Procesando" lo
+    # muestra cuando termina, como con los archivos
+    task = tarea_transcripcion_audio.delay(localizacion_archivo, title, formato, idioma=idioma,
+                                           inicio_peticion=inicio_peticion, encolado=time.time())
+    return templates.TemplateResponse("procesando.html", {"request": request, "task_id": task.id})
+
+
+# Avisar del fin o del error de la tarea cuando su estado ya está guardado en el backend, para que la página de
+# "Procesando" pueda redirigir a los resultados
+class TareaConEventos(celery_app.Task):
+    def after_return(self, status, retval, task_id, args, kwargs, einfo):
+        publicar(task_id, "fin" if status == "SUCCESS" else "error")
+
+
+# Tareas en ejecución en el worker
+@task_prerun.connect
+def empezar_tarea(**kwargs):
+    sumar_indicador("whisper_trabajos_en_curso")
+
+
+@task_postrun.connect
+def terminar_tarea(**kwargs):
+    sumar_indicador("whisper_trabajos_en_curso", -1)
+
+
+# Modelo del worker, cargándolo la primera vez. Este servicio usa siempre el backend de JAX: los de PyTorch no tienen
+# su pipeline (calentar, cargar_audio, transcribir_audio) y sus dependencias no están en la imagen
+def obtener_modelo():
+    global model
+    with cerrojo_modelo:
+        if model is None:
+            model = cargar_modelo(os.environ.get("TAMANO_MODELO", "large-v2"), "jax")
+    return model
+
+
+# Cargar el modelo y compilar sus funciones al arrancar cada proceso del worker, para que la primera petición no pague
+# la compilación. Su duración se registra como la etapa de compilación, aparte del factor de tiempo real de las
+# transcripciones, que así solo mide el estado estacionario
+@worker_process_init.connect
+def calentar_modelo(**kwargs):
+    tiempos = obtener_modelo().calentar()
+    observar("whisper_etapa_segundos", tiempos["compilacion"], etapa="compilacion")
+
+
+# Tarea de transcripción. Si se indica el idioma del audio, no se detecta. inicio_peticion y encolado son los instantes
+# (de reloj de pared, porque se comparan en otro proceso) en que empezó la petición y en que la API encoló la tarea,
+# para medir el tiempo total de la petición y la espera en la cola
+@celery_app.task(bind=True, base=TareaConEventos)
+def tarea_transcripcion_audio(self, localizacion_archivo, nombre_archivo=None, formato=None, inicio_peticion=None,
+                              encolado=None, idioma=None):
+    if encolado is not None:
+        observar("whisper_etapa_segundos", max(0.0, time.time() - encolado), etapa="espera_cola")
+    publicar(self.request.id, "estado", etapa="transcripcion", progreso=0.0)
+    modelo = obtener_modelo()
+    tiempos = {}
+
+    # Obtener el nombre del archivo sin su formato, si no se indica aparte (en los vídeos, el nombre es el título)
+    nombre_archivo = nombre_archivo or os.path.basename(localizacion_archivo)
+    if formato is None:
+        nombre_archivo, extension = os.path.splitext(nombre_archivo)
+        formato = extension.lstrip(".")
+
+    # Obtener la transcripción y el idioma del archivo de audio con el backend configurado. El pipeline transcribe
+    # las ventanas de 30 segundos del audio en lotes, con las funciones ya compiladas al arrancar el worker
+    fijado = idioma is not None
+    try:
+        inicio = time.perf_counter()
+        audio = modelo.cargar_audio(localizacion_archivo)
+        tiempos["carga_audio"] = time.perf_counter() - inicio
+
+        inicio = time.perf_counter()
+        idioma, segmentos = modelo.transcribir_audio(audio, idioma=idioma)
+        tiempos["pipeline"] = time.perf_counter() - inicio
+    finally:
+        # Eliminar el archivo del disco
+        os.remove(localizacion_archivo)
+    transcripcion = "".join(segmento["text"] for segmento in segmentos)
+
+    # Factor de tiempo real: segundos de proceso por segundo de audio
+    duracion_audio = len(audio) / FRECUENCIA_MUESTREO
+    rtf = sum(tiempos.values()) / max(duracion_audio, 1e-9)
+    registrar_transcripcion({"tiempos": tiempos, "duracion_audio": duracion_audio, "rtf": rtf})
+
+    # El tiempo de transcripción se cuenta desde el inicio de la petición, así que incluye la subida o la descarga y
+    # la espera en la cola
+    tiempo_transcripcion = time.time() - inicio_peticion if inicio_peticion is not None else sum(tiempos.values())
+    return {"nombreArchivo": nombre_archivo, "formato": formato, "transcripcion": transcripcion,
+            "idioma": nombre_idioma(idioma), "tiempos": tiempos, "tiempoTranscripcion": tiempo_transcripcion,
+            "rtf": rtf, "modelo": modelo.nombre, "idiomaFijado": fijado, "segmentos": segmentos}
+
+
+# Métricas de la API y del worker en el formato de Prometheus. La profundidad de la cola es la longitud de la cola de
+# Celery en Redis
+@app.get("/metrics")
+def metrics():
+    return PlainTextResponse(exponer({"whisper_cola_pendientes": conexion.llen("celery")}), media_type=TIPO_CONTENIDO)
+
+
+# Canal de eventos enviados por el servidor (SSE) con el progreso de la tarea y el aviso de fin o de error
+@app.get("/eventos/{task_id}")
+async def get_eventos(task_id: str):
+    resultado = tarea_transcripcion_audio.AsyncResult(task_id)
 
-    # Devolvemos el nombre, la transcripción y el idioma
-    return nombre_archivo, transcripcion, idioma_detectado
+    def formatear(evento):
+        return f"event: {evento['tipo']}\ndata: {json.dumps(evento)}\n\n"
+
+    async def eventos():
+        async for evento in escuchar(task_id):
+            if evento is not None:
+                yield formatear(evento)
+            elif resultado.ready():
+                # La tarea terminó sin que llegase su evento de fin (por ejemplo, antes de suscribirse)
+                yield formatear({"tipo": "fin" if resultado.successful() else "error"})
+                return
+            else:
+                # Comentario para mantener viva la conexión
+                yield ": \n\n"
+
+    # Si la tarea ya terminó no hace falta suscribirse
+    if resultado.ready():
+        return StreamingResponse(iter([formatear({"tipo": "fin" if resultado.successful() else "error"})]),
+                                 media_type="text/event-stream")
+    return StreamingResponse(eventos(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
 
 
 @app.get("/resultados/{task_id}", response_class=HTMLResponse)
-async def obtener_resultados(task_id: str):
-    # Guardar el tiempo de inicio
-    tiempo_inicio = int(time.time())
-
+async def obtener_resultados(request: Request, task_id: str):
     # Obtener el resultado de la tarea de Celery
     resultado = tarea_transcripcion_audio.AsyncResult(task_id)
 
-    # Guardar el tiempo de finalización
-    tiempo_final = int(time.time())
-
-    # Calcular el tiempo de transcripción en segundos
-    tiempo_transcripcion = tiempo_final - tiempo_inicio
+    if resultado.successful():
+        resultados = resultado.result
+        return templates.TemplateResponse("resultados.html",
+                                          {"request": request, "nombreArchivo": resultados["nombreArchivo"],
+                                           "formato": resultados["formato"], "idioma": resultados["idioma"],
+                                           "transcripcion": resultados["transcripcion"],
+                                           "tiempoTranscripcion": resultados["tiempoTranscripcion"],
+                                           "tiemposEtapas": resultados["tiempos"], "rtf": resultados["rtf"],
+                                           "modelo": resultados["modelo"],
+                                           "idiomaFijado": resultados.get("idiomaFijado", False),
+                                           "descargas": {formato: f"/resultados/{task_id}/subtitulos.{formato}"
+                                                         for formato in FORMATOS}})
+
+    if resultado.failed():
+        return templates.TemplateResponse("error.html", {"request": request}, status_code=500)
+
+    # Renderizar una página de carga mientras se procesa el audio
+    return templates.TemplateResponse("procesando.html", {"request": request, "task_id": task_id})
+
+
+# Descargar los segmentos de la transcripción terminada como subtítulos (srt, vtt) o en JSON. El pipeline de JAX no
+# alinea las palabras ni da la confianza de cada segmento, así que solo llevan sus marcas de tiempo y su texto
+@app.get("/resultados/{task_id}/subtitulos.{formato}")
+async def obtener_subtitulos(task_id: str, formato: str):
+    if formato not in FORMATOS:
+        return JSONResponse({"error": f"Formato no disponible: {formato}"}, status_code=404)
+    resultado = tarea_transcripcion_audio.AsyncResult(task_id)
+    if not resultado.successful():
+        return JSONResponse({"status": resultado.status}, status_code=404 if resultado.failed() else 202)
 
-    if task_id is None:
-        # Si no hay tareas en la cola, devolver una página de error
-        return templates.TemplateResponse('error.html')
+    resultados = resultado.result
+    texto, tipo = exportar(resultados.get("segmentos", []), formato)
+    # El nombre del archivo (el título de un vídeo, por ejemplo) puede no ser ASCII, así que va codificado
+    nombre = quote(f"{resultados['nombreArchivo']}.{formato}")
+    return Response(texto, media_type=tipo, headers={"Content-Disposition": f"attachment; filename*=UTF-8''{nombre}"})
 
-    if resultado.ready():
-        # Si la tarea ha terminado, devolver el resultado
-        nombre_archivo, transcripcion, idioma_detectado = resultado.get()
-        return templates.TemplateResponse("result.html",
-                                          {"request": request,
-                                           "nombreArchivo": nombre_archivo,
-                                           #"formato": ,
-                                           "transcripcion": transcripcion,
-                                           "idioma": idioma_detectado,
-                                           "tiempoTranscripcion": tiempo_transcripcion})
-    else:
-        # Renderizar una página de carga mientras se procesa el audio
-        return templates.TemplateResponse("procesando.html", {"request": request, "task_id": task_id})
 
 # Para ejecutarlo en local y depurarlo
 if __name__ == "__main__":
@@ -0,0 +1,219 @@
+import os
+import socket
+import threading
+import time
+
+# Métricas del servicio en el formato de texto de Prometheus, para exponerlas en /metrics. Con METRICAS_URL =
+# redis://... se guardan en Redis y las suman todos los procesos (la API y los workers de Celery); si no, se guardan
+# en la memoria del proceso. Las duraciones se miden con time.perf_counter, salvo las que empiezan en un proceso y
+# terminan en otro (la espera en la cola de Celery), que solo pueden medirse con el reloj de pared
+METRICAS_URL = os.environ.get("METRICAS_URL", "")
+# Segundos que se conservan en Redis los indicadores de un proceso que deja de renovarlos (porque ha muerto, por
+# ejemplo) (ver sumar_indicador)
+TTL_INDICADORES = int(os.environ.get("METRICAS_TTL_INDICADORES", "60"))
+
+# Límites de los histogramas de duraciones (en segundos) y del factor de tiempo real
+LIMITES_SEGUNDOS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800)
+LIMITES_RTF = (0.05, 0.1, 0.2, 0.3, 0.5, 0.75, 1, 1.5, 2, 3, 5)
+
+# Métricas expuestas: tipo, descripción y, en los histogramas, sus límites
+METRICAS = {
+    "whisper_etapa_segundos": ("histogram", "Duración de cada etapa de una petición", LIMITES_SEGUNDOS),
+    "whisper_factor_tiempo_real": ("histogram", "Segundos de proceso por segundo de audio de cada transcripción",
+                                   LIMITES_RTF),
+    "whisper_audio_segundos_total": ("counter", "Segundos de audio transcritos", None),
+    "whisper_transcripciones_total": ("counter", "Transcripciones terminadas, por el modelo o desde la caché", None),
+    "whisper_trabajos_en_curso": ("gauge", "Trabajos de transcripción en ejecución", None),
+    "whisper_cola_pendientes": ("gauge", "Trabajos esperando en la cola de inferencia", None),
+    "whisper_replica_trabajos_en_curso": ("gauge", "Trabajos en curso en cada réplica del modelo", None),
+    "whisper_replica_ocupada_segundos_total": ("counter", "Segundos ocupada de cada réplica del modelo", None),
+}
+
+# Etapas de la transcripción (las claves de sus tiempos) que son el bucle de decodificación: se cuentan todas como la
+# etapa decodificacion
+ETAPAS_DECODIFICACION = ("bucle_decodificacion", "fragmentos", "pipeline")
+
+
+# Nombre de una serie con sus etiquetas, tal como aparece en la exposición
+def _serie(nombre, etiquetas):
+    if not etiquetas:
+        return nombre
+    return nombre + "{" + ",".join(f'{clave}="{valor}"' for clave, valor in sorted(etiquetas.items())) + "}"
+
+
+# Orden de las series de una métrica: por etiquetas y, en los histogramas, los límites de menor a mayor seguidos de
+# la suma y el número de observaciones
+def _orden(serie):
+    nombre, _, etiquetas = serie.partition("{")
+    etiquetas = etiquetas.rstrip("}").split(",") if etiquetas else []
+    limite = [etiqueta for etiqueta in etiquetas if etiqueta.startswith("le=")]
+    resto = [etiqueta for etiqueta in etiquetas if not etiqueta.startswith("le=")]
+    sufijo = {"_sum": 1, "_count": 2}.get(nombre[nombre.rfind("_"):], 0)
+    return resto, sufijo, float(limite[0][4:-1]) if limite else 0.0
+
+
+# Métricas en la memoria del proceso
+class MetricasMemoria:
+
+    def __init__(self):
+        self.valores = {}
+        self.cerrojo = threading.Lock()
+
+    def sumar(self, incrementos):
+        with self.cerrojo:
+            for serie, valor in incrementos.items():
+                self.valores[serie] = self.valores.get(serie, 0.0) + valor
+
+    # En un solo proceso, sus indicadores son los del servicio
+    def sumar_proceso(self, incrementos):
+        self.sumar(incrementos)
+
+    def leer(self):
+        with self.cerrojo:
+            return dict(self.valores)
+
+
+# Métricas en un hash de Redis, compartidas por todos los procesos. Los indicadores de cada proceso van en un hash
+# propio, identificado por la máquina y el proceso, que caduca si el proceso deja de renovarlo
+class MetricasRedis:
+
+    CLAVE = "metricas"
+    PREFIJO_PROCESO = "metricas:proceso:"
+
+    def __init__(self, url, ttl=TTL_INDICADORES):
+        import redis
+
+        self.conexion = redis.Redis.from_url(url)
+        self.ttl = ttl
+        self.cerrojo = threading.Lock()
+        self.pid = None
+        self.indicadores = {}
+
+    def sumar(self, incrementos):
+        with self.conexion.pipeline() as pipe:
+            for serie, valor in incrementos.items():
+                pipe.hincrbyfloat(self.CLAVE, serie, valor)
+            pipe.execute()
+
+    # El pid se lee en cada llamada porque los procesos de los workers de Celery se crean con fork
+    def _clave_proceso(self):
+        return f"{self.PREFIJO_PROCESO}{socket.gethostname()}:{os.getpid()}"
+
+    # Sumar a los indicadores del proceso y guardar sus valores. El proceso hijo de un fork empieza con los suyos a
+    # cero y con su propio hilo de renovación
+    def sumar_proceso(self, incrementos):
+        with self.cerrojo:
+            if self.pid != os.getpid():
+                self.pid = os.getpid()
+                self.indicadores = {}
+                threading.Thread(target=self._renovar, name="metricas-indicadores", daemon=True).start()
+            for serie, valor in incrementos.items():
+                self.indicadores[serie] = self.indicadores.get(serie, 0.0) + valor
+            indicadores = dict(self.indicadores)
+        with self.conexion.pipeline() as pipe:
+            pipe.hset(self._clave_proceso(), mapping=indicadores)
+            pipe.expire(self._clave_proceso(), self.ttl)
+            pipe.execute()
+
+    # Renovar la caducidad de los indicadores del proceso mientras siga vivo
+    def _renovar(self):
+        while True:
+            time.sleep(self.ttl / 3)
+            self.conexion.expire(self._clave_proceso(), self.ttl)
+
+    def leer(self):
+        valores = {serie.decode(): float(valor) for serie, valor in self.conexion.hgetall(self.CLAVE).items()}
+        for clave in self.conexion.scan_iter(self.PREFIJO_PROCESO + "*"):
+            for serie, valor in self.conexion.hgetall(clave).items():
+                valores[serie.decode()] = valores.get(serie.decode(), 0.0) + float(valor)
+        return valores
+
+
+def crear_almacen(url=METRICAS_URL):
+    if url.startswith("redis://"):
+        return MetricasRedis(url)
+    return MetricasMemoria()
+
+
+_almacen = crear_almacen()
+
+
+# Guardar las métricas en el almacén de la URL indicada en lugar del configurado
+def configurar(url):
+    global _almacen
+    _almacen = crear_almacen(url)
+
+
+# Añadir una observación a un histograma. Se suma a todos sus límites, aunque sea cero, para que cada serie tenga
+# todos los límites desde la primera observación
+def observar(nombre, valor, **etiquetas):
+    incrementos = {}
+    for limite in METRICAS[nombre][2]:
+        incrementos[_serie(nombre + "_bucket", {**etiquetas, "le": float(limite)})] = int(valor <= limite)
+    incrementos[_serie(nombre + "_bucket", {**etiquetas, "le": "+Inf"})] = 1
+    incrementos[_serie(nombre + "_sum", etiquetas)] = valor
+    incrementos[_serie(nombre + "_count", etiquetas)] = 1
+    _almacen.sumar(incrementos)
+
+
+# Sumar a un contador o a un indicador (con valor negativo, para restar)
+def sumar(nombre, valor=1, **etiquetas):
+    _almacen.sumar({_serie(nombre, etiquetas): valor})
+
+
+# Sumar a un indicador de lo que está haciendo este proceso, como los trabajos en curso (con valor negativo, para
+# restar). Con Redis, cada proceso guarda su propio valor y al exponerlos se suman los de todos, de modo que si un
+# proceso muere con trabajos a medias su parte desaparece al caducar, en lugar de quedarse para siempre
+def sumar_indicador(nombre, valor=1, **etiquetas):
+    _almacen.sumar_proceso({_serie(nombre, etiquetas): valor})
+
+
+# Registrar una transcripción terminada a partir de su resultado (o de su evento de fin): la duración de cada etapa,
+# los segundos de audio y el factor de tiempo real. Las que salen de la caché solo tienen la etapa consulta_cache
+def registrar_transcripcion(resultado):
+    for etapa, segundos in resultado["tiempos"].items():
+        if etapa in ETAPAS_DECODIFICACION:
+            etapa = "decodificacion"
+        observar("whisper_etapa_segundos", segundos, etapa=etapa)
+    origen = "cache" if "consulta_cache" in resultado["tiempos"] else "modelo"
+    sumar("whisper_transcripciones_total", origen=origen)
+    if origen == "modelo":
+        sumar("whisper_audio_segundos_total", resultado["duracion_audio"])
+        observar("whisper_factor_tiempo_real", resultado["rtf"])
+
+
+# Texto de la exposición. En medidores se pasan los indicadores que se calculan en el momento (la profundidad de la
+# cola, por ejemplo), que sustituyen a los guardados
+def exponer(medidores=None):
+    valores = _almacen.leer()
+    valores.update(medidores or {})
+
+    lineas = []
+    for nombre, (tipo, descripcion, _) in METRICAS.items():
+        lineas.append(f"# HELP {nombre} {descripcion}")
+        lineas.append(f"# TYPE {nombre} {tipo}")
+        nombres = (nombre + "_bucket", nombre + "_sum", nombre + "_count") if tipo == "histogram" else (nombre,)
+        for serie in sorted((serie for serie in valores if serie.partition("{")[0] in nombres), key=_orden):
+            lineas.append(f"{serie} {float(valores[serie])!r}")
+    return "\n".join(lineas) + "\n"
+
+
+# Indicadores de la profundidad de cada cola de trabajos, a partir de las tareas que esperan en cada una, para
+# pasarlos a exponer
+def medidores_colas(colas):
+    return {_serie("whisper_cola_pendientes", {"cola": cola}): pendientes for cola, pendientes in colas.items()}
+
+
+# Indicadores de las réplicas del modelo a partir del estado de un planificador (sus trabajos en curso y el tiempo
+# que han estado ocupadas), para pasarlos a exponer
+def medidores_replicas(replicas):
+    medidores = {}
+    for replica in replicas:
+        etiquetas = {"dispositivo": replica["dispositivo"], "replica": replica["replica"]}
+        medidores[_serie("whisper_replica_trabajos_en_curso", etiquetas)] = replica["en_curso"]
+        medidores[_serie("whisper_replica_ocupada_segundos_total", etiquetas)] = replica["ocupada_segundos"]
+    return medidores
+
+
+# Tipo de contenido de la exposición
+TIPO_CONTENIDO = "text/plain; version=0.0.4; charset=utf-8"
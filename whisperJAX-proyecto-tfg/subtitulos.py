@@ -0,0 +1,48 @@
+import json
+
+# Subtítulos y exportaciones a partir de los segmentos de una transcripción (con sus campos start, end y text y, si
+# los tienen, confianza y palabras). Solo dan formato a lo que ya salió de la decodificación, sin volver a pasar por
+# el modelo, así que cuestan muy poco frente a la transcripción
+
+
+# Marca de tiempo de un subtítulo: horas, minutos, segundos y milisegundos, que van separados por una coma en SRT y
+# por un punto en WebVTT
+def marca_tiempo(segundos, separador=","):
+    milisegundos = round(segundos * 1000)
+    horas, milisegundos = divmod(milisegundos, 3600000)
+    minutos, milisegundos = divmod(milisegundos, 60000)
+    segundos, milisegundos = divmod(milisegundos, 1000)
+    return f"{horas:02d}:{minutos:02d}:{segundos:02d}{separador}{milisegundos:03d}"
+
+
+def formato_srt(segmentos):
+    return "\n".join(f"{numero}\n{marca_tiempo(segmento['start'])} --> {marca_tiempo(segmento['end'])}\n"
+                     f"{segmento['text'].strip()}\n" for numero, segmento in enumerate(segmentos, 1))
+
+
+# En WebVTT el texto no puede contener la flecha que separa las marcas de tiempo
+def formato_vtt(segmentos):
+    return "WEBVTT\n\n" + "\n".join(f"{marca_tiempo(segmento['start'], '.')} --> {marca_tiempo(segmento['end'], '.')}\n"
+                                    f"{segmento['text'].strip().replace('-->', '->')}\n" for segmento in segmentos)
+
+
+# Segmentos en JSON, con sus marcas de tiempo, su confianza y, si se pidieron, sus palabras
+def formato_json(segmentos):
+    campos = ("id", "start", "end", "text", "confianza", "palabras")
+    return json.dumps([{campo: segmento[campo] for campo in campos if campo in segmento} for segmento in segmentos],
+                      ensure_ascii=False)
+
+
+# Formatos que se pueden descargar: función que les da formato y tipo de contenido
+FORMATOS = {
+    "srt": (formato_srt, "application/x-subrip; charset=utf-8"),
+    "vtt": (formato_vtt, "text/vtt; charset=utf-8"),
+    "json": (formato_json, "application/json"),
+}
+
+
+# Texto de los segmentos en el formato indicado y su tipo de contenido
+def exportar(segmentos, formato):
+    funcion, tipo = FORMATOS[formato]
+    return funcion(segmentos), tipo
+